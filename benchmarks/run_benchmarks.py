@@ -0,0 +1,150 @@
+from pathlib import Path
+import sys
+import os
+base_dir = str(Path(__file__).parents[1])
+sys.path.append(base_dir)
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import datetime
+import shutil
+import json
+import time
+import numpy as np
+from binary_rivers import synthetic
+from binary_rivers.geometry import pack_geometries, edge_metrics
+from binary_rivers.topology import Topology, tree_metrics, trunk
+from binary_rivers.metrics import Network
+
+
+def measure(func, setup=None, memory=True):
+    """Runs func once for wall time and, optionally, once more under tracemalloc for peak memory.  setup runs untimed
+    before each call."""
+    if setup is not None:
+        setup()
+    t1 = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - t1
+    peak_mb = None
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        func()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return seconds, peak_mb
+
+
+def network_stages(gdf):
+    """The per-phase work Network does, as (setup, func) pairs that can be timed one phase at a time."""
+    indexed = gdf.set_index('HYRIV_ID')
+    topo = Topology(indexed.index.values, indexed['NEXT_DOWN'].values, priority=indexed['UPLAND_SKM'].values, roots=[0])
+    orientation = np.full(len(topo.ids), np.nan)
+    orientation[:topo.n_edges] = edge_metrics(*pack_geometries(indexed.geometry.values))['orientation']
+    depth = tree_metrics(topo, orientation)['depth']
+    network = Network(gdf)
+    return {
+        'edge_metrics': (None, lambda: edge_metrics(*pack_geometries(indexed.geometry.values))),
+        'traversal': (None, lambda: tree_metrics(Topology(indexed.index.values, indexed['NEXT_DOWN'].values, priority=indexed['UPLAND_SKM'].values, roots=[0]), orientation)),
+        'trunk': (None, lambda: trunk(topo, depth)),
+        'network_metrics': (None, lambda: network.calc_network_metrics()),
+        'network_total': (None, lambda: Network(gdf)),
+    }
+
+
+def graph_stages(gdf, work_dir, order_thresh):
+    """Basin labeling, pruning and binarization over a graph.db built from the synthetic reaches."""
+    try:
+        from binary_rivers import extract_graph, graphdb
+    except ImportError as e:
+        return {}, f'skipped graph.db stages: {e}'
+
+    ids, next_down = synthetic.add_multi_confluences(gdf['HYRIV_ID'].values, gdf['NEXT_DOWN'].values)
+    template = os.path.join(work_dir, 'template.db')
+    synthetic.to_graph_db(synthetic.to_geodataframe(ids, next_down), template)
+    work = os.path.join(work_dir, 'graph.db')
+
+    def fresh(labeled=False, pruned=False):
+        graphdb.close(work)  # the shared connection would keep mapping the old file
+        shutil.copy(template, work)
+        if labeled:
+            extract_graph.label_basins_fast(work, order_thresh)
+        if pruned:
+            extract_graph.prune_graph(work)
+
+    def staged(stage, func):
+        return lambda: fresh(*stage), lambda: func(work)
+
+    return {
+        'label_basins': staged((False, False), lambda p: extract_graph.label_basins_fast(p, order_thresh)),
+        'prune_graph': staged((True, False), extract_graph.prune_graph),
+        'binarization': staged((True, True), extract_graph.enforce_binary_fast),
+    }, None
+
+
+def run(sizes, kinds, seed=0, memory=True, order_thresh=3):
+    results = list()
+    notes = list()
+    with tempfile.TemporaryDirectory() as work_dir:
+        for kind in kinds:
+            for size in sizes:
+                ids, next_down = synthetic.make_tree(kind, size, seed)
+                gdf = synthetic.to_geodataframe(ids, next_down, seed)
+                stages = network_stages(gdf)
+                db_stages, note = graph_stages(gdf, work_dir, order_thresh)
+                stages.update(db_stages)
+                if note and note not in notes:
+                    notes.append(note)
+                for stage, (setup, func) in stages.items():
+                    seconds, peak_mb = measure(func, setup, memory)
+                    results.append({'kind': kind, 'reaches': len(gdf), 'stage': stage, 'seconds': seconds, 'peak_mb': peak_mb})
+                    print(f'{kind:>9} {len(gdf):>9} {stage:>16} {seconds:10.4f} s' + (f' {peak_mb:10.1f} MB' if peak_mb is not None else ''))
+    return results, notes
+
+
+def compare(report, baseline):
+    """Prints the time ratio of every stage against a previous report."""
+    old = {(r['kind'], r['reaches'], r['stage']): r for r in baseline['results']}
+    for r in report['results']:
+        key = (r['kind'], r['reaches'], r['stage'])
+        if key in old:
+            print(f'{r["kind"]:>9} {r["reaches"]:>9} {r["stage"]:>16} {old[key]["seconds"] / r["seconds"]:8.2f}x')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time and memory-profile the Network and graph.db stages on synthetic trees.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--kinds', nargs='+', default=['random', 'balanced', 'tokunaga'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc pass')
+    parser.add_argument('--out', default=os.path.join(base_dir, 'benchmarks', 'report.json'))
+    parser.add_argument('--compare', default=None, help='Previous report to compare against')
+    args = parser.parse_args(argv)
+
+    results, notes = run(args.sizes, args.kinds, args.seed, not args.no_memory)
+    report = {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'notes': notes,
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {args.out}')
+    for note in notes:
+        print(note)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
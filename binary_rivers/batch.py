@@ -0,0 +1,201 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import logging
+import sqlite3
+import time
+import os
+from .graphdb import dirty_basins, clear_dirty
+from .instrument import Instrumentation, LoggingCallback, set_instrumentation, stage
+
+
+def plan_chunks(sizes, target_size=50000):
+    """Groups basins into chunks of roughly target_size reaches, largest basins first so chunks stay balanced."""
+    order = sorted(sizes, key=lambda b: sizes[b], reverse=True)
+    chunks = list()
+    current = list()
+    current_size = 0
+    for basin in order:
+        if current and current_size + sizes[basin] > target_size:
+            chunks.append(current)
+            current = list()
+            current_size = 0
+        current.append(basin)
+        current_size += sizes[basin]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def init_results(out_path):
+    """Creates the metrics and failures tables if necessary and returns the basins that already have results."""
+    con = sqlite3.connect(out_path)
+    cur = con.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS metrics (basin INTEGER, metric TEXT, value FLOAT, PRIMARY KEY (basin, metric))')
+    cur.execute('CREATE TABLE IF NOT EXISTS failures (basin INTEGER PRIMARY KEY, error TEXT)')
+    con.commit()
+    done = {i[0] for i in cur.execute('SELECT DISTINCT basin FROM metrics').fetchall()}
+    con.close()
+    return done
+
+
+def invalidate_results(out_path, basins):
+    """Deletes the stored metrics and failures of basins so the next run recomputes them."""
+    init_results(out_path)
+    con = sqlite3.connect(out_path)
+    for table in ['metrics', 'failures']:
+        con.executemany(f'DELETE FROM {table} WHERE basin = ?', [(int(b),) for b in basins])
+    con.commit()
+    con.close()
+
+
+def write_results(con, results):
+    """Stores one chunk of (basin, metrics, error) results in a single transaction."""
+    cur = con.cursor()
+    for basin, metrics, error in results:
+        if error is None:
+            cur.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?)', [(basin, k, float(v)) for k, v in metrics.items()])
+            cur.execute('DELETE FROM failures WHERE basin = ?', (basin,))
+        else:
+            cur.execute('INSERT OR REPLACE INTO failures VALUES (?, ?)', (basin, error))
+    con.commit()
+
+
+def basin_arrays(gdf):
+    """The arrays Network.from_arrays needs for one basin, which pickle far more cheaply than the GeoDataFrame."""
+    from .geometry import CoordinateStore
+    return {
+        'ids': gdf['HYRIV_ID'].to_numpy(),
+        'next_down': gdf['NEXT_DOWN'].to_numpy(),
+        'upland': gdf['UPLAND_SKM'].to_numpy(),
+        'order': gdf['ORD_STRA'].to_numpy(),
+        'coords': CoordinateStore.from_geometries(gdf['geometry'].values),
+    }
+
+
+def basin_metrics(arrays, basin):
+    """Builds the Network for one basin from basin_arrays, rooted at the basin id, and returns its metrics."""
+    from .metrics import Network
+    return Network.from_arrays(**arrays, root=basin).metrics
+
+
+def _run_chunk(chunk):
+    results = list()
+    for basin, arrays in chunk:
+        try:
+            results.append((basin, basin_metrics(arrays, basin), None))
+        except Exception as e:
+            results.append((basin, None, f'{type(e).__name__}: {e}'))
+    return results
+
+
+def load_reaches(in_path, basin_field='basin', db_path=None):
+    """Reads reaches from a GeoPackage, taking basin labels from the nodes table of graph.db if db_path is given."""
+    import geopandas as gpd
+    import pandas as pd
+
+    gdf = gpd.read_file(in_path)
+    if db_path is not None:
+        con = sqlite3.connect(db_path)
+        labels = pd.read_sql_query('SELECT hyriv_id, basin FROM nodes WHERE basin != -1', con)
+        con.close()
+        labels = labels.rename(columns={'hyriv_id': 'HYRIV_ID', 'basin': basin_field})
+        gdf = gdf.drop(columns=[basin_field], errors='ignore').merge(labels, on='HYRIV_ID', how='inner')
+    return gdf
+
+
+def run_basins(gdf, out_path, basin_field='basin', workers=None, chunk_size=50000, basins=None, max_pending=None):
+    """Computes Network metrics for every basin in gdf on a process pool, streaming results into a SQLite table.
+
+    Basins that already have rows in out_path are skipped, so an interrupted run can simply be restarted.  A basin
+    that raises (e.g. 'Multiple roots found') is recorded in the failures table and does not stop the run.  Chunk
+    payloads are built as work is submitted, with at most max_pending chunks (twice the workers by default) in
+    flight, so only those are held in memory next to gdf.
+    """
+    done = init_results(out_path)
+    rows = {b: r for b, r in gdf.groupby(basin_field).indices.items() if b != -1 and b not in done}
+    if basins is not None:
+        rows = {b: rows[b] for b in basins if b in rows}
+    sizes = {b: len(r) for b, r in rows.items()}
+    plan = plan_chunks(sizes, chunk_size)
+    chunks = iter(plan)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+
+    con = sqlite3.connect(out_path)
+    counts = {'ok': 0, 'failed': 0}
+    with stage('run_basins') as s:
+        s.set('basins', len(rows))
+        s.set('chunks', len(plan))
+        s.set('already_done', len(done))
+        t1 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            def submit():
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.add(pool.submit(_run_chunk, [(int(b), basin_arrays(gdf.iloc[rows[b]])) for b in chunk]))
+                return chunk is not None
+
+            pending = set()
+            while len(pending) < max_pending and submit():
+                pass
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    # Each chunk's stage covers the wait for it
+                    with stage('basin_chunk', rows=0, started=t1) as c:
+                        results = future.result()
+                        write_results(con, results)
+                        for _, _, error in results:
+                            counts['ok' if error is None else 'failed'] += 1
+                        c.add_rows(len(results))
+                        c.set('finished', counts['ok'] + counts['failed'])
+                        c.set('basins', len(rows))
+                    s.add_rows(len(results))
+                    t1 = time.perf_counter()
+                    submit()
+        s.set('ok', counts['ok'])
+        s.set('failed', counts['failed'])
+    con.close()
+    return counts
+
+
+def read_results(out_path):
+    """Returns the metrics table as a wide DataFrame indexed by basin."""
+    import pandas as pd
+
+    con = sqlite3.connect(out_path)
+    df = pd.read_sql_query('SELECT basin, metric, value FROM metrics', con)
+    con.close()
+    return df.pivot(index='basin', columns='metric', values='value')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute Network metrics for every basin in a reach dataset.')
+    parser.add_argument('in_path', help='GeoPackage of reaches')
+    parser.add_argument('out_path', help='SQLite file to store metrics in')
+    parser.add_argument('--basin-field', default='basin', help='Column holding basin labels')
+    parser.add_argument('--graph-db', default=None, help='graph.db to take basin labels from instead of the GeoPackage')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=50000, help='Approximate number of reaches per task')
+    parser.add_argument('--dirty', action='store_true', help='Only recompute the basins graph.db marks dirty after a refresh')
+    args = parser.parse_args(argv)
+    if args.dirty and args.graph_db is None:
+        parser.error('--dirty needs --graph-db')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    set_instrumentation(Instrumentation(callbacks=[LoggingCallback()], keep_records=False, count_sql=False))
+
+    basins = None
+    if args.dirty:
+        # Removed basins only lose their old results
+        dirty = dirty_basins(args.graph_db)
+        invalidate_results(args.out_path, dirty)
+        basins = [b for b, status in dirty.items() if status != 'removed']
+    gdf = load_reaches(args.in_path, args.basin_field, args.graph_db)
+    counts = run_basins(gdf, args.out_path, args.basin_field, args.workers, args.chunk_size, basins)
+    if args.dirty:
+        clear_dirty(args.graph_db, dirty)
+    logging.getLogger('binary_rivers').info('Done: %d basins succeeded, %d failed', counts['ok'], counts['failed'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import numpy as np
+import json
+import os
+from .geometry import METRIC_VERSION
+
+
+CACHED_METRICS = ['length', 'curvature', 'meander', 'orientation']
+KEY_COLUMNS = {'hyriv_id': np.int64, 'geom_hash': np.int64, 'used': np.int64}
+
+
+def _sorted_run(columns):
+    """columns sorted by hyriv_id, keeping only the last entry of every repeated id."""
+    ids = columns['hyriv_id']
+    order = np.argsort(ids, kind='stable')
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = ids[order][1:] != ids[order][:-1]
+    return {c: v[order[last]] for c, v in columns.items()}
+
+
+class EdgeMetricCache:
+    """On-disk store of per-reach edge metrics keyed by HYRIV_ID and geometry_hash, kept as .npy columns sorted by
+    HYRIV_ID so a whole network is looked up with one searchsorted.
+
+    An entry only counts as a hit when the stored hash matches, so an edited reach is recomputed.  Every lookup
+    stamps its hits with a new generation number; once more than max_entries reaches are stored the least recently
+    used ones are evicted.  Entries written under another METRIC_VERSION are dropped when the cache is opened.  The
+    cache is meant for one process at a time.
+
+    Used on its own (as Network and Forest do) every put is written straight to disk.  Inside a with block new entries
+    are instead kept in memory as a few sorted runs (merged pairwise as they grow, so each entry is only re-sorted a
+    logarithmic number of times) and written once on leaving the block, or by flush().
+    """
+
+    def __init__(self, path, max_entries=5000000, version=METRIC_VERSION):
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version
+        self._dirty = False
+        self._runs = list()
+        self.autoflush = True
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        if meta is None or meta['version'] != version or not self._load(meta['rows']):
+            self.invalidate()
+        else:
+            self.generation = meta['generation']
+
+    def _load(self, rows):
+        try:
+            self.columns = {c: np.load(os.path.join(self.path, f'{c}.npy')) for c in list(KEY_COLUMNS) + CACHED_METRICS}
+        except (OSError, ValueError):
+            return False
+        return all(len(v) == rows for v in self.columns.values())
+
+    def __len__(self):
+        self._merge()
+        return len(self.columns['hyriv_id'])
+
+    def __enter__(self):
+        self.autoflush = False
+        return self
+
+    def __exit__(self, *exc):
+        self.autoflush = True
+        self.close()
+
+    def invalidate(self):
+        """Drops every entry, e.g. after the metric definitions change."""
+        self.columns = {c: np.zeros(0, dtype=KEY_COLUMNS.get(c, np.float64)) for c in list(KEY_COLUMNS) + CACHED_METRICS}
+        self.generation = 0
+        self._runs = list()
+        self.flush(force=True)
+
+    def get(self, ids, hashes):
+        """Returns a hit mask and a dict of metric arrays (NaN where missed) for the given reaches."""
+        ids = np.asarray(ids, dtype=np.int64)
+        hashes = np.asarray(hashes, dtype=np.int64)
+        self.generation += 1
+        stored = self.columns['hyriv_id']
+        pos = np.minimum(np.searchsorted(stored, ids), max(len(stored) - 1, 0))
+        hit = np.zeros(len(ids), dtype=bool)
+        if len(stored):
+            hit = (stored[pos] == ids) & (self.columns['geom_hash'][pos] == hashes)
+
+        values = {c: np.full(len(ids), np.nan) for c in CACHED_METRICS}
+        for c in CACHED_METRICS:
+            values[c][hit] = self.columns[c][pos[hit]]
+        if hit.any():
+            self.columns['used'][pos[hit]] = self.generation
+            self._dirty = True
+
+        # Entries not written yet, newest run last so it wins
+        for run in self._runs:
+            pos = np.minimum(np.searchsorted(run['hyriv_id'], ids), len(run['hyriv_id']) - 1)
+            run_hit = (run['hyriv_id'][pos] == ids) & (run['geom_hash'][pos] == hashes)
+            for c in CACHED_METRICS:
+                values[c][run_hit] = run[c][pos[run_hit]]
+            run['used'][pos[run_hit]] = self.generation
+            hit |= run_hit
+        return hit, values
+
+    def put(self, ids, hashes, metrics):
+        """Stores (or replaces) the metrics of the given reaches, writing them out unless autoflush is off."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        new = {'hyriv_id': ids, 'geom_hash': np.asarray(hashes, dtype=np.int64), 'used': np.full(len(ids), self.generation, dtype=np.int64)}
+        new.update({c: np.asarray(metrics[c], dtype=np.float64) for c in CACHED_METRICS})
+        self._runs.append(_sorted_run(new))
+        while len(self._runs) > 1 and len(self._runs[-2]['hyriv_id']) <= len(self._runs[-1]['hyriv_id']):
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            self._runs.append(_sorted_run({c: np.concatenate([older[c], newer[c]]) for c in older}))
+        self._dirty = True
+        if self.autoflush:
+            self.flush()
+
+    def _merge(self):
+        """Folds the in-memory runs into the stored columns and evicts down to max_entries."""
+        if not self._runs:
+            return
+        merged = _sorted_run({c: np.concatenate([self.columns[c]] + [r[c] for r in self._runs]) for c in self.columns})
+        if len(merged['hyriv_id']) > self.max_entries:
+            recent = np.sort(np.argsort(-merged['used'], kind='stable')[:self.max_entries])
+            merged = {c: v[recent] for c, v in merged.items()}
+        self.columns = merged
+        self._runs = list()
+
+    def flush(self, force=False):
+        """Writes the columns (with new entries and the usage stamps from lookups) back to disk."""
+        if not (force or self._dirty):
+            return
+        self._merge()
+        for c, v in self.columns.items():
+            tmp = os.path.join(self.path, f'{c}.tmp.npy')
+            np.save(tmp, v)
+            os.replace(tmp, os.path.join(self.path, f'{c}.npy'))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'version': self.version, 'generation': self.generation, 'rows': len(self)}, f)
+        self._dirty = False
+
+    def close(self):
+        self.flush()
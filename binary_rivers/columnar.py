@@ -0,0 +1,102 @@
+import numpy as np
+import sqlite3
+import json
+import os
+
+
+COLUMNS = {
+    'hyriv_id': np.int64,
+    'next_down': np.int64,
+    'length_km': np.float32,
+    'upland_skm': np.float32,
+    'ord_stra': np.int8,
+    'longitude': np.float64,
+    'latitude': np.float64,
+    'basin': np.int64,
+}
+MISSING = {'next_down': 0, 'ord_stra': -1, 'basin': -1}  # written for NULLs in the integer columns (0 is an outlet)
+FIELD_NAMES = {
+    'hyriv_id': 'HYRIV_ID',
+    'next_down': 'NEXT_DOWN',
+    'length_km': 'LENGTH_KM',
+    'upland_skm': 'UPLAND_SKM',
+    'ord_stra': 'ORD_STRA',
+}
+
+
+def write_columnar(db_path, out_dir, chunk_size=500000):
+    """Writes edges and nodes from graph.db as fixed-width .npy columns sorted by basin, plus a basin offset table.
+    NULLs in the integer columns become the MISSING sentinels; in float columns they become NaN."""
+    os.makedirs(out_dir, exist_ok=True)
+    con = sqlite3.connect(db_path)
+    cur = con.cursor()
+    node_columns = [i[1].lower() for i in cur.execute('PRAGMA table_info(nodes)').fetchall()]
+    basin_select = f"COALESCE(n.basin, {MISSING['basin']})" if 'basin' in node_columns else str(MISSING['basin'])
+    n = cur.execute('SELECT COUNT(*) FROM edges').fetchall()[0][0]
+
+    # Stream rows straight into the output files
+    arrays = {c: np.lib.format.open_memmap(os.path.join(out_dir, f'{c}.npy'), mode='w+', dtype=d, shape=(n,)) for c, d in COLUMNS.items()}
+    cur.execute(f'''
+        SELECT e.hyriv_id, COALESCE(e.next_down, {MISSING['next_down']}), e.length_km, e.upland_skm,
+               COALESCE(e.ord_stra, {MISSING['ord_stra']}), n.longitude, n.latitude, {basin_select}
+        FROM edges e
+        LEFT JOIN nodes n ON e.hyriv_id = n.hyriv_id
+        ORDER BY 8, e.hyriv_id
+    ''')
+    start = 0
+    rows = cur.fetchmany(chunk_size)
+    while rows:
+        for c, values in zip(COLUMNS, zip(*rows)):
+            arrays[c][start:start + len(rows)] = np.array(values, dtype=np.float64 if np.issubdtype(COLUMNS[c], np.floating) else np.int64)
+        start += len(rows)
+        rows = cur.fetchmany(chunk_size)
+    con.close()
+
+    # Basin offsets
+    basin = arrays['basin']
+    change = np.flatnonzero(np.diff(basin)) + 1
+    starts = np.concatenate([[0], change]) if n else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(out_dir, 'basin_ids.npy'), np.asarray(basin[starts], dtype=np.int64))
+    np.save(os.path.join(out_dir, 'basin_offsets.npy'), np.concatenate([starts, [n]]).astype(np.int64))
+    for a in arrays.values():
+        a.flush()
+
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'rows': int(n), 'columns': {c: np.dtype(d).str for c, d in COLUMNS.items()}, 'source': os.path.abspath(db_path)}, f, indent=2)
+
+
+class ColumnarGraph:
+    """Read-only, memory-mapped view of a graph written by write_columnar.  Pages are shared between processes."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for c in COLUMNS:
+            setattr(self, c, np.load(os.path.join(path, f'{c}.npy'), mmap_mode='r'))
+        self.basin_ids = np.load(os.path.join(path, 'basin_ids.npy'))
+        self.basin_offsets = np.load(os.path.join(path, 'basin_offsets.npy'))
+        self._basin_lookup = {b: i for i, b in enumerate(self.basin_ids.tolist())}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def basin_slice(self, basin):
+        i = self._basin_lookup[basin]
+        return slice(int(self.basin_offsets[i]), int(self.basin_offsets[i + 1]))
+
+    def basin_columns(self, basin):
+        """Returns zero-copy views of every column for one basin."""
+        s = self.basin_slice(basin)
+        return {c: getattr(self, c)[s] for c in COLUMNS}
+
+    def to_frame(self, basin=None):
+        """Copies one basin, or the whole graph, into a DataFrame with the HydroRIVERS field names."""
+        import pandas as pd
+
+        s = slice(None) if basin is None else self.basin_slice(basin)
+        return pd.DataFrame({FIELD_NAMES.get(c, c): np.asarray(getattr(self, c)[s]) for c in COLUMNS})
+
+
+def open_columnar(path):
+    return ColumnarGraph(path)
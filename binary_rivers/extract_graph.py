@@ -1,13 +1,26 @@
-from osgeo import ogr, osr
-import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import shutil
 from math import ceil
+import struct
 import time
 import os
+import numpy as np
+from .topology import Topology, accumulate_columns, local_values
+from .instrument import stage, watch
+from .graphdb import connect
+
+
+EDGE_COLS = ['HYRIV_ID', 'NEXT_DOWN', 'LENGTH_KM', 'UPLAND_SKM', 'ORD_STRA']
+EDGE_DTYPES = ['INTEGER PRIMARY KEY', 'INTEGER', 'FLOAT', 'FLOAT', 'INTEGER']
+NODE_COLS = ['HYRIV_ID', 'longitude', 'latitude']
+NODE_DTYPES = ['INTEGER PRIMARY KEY', 'FLOAT', 'FLOAT']
 
 
 def insert_into_db(db_path, table_name, fields, dtypes, data, append=True):
     # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
+    watch(conn)
     cur = conn.cursor()
 
     # Create a new table in the SQLite database, if necessary
@@ -20,9 +33,33 @@ def insert_into_db(db_path, table_name, fields, dtypes, data, append=True):
     insert_command = "INSERT INTO {} VALUES ({})".format(table_name, ', '.join(['?' for i in range(len(fields))]))
     cur.executemany(insert_command, data)
 
-    # Commit changes and close connection
+    # Commit changes
     conn.commit()
-    conn.close()
+
+def open_bulk_connection(db_path):
+    """Opens a single connection tuned for bulk loading."""
+    return connect(db_path, bulk=True)
+
+def create_table(conn, table_name, fields, dtypes):
+    conn.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+    conn.execute("CREATE TABLE {} ({})".format(table_name, ', '.join([f'{f} {d}' for f, d in zip(fields, dtypes)])))
+
+def insert_rows(conn, table_name, fields, data):
+    insert_command = "INSERT INTO {} VALUES ({})".format(table_name, ', '.join(['?' for i in range(len(fields))]))
+    conn.executemany(insert_command, data)
+
+def wkb_first_point(wkb):
+    """Returns the first x, y of a (Multi)LineString WKB blob without building an OGR geometry."""
+    wkb = bytes(wkb)
+    endian = '<' if wkb[0] == 1 else '>'
+    geom_type = (struct.unpack_from(endian + 'I', wkb, 1)[0] & 0x0fffffff) % 1000
+    offset = 5
+    if geom_type == 5:  # MultiLineString: skip part count and the first part's header
+        offset += 4
+        endian = '<' if wkb[offset] == 1 else '>'
+        offset += 5
+    offset += 4  # point count
+    return struct.unpack_from(endian + 'dd', wkb, offset)
 
 def explore_db(db):
     # Get the number of layers in the geodatabase
@@ -46,34 +83,35 @@ def explore_db(db):
         field_name = field_def.GetName()
         print(i, ":", field_name)
 
-def extract_graph(in_path, out_path, batch_size=10000):
+def extract_graph(in_path, out_path, batch_size=10000, layer_name='HydroRIVERS_v10_na', stream=True):
     """Extracts edge and node data from HydroRivers and saves it to a SQLite database."""
-    
+    from osgeo import ogr
+
+    if stream:
+        return extract_graph_stream(in_path, out_path, batch_size=batch_size, layer_name=layer_name)
+
     # Load data
     driver = ogr.GetDriverByName("OpenFileGDB")
     geodatabase = driver.Open(in_path)
-    layer_name = 'HydroRIVERS_v10_na'
     row_count = geodatabase.ExecuteSQL('SELECT COUNT(*) AS row_count FROM {}'.format(layer_name))
     row_count = [r.GetField('row_count') for r in row_count][0]
     batches = ceil(row_count / batch_size)
 
     # Set up query info
-    edge_cols = ['HYRIV_ID', 'NEXT_DOWN', 'LENGTH_KM', 'UPLAND_SKM', 'ORD_STRA']
-    edge_dtypes = ['INTEGER PRIMARY KEY', 'INTEGER', 'FLOAT', 'FLOAT', 'INTEGER']
+    edge_cols = EDGE_COLS
+    edge_dtypes = EDGE_DTYPES
     edge_base_query = "SELECT {} FROM {} LIMIT {} OFFSET {}"
     node_query_cols = ['shape', 'HYRIV_ID']
-    node_cols = ['HYRIV_ID', 'longitude', 'latitude']
-    node_dtypes = ['INTEGER PRIMARY KEY', 'FLOAT', 'FLOAT']
+    node_cols = NODE_COLS
+    node_dtypes = NODE_DTYPES
     node_base_query = "SELECT {} FROM {} LIMIT {} OFFSET {}"
 
     # Query and Export
-    print('Extracting Edges')
     append = False
     false_start = 0
     for b in range(batches - false_start):
         t1 = time.perf_counter()
         b += false_start
-        print(f'batch {b} / {batches}')
         if b > 0:
             append = True
         offset = b * batch_size
@@ -95,158 +133,637 @@ def extract_graph(in_path, out_path, batch_size=10000):
         geodatabase.ReleaseResultSet(results)
 
         # Log data to new db
-        insert_into_db(out_path, 'edges', edge_cols, edge_dtypes, edge_values, append=append)
-        insert_into_db(out_path, 'nodes', node_cols, node_dtypes, node_values, append=append)
-        print(f'Finished in {round(time.perf_counter() - t1, 3)} seconds')
+        with stage('extract_batch', rows=len(edge_values), started=t1) as s:
+            s.set('batch', b)
+            s.set('batches', batches)
+            insert_into_db(out_path, 'edges', edge_cols, edge_dtypes, edge_values, append=append)
+            insert_into_db(out_path, 'nodes', node_cols, node_dtypes, node_values, append=append)
+    connect(out_path).create_indexes()
+
+def _read_feature_batches(layer, batch_size):
+    """Yields (edge rows, node rows) from one sequential pass of the layer's feature cursor."""
+    layer_definition = layer.GetLayerDefn()
+    field_idx = [layer_definition.GetFieldIndex(c) for c in EDGE_COLS]
+    layer.ResetReading()
+    edge_values = list()
+    node_values = list()
+    for f in layer:
+        edge = tuple(f.GetField(i) for i in field_idx)
+        x, y = f.geometry().GetGeometryRef(0).GetPoint(0)[0:2]
+        edge_values.append(edge)
+        node_values.append((edge[0], x, y))
+        if len(edge_values) == batch_size:
+            yield edge_values, node_values
+            edge_values = list()
+            node_values = list()
+    if edge_values:
+        yield edge_values, node_values
+
+def _read_arrow_batches(layer, batch_size):
+    """Yields (edge rows, node rows) from GDAL's columnar Arrow stream."""
+    geom_col = layer.GetGeometryColumn() or 'wkb_geometry'
+    layer.ResetReading()
+    stream = layer.GetArrowStreamAsNumPy(options=[f'MAX_FEATURES_IN_BATCH={batch_size}', 'INCLUDE_FID=NO'])
+    for batch in stream:
+        cols = [batch[c].tolist() for c in EDGE_COLS]
+        edge_values = list(zip(*cols))
+        node_values = [(i, *wkb_first_point(g)) for i, g in zip(cols[0], batch[geom_col])]
+        yield edge_values, node_values
+
+def _open_layer(in_path, layer_name):
+    """Opens one layer of a geodatabase with only the fields we keep."""
+    from osgeo import ogr
+    driver = ogr.GetDriverByName("OpenFileGDB")
+    geodatabase = driver.Open(in_path)
+    layer = geodatabase.GetLayerByName(layer_name)
+    layer_definition = layer.GetLayerDefn()
+    all_fields = [layer_definition.GetFieldDefn(i).GetName() for i in range(layer_definition.GetFieldCount())]
+    layer.SetIgnoredFields([f for f in all_fields if f not in EDGE_COLS])
+    return geodatabase, layer
+
+def _batch_reader(layer, batch_size, use_arrow=True):
+    from osgeo import ogr
+    if use_arrow and hasattr(layer, 'GetArrowStreamAsNumPy') and layer.TestCapability(ogr.OLCFastGetArrowStream):
+        return _read_arrow_batches(layer, batch_size)
+    return _read_feature_batches(layer, batch_size)
+
+def _write_batches(conn, reader, batches=None, commit=True):
+    """Writes every (edge rows, node rows) batch from reader; each batch's stage also covers reading it.  With
+    commit=False the caller owns the transaction."""
+    rows = 0
+    t1 = time.perf_counter()
+    for b, (edge_values, node_values) in enumerate(reader):
+        with stage('extract_batch', rows=len(edge_values), con=conn, started=t1) as s:
+            s.set('batch', b)
+            s.set('batches', batches)
+            insert_rows(conn, 'edges', EDGE_COLS, edge_values)
+            insert_rows(conn, 'nodes', NODE_COLS, node_values)
+            if commit:
+                conn.commit()
+        rows += len(edge_values)
+        t1 = time.perf_counter()
+    return rows
+
+def _create_graph_tables(db_path):
+    conn = open_bulk_connection(db_path)
+    create_table(conn, 'edges', EDGE_COLS, EDGE_DTYPES)
+    create_table(conn, 'nodes', NODE_COLS, NODE_DTYPES)
+    conn.commit()
+    return conn
 
-def label_basins(db_path, order_thresh):
-    """ Selects root nodes at a certain order threshold and recursively labels all upstream nodes with the root node."""
+def extract_graph_stream(in_path, out_path, batch_size=100000, layer_name='HydroRIVERS_v10_na', use_arrow=True):
+    """Extracts edges and nodes in a single sequential read of the layer, writing both tables through one connection."""
 
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
-    root_query = sql_query = """
-        SELECT t1.hyriv_id
-        FROM edges t1
-        JOIN edges t2 ON t1.next_down = t2.hyriv_id
-        WHERE t1.ord_stra = ?
-          AND t2.ord_stra > ?;
+    # Load data
+    geodatabase, layer = _open_layer(in_path, layer_name)
+    batches = ceil(layer.GetFeatureCount() / batch_size)
+    reader = _batch_reader(layer, batch_size, use_arrow)
+
+    # Set up output, then query and export
+    conn = _create_graph_tables(out_path)
+    _write_batches(conn, reader, batches)
+    conn.create_indexes()
+    conn.close()
+
+def list_layers(in_path, prefix='HydroRIVERS'):
+    """Names of the layers in a geodatabase that start with prefix."""
+    from osgeo import ogr
+    geodatabase = ogr.GetDriverByName("OpenFileGDB").Open(in_path)
+    names = [geodatabase.GetLayerByIndex(i).GetName() for i in range(geodatabase.GetLayerCount())]
+    return [n for n in names if n.startswith(prefix)]
+
+def plan_shards(sources, shard_size=500000):
+    """Splits every (geodatabase, layer) source into contiguous FID ranges of about shard_size features.  Shards come
+    back in source order and then FID order, which is the order the serial path reads features in."""
+    shards = list()
+    for in_path, layer_name in sources:
+        geodatabase, layer = _open_layer(in_path, layer_name)
+        fid_col = layer.GetFIDColumn() or 'FID'
+        results = geodatabase.ExecuteSQL(f'SELECT MIN({fid_col}) AS lo, MAX({fid_col}) AS hi FROM {layer_name}')
+        lo, hi = [(r.GetField('lo'), r.GetField('hi')) for r in results][0]
+        geodatabase.ReleaseResultSet(results)
+        if lo is None:
+            continue
+        for start in range(lo, hi + 1, shard_size):
+            shards.append((in_path, layer_name, fid_col, start, min(start + shard_size, hi + 1)))
+    return shards
+
+def extract_shard(conn, shard, batch_size=100000, use_arrow=True):
+    """Reads one FID range from plan_shards into the edges and nodes tables on conn without committing, and returns
+    the number of reaches written."""
+    in_path, layer_name, fid_col, start, stop = shard
+    geodatabase, layer = _open_layer(in_path, layer_name)
+    layer.SetAttributeFilter(f'{fid_col} >= {start} AND {fid_col} < {stop}')
+    return _write_batches(conn, _batch_reader(layer, batch_size, use_arrow), commit=False)
+
+def _extract_shard(args):
+    """Worker: opens its own handle on the geodatabase and writes one FID range to its own SQLite file."""
+    shard, shard_path, batch_size, use_arrow = args
+    conn = _create_graph_tables(shard_path)
+    rows = extract_shard(conn, shard, batch_size, use_arrow)
+    conn.commit()
+    conn.close()
+    return shard_path, rows
+
+def merge_shards(shard_paths, out_path):
+    """Copies per-shard edges and nodes into out_path, in shard order, through a single writer."""
+    conn = _create_graph_tables(out_path)
+    with stage('merge_shards', con=conn) as s:
+        for shard_path in shard_paths:
+            conn.execute('ATTACH DATABASE ? AS shard', (shard_path,))
+            s.add_rows(conn.execute('INSERT INTO edges SELECT * FROM shard.edges ORDER BY HYRIV_ID').rowcount)
+            conn.execute('INSERT INTO nodes SELECT * FROM shard.nodes ORDER BY HYRIV_ID')
+            conn.commit()
+            conn.execute('DETACH DATABASE shard')
+        conn.create_indexes()
+    conn.close()
+
+def extract_graph_parallel(in_path, out_path, layer_names=None, workers=None, shard_size=500000, batch_size=100000, use_arrow=True):
+    """Extracts edges and nodes with one process per FID shard and merges them into one graph.db.
+
+    in_path may be a single geodatabase or a list of them (e.g. one per HydroRIVERS region).  layer_names defaults
+    to every HydroRIVERS layer in each.  The tables hold exactly the rows extract_graph_stream writes for the same
+    layers.
     """
-    cur.execute(sql_query, (order_thresh, order_thresh))
-    roots = [i[0] for i in cur.fetchall()]
-
-    root_query = '''
-    WITH RECURSIVE Upstream AS (
-        -- Anchor member: select initial rows to start the recursion
-        SELECT hyriv_id, next_down
-        FROM edges
-        WHERE next_down = {}
+    in_paths = [in_path] if isinstance(in_path, (str, os.PathLike)) else list(in_path)
+    sources = [(p, l) for p in in_paths for l in (layer_names or list_layers(p))]
+    shards = plan_shards(sources, shard_size)
+
+    # Shards are written next to the output so the merge does not cross filesystems
+    work_dir = tempfile.mkdtemp(prefix='shards_', dir=os.path.dirname(os.path.abspath(out_path)))
+    try:
+        jobs = [(shard, os.path.join(work_dir, f'shard_{i}.db'), batch_size, use_arrow) for i, shard in enumerate(shards)]
+        with stage('extract_shards') as s:
+            s.set('shards', len(jobs))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for shard_path, rows in pool.map(_extract_shard, jobs):
+                    s.add_rows(rows)
+        merge_shards([job[1] for job in jobs], out_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def label_basins(db_path, order_thresh, use_index=False):
+    """ Selects root nodes at a certain order threshold and recursively labels all upstream nodes with the root node.
+    With use_index, upstream reaches come from a range scan of the upstream index instead of a recursive query."""
+
+    if use_index and not has_upstream_index(db_path):
+        build_upstream_index(db_path)
+
+    con = connect(db_path)
+    cur = con.cursor()
+    with stage('label_basins', con=con) as s:
+        root_query = sql_query = """
+            SELECT t1.hyriv_id
+            FROM edges t1
+            JOIN edges t2 ON t1.next_down = t2.hyriv_id
+            WHERE t1.ord_stra = ?
+              AND t2.ord_stra > ?;
+        """
+        cur.execute(sql_query, (order_thresh, order_thresh))
+        roots = [i[0] for i in cur.fetchall()]
+        s.set('roots', len(roots))
+
+        root_query = '''
+        WITH RECURSIVE Upstream AS (
+            -- Anchor member: select initial rows to start the recursion
+            SELECT hyriv_id, next_down
+            FROM edges
+            WHERE next_down = ?
     
-        UNION ALL
+            UNION ALL
     
-        -- Recursive member: select rows that lead to the current nodes
-        SELECT c.hyriv_id, c.next_down
-        FROM edges c
-        JOIN Upstream u ON c.next_down = u.hyriv_id
-    )
-    -- Final query: hyriv_id all upstream connections leading to the root
-    SELECT DISTINCT hyriv_id
-    FROM Upstream;
-    '''        
-    counter = 0
-    cur.execute('ALTER TABLE nodes DROP basin')
-    cur.execute('ALTER TABLE nodes ADD basin INT DEFAULT -1')
-    for root_node in roots:
-        print(counter)
-        tmp_query = root_query.format(root_node)
-        res = cur.execute(tmp_query)
-        reaches = res.fetchall()
-        reaches = [i[0] for i in reaches]
-        cur.execute('UPDATE nodes SET basin = {} WHERE hyriv_id IN ({})'.format(root_node, ", ".join("?" * len(reaches))), reaches)
-        counter += 1
-    con.commit()
-    con.close()
+            -- Recursive member: select rows that lead to the current nodes
+            SELECT c.hyriv_id, c.next_down
+            FROM edges c
+            JOIN Upstream u ON c.next_down = u.hyriv_id
+        )
+        -- Final query: hyriv_id all upstream connections leading to the root
+        SELECT DISTINCT hyriv_id
+        FROM Upstream;
+        '''        
+        if use_index:
+            root_query = """
+            SELECT u.hyriv_id
+            FROM edges r
+            JOIN edges u ON u.tin > r.tin AND u.tin <= r.tout
+            WHERE r.hyriv_id = ?
+            """
+
+        counter = 0
+        con.reset_basin()
+        for root_node in roots:
+            res = cur.execute(root_query, (root_node,))
+            reaches = res.fetchall()
+            reaches = [i[0] for i in reaches]
+            cur.execute('UPDATE nodes SET basin = {} WHERE hyriv_id IN ({})'.format(root_node, ", ".join("?" * len(reaches))), reaches)
+            counter += 1
+            s.add_rows(len(reaches))
+        con.commit()
+        con.create_indexes()
 
 def label_basins_tree_search(db_path, order_thresh):
-    con = sqlite3.connect(db_path)
+    con = connect(db_path)
     cur = con.cursor()
-    root_query = sql_query = """
-        SELECT t1.hyriv_id
-        FROM edges t1
-        JOIN edges t2 ON t1.next_down = t2.hyriv_id
-        WHERE t1.ord_stra = ?
-          AND t2.ord_stra > ?;
-    """
-    cur.execute(sql_query, (order_thresh, order_thresh))
-    roots = [i[0] for i in cur.fetchall()]
+    with stage('label_basins', con=con) as s:
+        root_query = sql_query = """
+            SELECT t1.hyriv_id
+            FROM edges t1
+            JOIN edges t2 ON t1.next_down = t2.hyriv_id
+            WHERE t1.ord_stra = ?
+              AND t2.ord_stra > ?;
+        """
+        cur.execute(sql_query, (order_thresh, order_thresh))
+        roots = [i[0] for i in cur.fetchall()]
+        s.set('roots', len(roots))
 
-    counter = 0
-    try:
-        cur.execute('ALTER TABLE nodes ADD basin INT DEFAULT -1')
-    except (NameError, sqlite3.OperationalError):
-        cur.execute('ALTER TABLE nodes DROP basin')
-        cur.execute('ALTER TABLE nodes ADD basin INT DEFAULT -1')
-
-    for root_node in roots:
-        print(counter)
-        q = [root_node]
-        reaches = []
-        while q:
-            cur_node = q[-1]
-            q.pop()
-            reaches.append(cur_node)
-            cur.execute('SELECT hyriv_id FROM edges WHERE next_down = ?', (cur_node,))
-            q.extend([i[0] for i in cur.fetchall()])
-        cur.execute('UPDATE nodes SET basin = {} WHERE hyriv_id IN ({})'.format(root_node, ", ".join("?" * len(reaches))), reaches)
-        counter += 1
+        counter = 0
+        con.reset_basin()
+
+        for root_node in roots:
+            q = [root_node]
+            reaches = []
+            while q:
+                cur_node = q[-1]
+                q.pop()
+                reaches.append(cur_node)
+                cur.execute('SELECT hyriv_id FROM edges WHERE next_down = ?', (cur_node,))
+                q.extend([i[0] for i in cur.fetchall()])
+            cur.execute('UPDATE nodes SET basin = {} WHERE hyriv_id IN ({})'.format(root_node, ", ".join("?" * len(reaches))), reaches)
+            counter += 1
+            s.add_rows(len(reaches))
+        con.commit()
+        con.create_indexes()
+
+class BasinLabeler:
+    """Keeps hyriv_id, next_down and ord_stra in memory so basins can be labeled, and re-labeled, in one sweep each."""
+
+    def __init__(self, ids, next_down, order):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.next_down = np.asarray(next_down, dtype=np.int64)
+        self.order = np.asarray(order, dtype=np.float64)
+        self.topology = Topology(self.ids, self.next_down)
+
+    @classmethod
+    def from_db(cls, db_path):
+        con = connect(db_path)
+        watch(con)
+        rows = con.execute('SELECT hyriv_id, next_down, ord_stra FROM edges').fetchall()
+        ids, next_down, order = zip(*rows) if rows else ([], [], [])
+        order = [np.nan if o is None else o for o in order]
+        return cls(ids, next_down, order)
+
+    def find_roots(self, order_thresh):
+        """Reaches of order order_thresh that drain into a reach of higher order, as in label_basins."""
+        topo = self.topology
+        parent = topo.parent[:topo.n_edges]
+        has_down = parent < topo.n_edges
+        down_order = np.full(topo.n_edges, np.nan)
+        down_order[has_down] = self.order[parent[has_down]]
+        return np.flatnonzero((self.order == order_thresh) & (down_order > order_thresh))
+
+    def label(self, order_thresh):
+        """Returns the basin id of every reach (-1 if none): the root of the basin it lies strictly upstream of."""
+        topo = self.topology
+        n = len(topo.ids)
+        is_root = np.zeros(n, dtype=bool)
+        is_root[self.find_roots(order_thresh)] = True
+        basin = np.full(n, -1, dtype=np.int64)
+        for lvl in topo.levels[1:]:
+            par = topo.parent[lvl]
+            basin[lvl] = np.where(is_root[par], topo.ids[par], basin[par])
+        return basin[:topo.n_edges]
+
+    def write(self, db_path, basin):
+        """Replaces the basin column of the nodes table in one bulk update."""
+        con = connect(db_path)
+        watch(con)
+        cur = con.cursor()
+        con.reset_basin()
+        cur.execute('CREATE TEMP TABLE labels (hyriv_id INTEGER PRIMARY KEY, basin INTEGER)')
+        labeled = basin != -1
+        cur.executemany('INSERT INTO labels VALUES (?, ?)', zip(self.ids[labeled].tolist(), basin[labeled].tolist()))
+        cur.execute('UPDATE nodes SET basin = labels.basin FROM labels WHERE nodes.hyriv_id = labels.hyriv_id')
+        cur.execute('DROP TABLE labels')
+        con.commit()
+        con.create_indexes()
+
+def label_basins_fast(db_path, order_thresh, labeler=None):
+    """ Same labels as label_basins, from a single topological sweep over the edges held in memory.
+
+    Returns the BasinLabeler so the basins can be re-labeled at another order_thresh without re-reading the edges.
+    """
+    with stage('label_basins') as s:
+        if labeler is None:
+            labeler = BasinLabeler.from_db(db_path)
+        basin = labeler.label(order_thresh)
+        labeler.write(db_path, basin)
+        s.add_rows(int((basin != -1).sum()))
+    return labeler
+
+def prune_graph(db_path, use_index=False):
+    """ Removes all nodes and edges that are not part of a basin. With use_index, a reach is kept when it falls inside
+    the upstream interval of one of the basin roots.  Running it again on a pruned graph.db changes nothing. """
+
+    # Already pruned: the indexed query would find none of the (removed) roots and drop everything
+    con = connect(db_path)
+    if not con.execute('SELECT 1 FROM nodes WHERE basin = -1 LIMIT 1').fetchall():
+        return
+
+    if use_index and not has_upstream_index(db_path):
+        build_upstream_index(db_path)
+
+    with stage('prune_graph', con=con) as s:
+        # Both tables are rebuilt from the surviving reaches rather than deleted from row by row
+        if use_index:
+            keep = """
+            hyriv_id IN (
+                SELECT u.hyriv_id
+                FROM (SELECT DISTINCT basin FROM nodes WHERE basin != -1) b
+                JOIN edges r ON r.hyriv_id = b.basin
+                JOIN edges u ON u.tin > r.tin AND u.tin <= r.tout
+            )
+            """
+            removed = con.rebuild('edges', keep)
+            removed += con.rebuild('nodes', 'hyriv_id IN (SELECT hyriv_id FROM edges)')
+        else:
+            removed = con.rebuild('edges', 'hyriv_id NOT IN (SELECT hyriv_id FROM nodes WHERE basin = -1)')
+            removed += con.rebuild('nodes', 'basin IS NOT -1')
+        s.add_rows(removed)
+
+def build_upstream_index(db_path):
+    """ Stores DFS entry/exit numbers (tin, tout) on the edges table so that everything upstream of reach X is the
+    indexed range tin(X) < tin <= tout(X), and A is upstream of B when tin(B) < tin(A) <= tout(B). """
+
+    con = connect(db_path)
+    cur = con.cursor()
+    with stage('build_upstream_index', con=con) as s:
+        rows = cur.execute('SELECT hyriv_id, next_down FROM edges').fetchall()
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        next_down = np.array([r[1] for r in rows], dtype=np.int64)
+        topo = Topology(ids, next_down)
+        s.add_rows(len(ids))
+        tin, tout = topo.intervals()
+
+        columns = [i[1].lower() for i in cur.execute('PRAGMA table_info(edges)').fetchall()]
+        cur.execute('DROP INDEX IF EXISTS edges_tin')
+        for c in ['tin', 'tout']:
+            if c in columns:
+                cur.execute(f'ALTER TABLE edges DROP {c}')
+            cur.execute(f'ALTER TABLE edges ADD {c} INTEGER')
+        cur.execute('CREATE TEMP TABLE intervals (hyriv_id INTEGER PRIMARY KEY, tin INTEGER, tout INTEGER)')
+        cur.executemany('INSERT INTO intervals VALUES (?, ?, ?)', zip(ids.tolist(), tin[:topo.n_edges].tolist(), tout[:topo.n_edges].tolist()))
+        cur.execute('UPDATE edges SET tin = i.tin, tout = i.tout FROM intervals i WHERE edges.hyriv_id = i.hyriv_id')
+        cur.execute('DROP TABLE intervals')
+        cur.execute('CREATE INDEX edges_tin ON edges (tin)')
+        con.commit()
+    return topo
+
+def drop_upstream_index(db_path):
+    con = connect(db_path)
+    cur = con.cursor()
+    cur.execute('DROP INDEX IF EXISTS edges_tin')
+    columns = [i[1].lower() for i in cur.execute('PRAGMA table_info(edges)').fetchall()]
+    for c in ['tin', 'tout']:
+        if c in columns:
+            cur.execute(f'ALTER TABLE edges DROP {c}')
     con.commit()
-    con.close()
 
-def prune_graph(db_path):
-    """ Removes all nodes and edges that are not part of a basin. """
-
-    con = sqlite3.connect(db_path)
+def has_upstream_index(db_path):
+    con = connect(db_path)
+    columns = [i[1].lower() for i in con.execute('PRAGMA table_info(edges)').fetchall()]
+    return 'tin' in columns and 'tout' in columns
+
+def upstream_reaches(db_path, hyriv_id, include_self=False):
+    """ All reaches upstream of hyriv_id, from one range scan of the upstream index. """
+    con = connect(db_path)
+    lower = '>=' if include_self else '>'
+    sql_query = f"SELECT u.hyriv_id FROM edges r JOIN edges u ON u.tin {lower} r.tin AND u.tin <= r.tout WHERE r.hyriv_id = ?"
+    reaches = [i[0] for i in con.execute(sql_query, (hyriv_id,)).fetchall()]
+    return reaches
+
+def is_upstream(db_path, a, b):
+    """ True if reach a is upstream of reach b. """
+    con = connect(db_path)
+    intervals = dict(((i[0], i[1:]) for i in con.execute('SELECT hyriv_id, tin, tout FROM edges WHERE hyriv_id IN (?, ?)', (a, b)).fetchall()))
+    return intervals[b][0] < intervals[a][0] <= intervals[b][1]
+
+def read_edge_columns(db_path, columns):
+    """ hyriv_id, next_down and the given numeric edges columns as arrays (NULL becomes NaN). """
+    con = connect(db_path)
+    watch(con)
+    fields = ', '.join(['hyriv_id', 'next_down', *columns])
+    rows = con.execute(f'SELECT {fields} FROM edges').fetchall()
+    data = np.array(rows, dtype=np.float64).reshape(len(rows), len(columns) + 2)
+    return data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), {c: data[:, i + 2] for i, c in enumerate(columns)}
+
+def write_edge_columns(db_path, ids, columns):
+    """ Adds (or replaces) numeric columns on the edges table in one bulk update keyed by hyriv_id.  Integer arrays
+    become INTEGER columns, anything else FLOAT with NaN stored as NULL. """
+    con = connect(db_path)
+    watch(con)
     cur = con.cursor()
-    sql_query = "DELETE FROM edges WHERE hyriv_id IN (SELECT hyriv_id FROM nodes WHERE basin = -1)"
-    cur.execute(sql_query)
-    sql_query = "DELETE FROM nodes WHERE basin = -1"
-    cur.execute(sql_query)
+    existing = [i[1].lower() for i in cur.execute('PRAGMA table_info(edges)').fetchall()]
+    names = list(columns)
+    values = [np.asarray(columns[c]) for c in names]
+    dtypes = ['INTEGER' if np.issubdtype(v.dtype, np.integer) else 'FLOAT' for v in values]
+    for c, d in zip(names, dtypes):
+        if c.lower() not in existing:
+            cur.execute(f'ALTER TABLE edges ADD {c} {d}')
+    cur.execute('CREATE TEMP TABLE edge_values (hyriv_id INTEGER PRIMARY KEY, {})'.format(', '.join(f'{c} {d}' for c, d in zip(names, dtypes))))
+    values = [v.tolist() if d == 'INTEGER' else np.where(np.isnan(v), None, v).tolist() for v, d in zip(values, dtypes)]
+    cur.executemany('INSERT INTO edge_values VALUES ({})'.format(', '.join('?' * (len(names) + 1))), zip(np.asarray(ids).tolist(), *values))
+    assignments = ', '.join(f'{c} = v.{c}' for c in names)
+    cur.execute(f'UPDATE edges SET {assignments} FROM edge_values v WHERE edges.hyriv_id = v.hyriv_id')
+    cur.execute('DROP TABLE edge_values')
     con.commit()
-    con.close()
+
+def accumulate_upstream(db_path, columns, how='sum', write=False, prefix='up_'):
+    """ Upstream sums, maxima or minima of numeric edges columns for every reach in graph.db, each reach included,
+    from one bottom-up sweep over the whole table.  how is one method or {column: method}.  Returns {column: array}
+    aligned with the returned hyriv_ids; with write, also stores sums as prefix + column and maxima and minima as
+    prefix + method + '_' + column (up_max_length_km), so they never overwrite a total. """
+    with stage('accumulate_upstream') as s:
+        ids, next_down, values = read_edge_columns(db_path, list(columns))
+        topo = Topology(ids, next_down)
+        totals = {c: v[:topo.n_edges] for c, v in accumulate_columns(topo, values, how).items()}
+        s.add_rows(len(ids))
+        if write:
+            methods = how if isinstance(how, dict) else dict.fromkeys(totals, how)
+            write_edge_columns(db_path, ids, {prefix + ('' if methods[c] == 'sum' else methods[c] + '_') + c: v for c, v in totals.items()})
+    return ids, totals
+
+def upstream_totals(db_path, write=True):
+    """ Network totals that enforce_binary leaves stale, recomputed for every reach: upland_skm (synthetic reaches get
+    the drainage area of the tributaries they collect, every original reach keeps its own), upstream channel length
+    (up_length_km), reach count (up_reaches) and synthetic-reach count (up_synthetic).  Synthetic reaches are the ones
+    flagged in the synthetic column enforce_binary adds; without it every reach is original.  Returns hyriv_ids and
+    {column: array}. """
+    with stage('upstream_totals') as s:
+        flagged = 'synthetic' in connect(db_path).columns('edges')
+        ids, next_down, values = read_edge_columns(db_path, ['length_km', 'upland_skm'] + (['synthetic'] if flagged else []))
+        topo = Topology(ids, next_down)
+        synthetic = values['synthetic'] == 1 if flagged else np.zeros(len(ids), dtype=bool)
+        upland = values['upland_skm']
+        local_area = local_values(topo, np.where(np.isnan(upland), 0.0, upland), synthetic)
+        totals = accumulate_columns(topo, {
+            'upland_skm': local_area,
+            'up_length_km': values['length_km'],
+            'up_reaches': np.ones(len(ids)),
+            'up_synthetic': synthetic.astype(np.float64),
+        })
+        totals = {c: v[:topo.n_edges] for c, v in totals.items()}
+        for c in ['up_reaches', 'up_synthetic']:
+            totals[c] = totals[c].astype(np.int64)
+        s.add_rows(len(ids))
+        if write:
+            write_edge_columns(db_path, ids, totals)
+    return ids, totals
+
+def add_synthetic_flag(con):
+    """ Adds the synthetic flag column to edges, 0 for every reach already there, unless it exists. """
+    if 'synthetic' not in con.columns('edges'):
+        con.execute('ALTER TABLE edges ADD synthetic INTEGER DEFAULT 0')
+
+def insert_synthetic(cur, new_edges):
+    """ Inserts synthetic edge rows (EDGE_COLS) with their synthetic flag set. """
+    cur.executemany('INSERT INTO edges ({}, synthetic) VALUES ({}, 1)'.format(', '.join(EDGE_COLS), ', '.join('?' * len(EDGE_COLS))), new_edges)
 
 def enforcce_binary(db_path):
     """ Ensures that all nodes have at most two children.  Inserts artificial edges and nodes to enforce this. """
 
+    # Synthetic reaches change the intervals, so the upstream index is rebuilt afterwards
+    rebuild_index = has_upstream_index(db_path)
+    if rebuild_index:
+        drop_upstream_index(db_path)
+
     # SQL queries
     get_tribs = 'SELECT * FROM edges WHERE next_down = ?'
     bad_reach_query = 'SELECT t1.* FROM edges t1 JOIN (SELECT next_down, COUNT(*) AS count_next_down FROM edges GROUP BY next_down) t2 ON t1.hyriv_id = t2.next_down WHERE t2.count_next_down > 2;'
     max_id_query = 'SELECT max(hyriv_id) AS max FROM nodes'
-    delete_query = 'DELETE FROM edges WHERE hyriv_id in ({})'
 
     # Load DB
-    con = sqlite3.connect(db_path)
+    con = connect(db_path)
     cur = con.cursor()
+    with stage('enforce_binary', con=con) as s:
+        add_synthetic_flag(con)
 
-    # get max_id
-    cur.execute(max_id_query)
-    max_id = cur.fetchall()[0][0]
+        # get max_id
+        cur.execute(max_id_query)
+        max_id = cur.fetchall()[0][0]
 
-    # Process
-    cur.execute(bad_reach_query)
-    bad_reaches = cur.fetchall()
-    while len(bad_reaches) != 0:
-        print(f'Found {len(bad_reaches)} triple confluences')
-        counter = 0
-        for r in bad_reaches:
-            if counter % 100 == 0:
-                print(f' - Processed {counter}')
-            counter += 1
-            cur.execute('SELECT * FROM nodes WHERE hyriv_id = ?', (r[0],))
-            r_node = cur.fetchall()[0]
-            cur.execute(get_tribs, (r[0],))
-            tribs = cur.fetchall()
-            das = [i[3] for i in tribs]
-            tribs = [list(t) for d, t in sorted(zip(das, tribs))]
-
-            add_reaches = len(tribs) - 2
-            new_edges = list()
-            new_nodes = list()
-            parent = r[0]
-            for i in range(add_reaches):
-                max_id += 1
-                new_edges.append([max_id, parent, 0, r[3] - tribs[i][3], r[4]])  # This r[4] could be improved in the future
-                parent = max_id
-                new_nodes.append([max_id, r_node[1], r_node[2], r_node[3]])
-                tribs[i + 1][1] = max_id
-            tribs[-1][1] = max_id
-
-            combo_edges = [*tribs, *new_edges]
-
-            tmp_delete_query = delete_query.format(", ".join("?" * len(combo_edges)))
-            cur.execute(tmp_delete_query, [i[0] for i in combo_edges])
-            cur.executemany('INSERT INTO edges VALUES ({})'.format(", ".join("?" * len(combo_edges[0]))), combo_edges)
-            cur.executemany('INSERT INTO nodes VALUES ({})'.format(", ".join("?" * len(new_nodes[0]))), new_nodes)
-            con.commit()
+        # Process
         cur.execute(bad_reach_query)
         bad_reaches = cur.fetchall()
-    con.close()
+        while len(bad_reaches) != 0:
+            s.set('confluences', s.record.get('confluences', 0) + len(bad_reaches))
+            counter = 0
+            for r in bad_reaches:
+                counter += 1
+                cur.execute('SELECT * FROM nodes WHERE hyriv_id = ?', (r[0],))
+                r_node = cur.fetchall()[0]
+                cur.execute(get_tribs, (r[0],))
+                tribs = cur.fetchall()
+                das = [i[3] for i in tribs]
+                tribs = [list(t) for d, t in sorted(zip(das, tribs))]
+
+                add_reaches = len(tribs) - 2
+                new_edges = list()
+                new_nodes = list()
+                parent = r[0]
+                for i in range(add_reaches):
+                    max_id += 1
+                    s.add_rows(1)
+                    new_edges.append([max_id, parent, 0, r[3] - tribs[i][3], r[4]])  # This r[4] could be improved in the future
+                    parent = max_id
+                    new_nodes.append([max_id, r_node[1], r_node[2], r_node[3]])
+                    tribs[i + 1][1] = max_id
+                tribs[-1][1] = max_id
+
+                # Columns are named, since edges may have gained some (e.g. from write_edge_columns) since extraction
+                cur.executemany('UPDATE edges SET next_down = ? WHERE hyriv_id = ?', [(t[1], t[0]) for t in tribs])
+                insert_synthetic(cur, new_edges)
+                cur.executemany('INSERT INTO nodes VALUES ({})'.format(", ".join("?" * len(new_nodes[0]))), new_nodes)
+                con.commit()
+            cur.execute(bad_reach_query)
+            bad_reaches = cur.fetchall()
+    if rebuild_index:
+        build_upstream_index(db_path)
+
+def find_confluences(edges):
+    """ Topology of edge rows (hyriv_id, next_down, ...) and the positions of reaches with more than two tributaries,
+    in hyriv_id order. """
+    ids = np.array([e[0] for e in edges], dtype=np.int64)
+    topo = Topology(ids, np.array([e[1] for e in edges], dtype=np.int64))
+    counts = topo.n_children()[:topo.n_edges]
+    bad = np.flatnonzero(counts > 2)
+    return topo, bad[np.argsort(ids[bad])]
+
+def synthetic_reaches(edges, topo, bad, node_rows, max_id, basin_col=None):
+    """ The zero-length reaches enforcce_binary chains below every confluence in bad, numbered from max_id + 1.
+    Returns the new edge and node rows, the (next_down, hyriv_id) moves of the tributaries and the number of
+    synthetic reaches per basin. """
+    new_edges = list()
+    new_nodes = list()
+    moved = list()
+    created = dict()
+    for i in bad:
+        r = edges[i]
+        r_node = node_rows[r[0]]
+        tribs = sorted([(edges[c][3], edges[c]) for c in topo.children[topo.child_offsets[i]:topo.child_offsets[i + 1]]])
+        tribs = [list(t) for d, t in tribs]
+
+        parent = r[0]
+        for j in range(len(tribs) - 2):
+            max_id += 1
+            new_edges.append((max_id, parent, 0, r[3] - tribs[j][3], r[4]))  # This r[4] could be improved in the future
+            new_nodes.append((max_id, *r_node[1:]))
+            parent = max_id
+            moved.append((max_id, tribs[j + 1][0]))
+        moved.append((max_id, tribs[-1][0]))
+
+        basin = r_node[basin_col] if basin_col is not None else None
+        created[basin] = created.get(basin, 0) + len(tribs) - 2
+    return new_edges, new_nodes, moved, created
+
+def enforce_binary_fast(db_path):
+    """ Same rules as enforcce_binary, but every confluence is found from one in-memory child index and all synthetic
+    edges and nodes are written in a single transaction.  Returns the number of synthetic reaches created per basin. """
+
+    # Synthetic reaches change the intervals, so the upstream index is rebuilt afterwards
+    rebuild_index = has_upstream_index(db_path)
+    if rebuild_index:
+        drop_upstream_index(db_path)
 
+    # Load DB
+    con = connect(db_path)
+    cur = con.cursor()
+    with stage('enforce_binary', con=con) as s:
+        edges = cur.execute('SELECT * FROM edges').fetchall()
+        max_id = max(cur.execute('SELECT max(hyriv_id) FROM nodes').fetchall()[0][0] or 0, max([e[0] for e in edges], default=0))
+
+        # Find every reach with more than two tributaries
+        topo, bad = find_confluences(edges)
+        ids = topo.ids
+        s.set('confluences', len(bad))
+
+        cur.execute('CREATE TEMP TABLE bad_reaches (hyriv_id INTEGER PRIMARY KEY)')
+        cur.executemany('INSERT INTO bad_reaches VALUES (?)', [(i,) for i in ids[bad].tolist()])
+        node_rows = {r[0]: r for r in cur.execute('SELECT nodes.* FROM nodes JOIN bad_reaches ON nodes.hyriv_id = bad_reaches.hyriv_id').fetchall()}
+        cur.execute('DROP TABLE bad_reaches')
+        node_columns = [i[1].lower() for i in cur.execute('PRAGMA table_info(nodes)').fetchall()]
+        basin_col = node_columns.index('basin') if 'basin' in node_columns else None
+
+        # Build synthetic reaches
+        new_edges, new_nodes, moved, created = synthetic_reaches(edges, topo, bad, node_rows, max_id, basin_col)
+
+        # Apply
+        s.add_rows(len(new_edges))
+        add_synthetic_flag(con)
+        cur.executemany('UPDATE edges SET next_down = ? WHERE hyriv_id = ?', moved)
+        if new_edges:
+            insert_synthetic(cur, new_edges)
+            cur.executemany('INSERT INTO nodes VALUES ({})'.format(", ".join("?" * len(new_nodes[0]))), new_nodes)
+        con.commit()
+    if rebuild_index:
+        build_upstream_index(db_path)
+    return created
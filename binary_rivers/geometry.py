@@ -0,0 +1,306 @@
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088  # mean radius, for distances between lon/lat vertices
+
+# Bump whenever edge_metrics changes what it returns; cached metrics from another version are discarded
+METRIC_VERSION = 1
+
+
+def pack_geometries(geoms):
+    """Flattens (Multi)LineStrings into one coordinate array with per-geometry and per-part offsets."""
+    import shapely
+
+    geoms = np.asarray(geoms, dtype=object)
+    parts, part_index = shapely.get_parts(geoms, return_index=True)
+    coords, coord_index = shapely.get_coordinates(parts, return_index=True)
+
+    # Offsets into coords for every part, and offsets into parts for every geometry
+    part_counts = np.bincount(coord_index, minlength=len(parts))
+    part_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    np.cumsum(part_counts, out=part_offsets[1:])
+    geom_part_counts = np.bincount(part_index, minlength=len(geoms))
+    geom_parts = np.zeros(len(geoms) + 1, dtype=np.int64)
+    np.cumsum(geom_part_counts, out=geom_parts[1:])
+    offsets = part_offsets[geom_parts]
+    return coords, offsets, part_offsets
+
+
+def edge_metrics(coords, offsets, part_offsets=None):
+    """Computes length, chord, max deviation, curvature, meander and orientation for every packed geometry.
+
+    coords is an (n, 2) array, offsets has one more entry than there are geometries.  part_offsets marks the
+    boundaries of MultiLineString parts so that length is not measured across the gap between parts; the chord and
+    deviation use all coordinates of a geometry concatenated, as Segment always has.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if part_offsets is None:
+        part_offsets = offsets
+    part_offsets = np.asarray(part_offsets, dtype=np.int64)
+    n = len(offsets) - 1
+    x = coords[:, 0]
+    y = coords[:, 1]
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+
+    # Length: sum of vertex-to-vertex distances that do not cross a part boundary
+    step = np.hypot(np.diff(x), np.diff(y))
+    same_part = np.ones(len(step), dtype=bool)
+    same_part[part_offsets[1:-1] - 1] = False
+    step = np.where(same_part, step, 0)
+    length = np.zeros(n)
+    has_step = ends > starts  # summed per geometry, so a reach measures the same whatever it is batched with
+    if has_step.any():
+        length[has_step] = np.add.reduceat(step, starts[has_step])[:has_step.sum()]
+
+    # Chord between first and last vertex
+    dx = x[ends] - x[starts]
+    dy = y[ends] - y[starts]
+    vertical = dx == 0
+    slope = np.divide(dy, dx, out=np.full(n, 999999.0), where=~vertical)
+    intercept = y[starts] - (slope * x[starts])
+    d = (dx ** 2 + dy ** 2) ** 0.5
+    orientation = np.where(vertical, np.where(dy > 0, 90.0, -90.0), (np.arctan2(dy, dx) / np.pi) * 180)
+
+    # Max deviation of any vertex from the chord line
+    owner = np.repeat(np.arange(n), np.diff(offsets))
+    dist = np.abs(slope[owner] * x - y + intercept[owner]) / (slope[owner] ** 2 + 1) ** 0.5
+    a = np.maximum.reduceat(dist, starts) if len(dist) else np.zeros(n)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = a / d
+        h = d / 2
+        r = ((h ** 2) + (a ** 2)) / (2 * a)
+        alpha = np.where(np.abs(h - r) < 0.0001, np.pi / 2, np.arcsin(h / r))
+        arc_l = r * alpha
+        meander = np.where(a == 0, 0.0, (length - arc_l) / arc_l)
+
+    return {
+        'length': length,
+        'd': d,
+        'a': a,
+        'curvature': curvature,
+        'meander': meander,
+        'orientation': orientation,
+        'arc_l': np.where(a == 0, np.nan, arc_l),
+    }
+
+
+def _mix(h):
+    """splitmix64 finalizer over a uint64 array."""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+def geometry_hash(geoms):
+    """Order-sensitive 64 bit fingerprint of every geometry's coordinates and part count, as int64.  Reads the
+    coordinates once without splitting them into parts, which is far cheaper than computing the metrics."""
+    import shapely
+
+    geoms = np.asarray(geoms, dtype=object)
+    coords, index = shapely.get_coordinates(geoms, return_index=True)
+    counts = np.bincount(index, minlength=len(geoms))
+    return packed_hash(coords, counts, shapely.get_num_geometries(geoms))
+
+
+def packed_hash(coords, counts, n_parts):
+    """geometry_hash over packed coordinates: counts vertices and n_parts parts per geometry."""
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+    bits = np.ascontiguousarray(coords, dtype=np.float64).view(np.uint64)
+    position = (np.arange(len(coords), dtype=np.int64) - np.repeat(starts, counts)).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        h = _mix(_mix(bits[:, 0] ^ position) + bits[:, 1])
+        out = np.zeros(len(counts), dtype=np.uint64)
+        nonempty = counts > 0
+        if len(h):
+            out[nonempty] = np.add.reduceat(h, starts[nonempty])
+        out = _mix(out ^ counts.astype(np.uint64)) + np.asarray(n_parts).astype(np.uint64)
+    return out.view(np.int64)
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    """Great-circle distance in km between lon/lat points (degrees)."""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def end_tangents(coords, offsets, part_offsets=None, n_vertices=None, distance=None, distance_km=None):
+    """Direction (degrees, like orientation) in which every packed geometry leaves its first vertex ('head') and
+    arrives at its last vertex ('tail').
+
+    The tangent runs to the vertex n_vertices along the line, or to the point distance along it, without leaving the
+    first or last part.  distance is in coordinate units (for projected data); distance_km is in km along lon/lat
+    coordinates such as HydroRIVERS', measured with great-circle vertex steps.  With none of them, or where the
+    tangent has no length, the chord orientation is used.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if part_offsets is None:
+        part_offsets = offsets
+    part_offsets = np.asarray(part_offsets, dtype=np.int64)
+    x = coords[:, 0]
+    y = coords[:, 1]
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+    chord = np.degrees(np.arctan2(y[ends] - y[starts], x[ends] - x[starts]))
+
+    # First part ends and last part starts for every geometry
+    first_end = part_offsets[np.searchsorted(part_offsets, starts, side='right')] - 1
+    last_start = part_offsets[np.searchsorted(part_offsets, ends, side='right') - 1]
+
+    if n_vertices is not None:
+        hx, hy = x[np.minimum(starts + n_vertices, first_end)], y[np.minimum(starts + n_vertices, first_end)]
+        tx, ty = x[np.maximum(ends - n_vertices, last_start)], y[np.maximum(ends - n_vertices, last_start)]
+    elif distance is not None or distance_km is not None:
+        if distance_km is not None:
+            step = haversine_km(x[:-1], y[:-1], x[1:], y[1:])
+            distance = distance_km
+        else:
+            step = np.hypot(np.diff(x), np.diff(y))
+        cum = np.zeros(len(coords))
+        np.cumsum(step, out=cum[1:])
+        hx, hy = _point_along(x, y, cum, starts, first_end, cum[starts] + distance)
+        tx, ty = _point_along(x, y, cum, last_start, ends, cum[ends] - distance)
+    else:
+        return {'head': chord, 'tail': chord}
+
+    head = np.degrees(np.arctan2(hy - y[starts], hx - x[starts]))
+    tail = np.degrees(np.arctan2(y[ends] - ty, x[ends] - tx))
+    head = np.where((hx == x[starts]) & (hy == y[starts]), chord, head)
+    tail = np.where((tx == x[ends]) & (ty == y[ends]), chord, tail)
+    return {'head': head, 'tail': tail}
+
+
+def _point_along(x, y, cum, lo, hi, target):
+    """Interpolated point where the cumulative length reaches target, clamped to vertices lo .. hi."""
+    i = np.clip(np.searchsorted(cum, target, side='right') - 1, lo, np.maximum(hi - 1, lo))
+    j = np.minimum(i + 1, hi)
+    span = cum[j] - cum[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = np.clip(np.where(span > 0, (target - cum[i]) / span, 0), 0, 1)
+    return x[i] + f * (x[j] - x[i]), y[i] + f * (y[j] - y[i])
+
+
+# GeoPackage envelope sizes by the envelope indicator in the header flags
+_GPKG_ENVELOPE = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def _wkb_parts(buf, offset=0):
+    """x, y arrays of every LineString in a (Multi)LineString WKB (ISO or EWKB, any dimension) starting at offset."""
+    endian = '<' if buf[offset] == 1 else '>'
+    code = int.from_bytes(buf[offset + 1:offset + 5], 'little' if endian == '<' else 'big')
+    offset += 5
+    dims = 2 + bool(code & 0x80000000) + bool(code & 0x40000000)
+    if code & 0x20000000:  # EWKB SRID
+        offset += 4
+    code &= 0x0fffffff
+    dims += {0: 0, 1: 1, 2: 1, 3: 2}[code // 1000]
+    geom_type = code % 1000
+    if geom_type == 2:
+        n = int.from_bytes(buf[offset:offset + 4], 'little' if endian == '<' else 'big')
+        xy = np.frombuffer(buf, dtype=endian + 'f8', count=n * dims, offset=offset + 4).reshape(n, dims)[:, :2]
+        return [xy], offset + 4 + 8 * n * dims
+    if geom_type == 5:
+        n_parts = int.from_bytes(buf[offset:offset + 4], 'little' if endian == '<' else 'big')
+        offset += 4
+        parts = list()
+        for _ in range(n_parts):
+            part, offset = _wkb_parts(buf, offset)
+            parts.extend(part)
+        return parts, offset
+    raise ValueError(f'Unsupported WKB geometry type {geom_type}')
+
+
+def _gpkg_wkb_offset(blob):
+    """Where the WKB starts in a GeoPackage geometry blob (0 for plain WKB), or None for an empty geometry."""
+    if blob[:2] != b'GP':
+        return 0
+    flags = blob[3]
+    if flags & 0x10:
+        return None
+    return 8 + _GPKG_ENVELOPE[(flags >> 1) & 0x07]
+
+
+class CoordinateStore:
+    """Every reach's coordinates in one contiguous (n, 2) buffer, float64 or float32, with per-reach offsets and the
+    boundaries of MultiLineString parts; the layout pack_geometries produces.  Edge metrics, end tangents and cache
+    hashes are computed straight from the buffer, and shapely geometries are only built by geometries()."""
+
+    def __init__(self, coords, offsets, part_offsets=None, dtype=np.float64):
+        self.coords = np.ascontiguousarray(coords, dtype=dtype)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.part_offsets = self.offsets if part_offsets is None else np.asarray(part_offsets, dtype=np.int64)
+
+    @classmethod
+    def from_geometries(cls, geoms, dtype=np.float64):
+        return cls(*pack_geometries(geoms), dtype=dtype)
+
+    @classmethod
+    def from_wkb(cls, blobs, dtype=np.float64):
+        """Parses (Multi)LineString WKB, or GeoPackage geometry blobs, without building any geometry objects.  Empty
+        or missing geometries get no coordinates."""
+        parts = list()
+        geom_parts = np.zeros(len(blobs) + 1, dtype=np.int64)
+        for i, blob in enumerate(blobs):
+            start = None if blob is None else _gpkg_wkb_offset(blob)
+            if start is not None:
+                parts.extend(_wkb_parts(bytes(blob), start)[0])
+            geom_parts[i + 1] = len(parts)
+        part_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in parts], out=part_offsets[1:])
+        coords = np.concatenate(parts).astype(dtype) if parts else np.zeros((0, 2), dtype=dtype)
+        return cls(coords, part_offsets[geom_parts], part_offsets, dtype=dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return self.coords.nbytes + self.offsets.nbytes + (self.part_offsets.nbytes if self.part_offsets is not self.offsets else 0)
+
+    def n_parts(self):
+        return np.diff(np.searchsorted(self.part_offsets, self.offsets))
+
+    def take(self, rows):
+        """A new store holding only the given reaches, in the given order."""
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        coords = self.coords[np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)]
+
+        # Part boundaries move by the same shift as their reach's first coordinate
+        first = np.searchsorted(self.part_offsets, starts)
+        n_parts = np.searchsorted(self.part_offsets, starts + counts) - first
+        idx = np.arange(n_parts.sum()) + np.repeat(first - np.cumsum(n_parts) + n_parts, n_parts)
+        part_offsets = np.append(self.part_offsets[idx] - np.repeat(starts - offsets[:-1], n_parts), offsets[-1])
+        return CoordinateStore(coords, offsets, part_offsets, dtype=self.coords.dtype)
+
+    def edge_metrics(self):
+        return edge_metrics(self.coords, self.offsets, self.part_offsets)
+
+    def end_tangents(self, n_vertices=None, distance=None, distance_km=None):
+        return end_tangents(self.coords, self.offsets, self.part_offsets, n_vertices, distance, distance_km)
+
+    def hashes(self):
+        """geometry_hash of every reach, from the buffer."""
+        return packed_hash(self.coords, np.diff(self.offsets), self.n_parts())
+
+    def geometries(self, rows=None):
+        """Shapely (Multi)LineStrings for the given reaches (all by default); single-part reaches are LineStrings."""
+        import shapely
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        out = np.empty(len(rows), dtype=object)
+        for k, i in enumerate(rows.tolist()):
+            lo = np.searchsorted(self.part_offsets, self.offsets[i])
+            hi = np.searchsorted(self.part_offsets, self.offsets[i + 1])
+            lines = [self.coords[a:b].astype(np.float64) for a, b in zip(self.part_offsets[lo:hi], self.part_offsets[lo + 1:hi + 1])]
+            out[k] = shapely.LineString(lines[0]) if len(lines) == 1 else shapely.MultiLineString(lines)
+        return out
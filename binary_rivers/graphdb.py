@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+import threading
+import sqlite3
+import time
+import re
+import os
+
+
+PRAGMAS = {'temp_store': 'MEMORY', 'cache_size': -512000, 'mmap_size': 2 ** 30, 'synchronous': 'NORMAL'}
+BULK_PRAGMAS = {'journal_mode': 'MEMORY', 'synchronous': 'OFF'}
+DURABLE_PRAGMAS = {'journal_mode': 'DELETE', 'synchronous': PRAGMAS['synchronous']}  # what BULK_PRAGMAS replaced
+INDEXES = {
+    'edges_next_down': ('edges', 'next_down'),
+    'nodes_basin': ('nodes', 'basin'),
+}
+CACHED_STATEMENTS = 512
+
+_open = dict()
+
+
+class GraphDB(sqlite3.Connection):
+    """Connection to graph.db with the pragmas, indexes and table maintenance the preprocessing steps share.
+
+    Both tables are keyed by HYRIV_ID INTEGER PRIMARY KEY, so the key is the rowid and lookups by reach need no
+    separate index.  next_down and basin are indexed for tributary lookups and basin filters.  Open it through
+    connect() so every step works on the same connection (and its prepared statement cache) until close().
+    """
+
+    bulk = False
+
+    def set_pragmas(self, pragmas):
+        for k, v in pragmas.items():
+            self.execute(f'PRAGMA {k} = {v}')
+
+    def columns(self, table):
+        return [i[1].lower() for i in self.execute(f'PRAGMA table_info({table})').fetchall()]
+
+    def tables(self):
+        return {r[0] for r in self.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+
+    def create_indexes(self):
+        """Creates the next_down and basin indexes on whichever of those columns exist."""
+        tables = self.tables()
+        for name, (table, column) in INDEXES.items():
+            if table in tables and column in self.columns(table):
+                self.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})')
+        self.commit()
+
+    def reset_basin(self):
+        """Replaces the basin column of nodes with an empty one (every reach -1).  The basin index is dropped with
+        it; create_indexes puts it back once the new labels are written."""
+        self.execute('DROP INDEX IF EXISTS nodes_basin')
+        if 'basin' in self.columns('nodes'):
+            self.execute('ALTER TABLE nodes DROP basin')
+        self.execute('ALTER TABLE nodes ADD basin INT DEFAULT -1')
+
+    def rebuild(self, table, where, params=()):
+        """Keeps only the rows of table matching where by copying them into a fresh table with the same schema and
+        indexes, instead of deleting the rest row by row.  Commits, and returns the number of rows dropped."""
+        sql = self.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchall()[0][0]
+        indexes = [r[0] for r in self.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall()]
+        before = self.execute(f'SELECT COUNT(*) FROM {table}').fetchall()[0][0]
+        new_sql = re.sub(rf'^CREATE TABLE\s+(["`]?){table}\1', f'CREATE TABLE {table}_new', sql, count=1, flags=re.IGNORECASE)
+        self.execute(f'DROP TABLE IF EXISTS {table}_new')
+        self.execute(new_sql)
+        after = self.execute(f'INSERT INTO {table}_new SELECT * FROM {table} WHERE {where}', params).rowcount
+        self.execute(f'DROP TABLE {table}')
+        self.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        for index_sql in indexes:
+            self.execute(index_sql)
+        self.commit()
+        return before - after
+
+    def optimize(self):
+        """ANALYZE and VACUUM, for the end of preprocessing."""
+        self.commit()
+        self.execute('ANALYZE')
+        self.execute('VACUUM')
+
+    def close(self):
+        for k, v in list(_open.items()):
+            if v is self:
+                del _open[k]
+        super().close()
+
+
+def _key(db_path):
+    # sqlite3 connections survive neither a fork nor a hop to another thread, so each process and thread gets its own
+    return os.path.abspath(db_path), os.getpid(), threading.get_ident()
+
+
+def connect(db_path, bulk=False):
+    """The shared GraphDB for db_path in this process and thread, opened on first use.  bulk switches it to an
+    in-memory journal with no syncs, which is only safe for a file that is rebuilt from scratch if the process dies.
+    The next plain connect() switches it back, as soon as no transaction is open."""
+    key = _key(db_path)
+    con = _open.get(key)
+    if con is None:
+        con = sqlite3.connect(db_path, factory=GraphDB, cached_statements=CACHED_STATEMENTS)
+        con.set_pragmas(PRAGMAS)
+        _open[key] = con
+    if bulk and not con.bulk:
+        con.set_pragmas(BULK_PRAGMAS)
+        con.bulk = True
+    elif not bulk and con.bulk and not con.in_transaction:
+        con.set_pragmas(DURABLE_PRAGMAS)
+        con.bulk = False
+    return con
+
+
+def close(db_path):
+    """Closes the shared connection to db_path, if there is one."""
+    con = _open.get(_key(db_path))
+    if con is not None:
+        con.close()
+
+
+@contextmanager
+def session(db_path, bulk=False):
+    """Scopes the shared connection to a with block: every step inside works on one connection, which is closed on
+    the way out unless it was already open before the block."""
+    owner = _key(db_path) not in _open
+    try:
+        yield connect(db_path, bulk)
+    finally:
+        if owner:
+            close(db_path)
+
+
+def finalize(db_path):
+    """Refreshes the planner statistics and compacts graph.db, then closes it."""
+    con = connect(db_path)
+    con.create_indexes()
+    con.optimize()
+    con.close()
+
+
+def mark_dirty(con, statuses):
+    """Records basins whose reaches changed ({basin: 'new' | 'changed' | 'removed'}) for downstream metric jobs."""
+    con.execute('CREATE TABLE IF NOT EXISTS dirty_basins (basin INTEGER PRIMARY KEY, status TEXT, marked REAL)')
+    now = time.time()
+    con.executemany('INSERT OR REPLACE INTO dirty_basins VALUES (?, ?, ?)', [(int(b), s, now) for b, s in statuses.items()])
+
+
+def dirty_basins(db_path):
+    """{basin: status} for every basin marked dirty and not cleared since."""
+    con = connect(db_path)
+    if 'dirty_basins' not in con.tables():
+        return {}
+    return dict(con.execute('SELECT basin, status FROM dirty_basins').fetchall())
+
+
+def clear_dirty(db_path, basins=None):
+    """Clears the given basins (all by default) once their metrics have been recomputed."""
+    con = connect(db_path)
+    if 'dirty_basins' not in con.tables():
+        return
+    if basins is None:
+        con.execute('DELETE FROM dirty_basins')
+    else:
+        con.executemany('DELETE FROM dirty_basins WHERE basin = ?', [(int(b),) for b in basins])
+    con.commit()
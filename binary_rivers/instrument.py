@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+import tracemalloc
+import cProfile
+import logging
+import pstats
+import json
+import time
+import sys
+import io
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _peak_rss_mb():
+    """High-water resident memory of the whole process so far.  ru_maxrss is in bytes on macOS and KiB elsewhere."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 1024)
+
+
+class StageHandle:
+    """What a running stage can report about itself: rows processed, extra values and SQLite connections to watch."""
+
+    def __init__(self, instrumentation, record):
+        self.instrumentation = instrumentation
+        self.record = record
+
+    def add_rows(self, n):
+        self.record['rows'] = (self.record['rows'] or 0) + n
+
+    def set(self, key, value):
+        self.record[key] = value
+
+    def watch(self, con):
+        """Counts every statement run on con towards all stages that are open at the time."""
+        if self.instrumentation.count_sql:
+            con.set_trace_callback(self.instrumentation._count_sql)
+
+
+class Instrumentation:
+    """Records wall time, rows processed, SQL statements issued and peak memory for each stage and passes every
+    finished record to the callbacks.  Stages named in profile are also run under cProfile and tracemalloc.
+
+    peak_rss_mb is the process-wide high-water mark when the stage ended, so it includes whatever ran before; the
+    stage's own share is rss_growth_mb, how far it raised that mark (0 when it stayed below an earlier peak)."""
+
+    def __init__(self, callbacks=None, profile=None, keep_records=True, count_sql=True, profile_limit=25):
+        self.callbacks = list(callbacks or [])
+        self.count_sql = count_sql
+        self.profile = {profile} if isinstance(profile, str) else set(profile or [])
+        self.keep_records = keep_records
+        self.profile_limit = profile_limit
+        self.records = list()
+        self._stack = list()
+
+    def _count_sql(self, statement):
+        for record in self._stack:
+            record['sql_statements'] += 1
+
+    @contextmanager
+    def stage(self, name, rows=None, con=None, started=None):
+        path = '/'.join([r['name'] for r in self._stack] + [name])
+        record = {'name': name, 'stage': path, 'rows': rows, 'sql_statements': 0}
+        handle = StageHandle(self, record)
+        if con is not None:
+            handle.watch(con)
+
+        profiler = None
+        if name in self.profile or path in self.profile:
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            profiler.enable()
+
+        self._stack.append(record)
+        rss_before = _peak_rss_mb()
+        t1 = time.perf_counter() if started is None else started
+        try:
+            yield handle
+        finally:
+            record['seconds'] = time.perf_counter() - t1
+            self._stack.pop()
+            if profiler is not None:
+                profiler.disable()
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(self.profile_limit)
+                record['profile'] = out.getvalue()
+            record['peak_rss_mb'] = _peak_rss_mb()
+            record['rss_growth_mb'] = None if rss_before is None else record['peak_rss_mb'] - rss_before
+            if self.keep_records:
+                self.records.append(record)
+            for callback in self.callbacks:
+                callback(record)
+
+    def summary(self):
+        """Totals per stage path: calls, seconds, rows and SQL statements, plus the highest peak memory and the most any
+        one call raised it."""
+        out = dict()
+        for r in self.records:
+            s = out.setdefault(r['stage'], {'calls': 0, 'seconds': 0.0, 'rows': 0, 'sql_statements': 0, 'peak_rss_mb': None, 'rss_growth_mb': None})
+            s['calls'] += 1
+            s['seconds'] += r['seconds']
+            s['rows'] += r['rows'] or 0
+            s['sql_statements'] += r['sql_statements']
+            if r['peak_rss_mb'] is not None:
+                s['peak_rss_mb'] = max(s['peak_rss_mb'] or 0, r['peak_rss_mb'])
+                s['rss_growth_mb'] = max(s['rss_growth_mb'] or 0, r['rss_growth_mb'])
+        return out
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'records': self.records}, f, indent=2, default=str)
+
+
+class PrintLogger:
+    """Prints one line per finished stage."""
+
+    def __call__(self, record):
+        rows = f' ({record["rows"]} rows)' if record['rows'] is not None else ''
+        print(f'{record["stage"]}{rows} finished in {round(record["seconds"], 3)} seconds')
+
+
+class LoggingCallback:
+    """Sends finished stages to a logging.Logger."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('binary_rivers')
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, '%s finished in %.3f seconds (rows=%s, sql=%s)', record['stage'], record['seconds'], record['rows'], record['sql_statements'])
+
+
+# Silent default: nothing is kept, printed or traced
+_instrumentation = Instrumentation(keep_records=False, count_sql=False)
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation):
+    """Installs instrumentation for all stages and returns the previous one."""
+    global _instrumentation
+    previous = _instrumentation
+    _instrumentation = instrumentation
+    return previous
+
+
+def stage(name, rows=None, con=None, started=None):
+    return _instrumentation.stage(name, rows=rows, con=con, started=started)
+
+
+def watch(con):
+    """Counts statements run on con towards whichever stages are open when they run."""
+    if _instrumentation.count_sql:
+        con.set_trace_callback(_instrumentation._count_sql)
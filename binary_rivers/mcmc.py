@@ -0,0 +1,257 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import math
+import csv
+import os
+from .topology import Topology
+
+
+STATISTICS = ['height', 'ave_depth', 'cum_depth', 'ave_balance', 'compactness']
+
+
+class MutableTree:
+    """Full, ordered binary tree held in plain lists so single moves stay cheap.
+
+    Every node keeps the same quantities tree_metrics computes: depth (height above the deepest leaf), leaves,
+    cum_depth and balance_factor (depth of the first child minus depth of the second).  A move only refreshes the
+    nodes on the paths from where it cut and where it grafted up to the root.
+    """
+
+    def __init__(self, parent, left, right):
+        self.parent = list(parent)
+        self.left = list(left)
+        self.right = list(right)
+        self.n = len(self.parent)
+        roots = [i for i in range(self.n) if self.parent[i] == -1]
+        if len(roots) != 1:
+            raise ValueError('Multiple roots found')
+        self.root = roots[0]
+        self.depth = [0] * self.n
+        self.leaves = [1] * self.n
+        self.cum_depth = [0] * self.n
+        self.balance_factor = [0] * self.n
+        self._balance_sum = 0
+
+        # Children before parents
+        order = [self.root]
+        for v in order:
+            if self.left[v] != -1:
+                order.append(self.left[v])
+                order.append(self.right[v])
+        if len(order) != self.n:
+            raise ValueError('Cycle found in network')
+        for v in reversed(order):
+            self._refresh(v)
+
+    @classmethod
+    def from_arrays(cls, ids, next_down, priority=None):
+        """Builds the tree from reach ids and downstream ids, ordering children the way Network does.  Every reach
+        must have zero or two tributaries."""
+        topo = Topology(ids, next_down, priority=priority)
+        n = topo.n_edges
+        counts = topo.n_children()[:n]
+        if np.any((counts != 0) & (counts != 2)):
+            raise ValueError('Tree is not binary')
+        parent = np.where(topo.parent[:n] < n, topo.parent[:n], -1)
+        left = topo.first_child(np.arange(n), 0)
+        right = topo.first_child(np.arange(n), 1)
+        return cls(parent.tolist(), left.tolist(), right.tolist())
+
+    @classmethod
+    def random(cls, n_leaves, seed=0):
+        from .synthetic import random_tree
+        return cls.from_arrays(*random_tree(n_leaves, seed))
+
+    def to_arrays(self):
+        """Reach ids 1..n and downstream ids (0 below the root).  Ids follow a preorder walk, so rows come in that order
+        and every first child has a lower id (and row) than its sibling; Topology and from_arrays keep that order."""
+        # Second child pushed first so the first child is visited first
+        preorder = list()
+        stack = [self.root]
+        while stack:
+            v = stack.pop()
+            preorder.append(v)
+            if self.left[v] != -1:
+                stack.append(self.right[v])
+                stack.append(self.left[v])
+        new_id = np.zeros(self.n + 1, dtype=np.int64)  # last slot maps the root's parent (-1) to 0
+        new_id[np.array(preorder)] = np.arange(1, self.n + 1)
+        parent = np.array([self.parent[v] for v in preorder], dtype=np.int64)
+        ids = np.arange(1, self.n + 1, dtype=np.int64)
+        next_down = new_id[parent]
+        return ids, next_down
+
+    def _refresh(self, v):
+        l = self.left[v]
+        r = self.right[v]
+        self._balance_sum -= self.balance_factor[v]
+        if l == -1:
+            self.depth[v] = 0
+            self.leaves[v] = 1
+            self.cum_depth[v] = 0
+            self.balance_factor[v] = 0
+        else:
+            self.depth[v] = max(self.depth[l], self.depth[r]) + 1
+            self.leaves[v] = self.leaves[l] + self.leaves[r]
+            self.cum_depth[v] = self.cum_depth[l] + self.cum_depth[r] + self.leaves[v]
+            self.balance_factor[v] = self.depth[l] - self.depth[r]
+        self._balance_sum += self.balance_factor[v]
+
+    def _update_path(self, v):
+        while v != -1:
+            self._refresh(v)
+            v = self.parent[v]
+
+    def _replace_child(self, parent, old, new):
+        if parent == -1:
+            self.root = new
+        elif self.left[parent] == old:
+            self.left[parent] = new
+        else:
+            self.right[parent] = new
+        self.parent[new] = parent
+
+    def is_ancestor(self, a, b):
+        """True when a is b or lies on the path from b to the root."""
+        while b != -1:
+            if b == a:
+                return True
+            b = self.parent[b]
+        return False
+
+    def sibling(self, v):
+        p = self.parent[v]
+        return self.right[p] if self.left[p] == v else self.left[p]
+
+    def swap_children(self, v):
+        """Sibling swap: reverses the order of v's two children.  Only v's balance_factor changes."""
+        self.left[v], self.right[v] = self.right[v], self.left[v]
+        self._refresh(v)
+
+    def prune_regraft(self, s, t, s_first=True):
+        """Cuts the subtree rooted at s together with its parent p, closes the gap (s's sibling takes p's place) and
+        grafts p back onto the edge above t, with s as its first or second child.  t must not be p or lie in the
+        subtree of s.  Returns the arguments that undo the move."""
+        p = self.parent[s]
+        q = self.sibling(s)
+        undo = (s, q, self.left[p] == s)
+
+        # Prune
+        g = self.parent[p]
+        self._replace_child(g, p, q)
+
+        # Regraft
+        self._replace_child(self.parent[t], t, p)
+        self.parent[t] = p
+        self.parent[s] = p
+        self.left[p], self.right[p] = (s, t) if s_first else (t, s)
+
+        # p's path first: when p ends up below g, g's path then sees p's new values
+        self._update_path(p)
+        if g != -1:
+            self._update_path(g)
+        return undo
+
+    def statistics(self):
+        """Root-level topology statistics; ave_balance averages balance_factor over every node, leaves included."""
+        leaves = self.leaves[self.root]
+        return {
+            'height': self.depth[self.root],
+            'ave_depth': self.cum_depth[self.root] / leaves,
+            'cum_depth': self.cum_depth[self.root],
+            'ave_balance': self._balance_sum / self.n,
+            'compactness': self.depth[self.root] / leaves,
+        }
+
+
+class Sampler:
+    """Metropolis-Hastings over ordered binary trees with a fixed number of leaves.
+
+    Proposals are a sibling swap (with probability swap_prob) or a subtree prune-and-regraft onto a uniformly chosen
+    edge; both are symmetric.  With beta = 0 every topologically distinct channel network is equally likely (the
+    random topology model); otherwise the target weighs a tree by exp(-beta * statistic).
+    """
+
+    def __init__(self, tree, seed=0, beta=0.0, statistic='ave_depth', swap_prob=0.1):
+        self.tree = tree
+        self.rng = np.random.default_rng(seed)
+        self.beta = beta
+        self.statistic = statistic
+        self.swap_prob = swap_prob
+        self.internal = [v for v in range(tree.n) if tree.left[v] != -1]
+        self.accepted = 0
+        self.proposed = 0
+        self._current = tree.statistics()[statistic]
+
+    def _propose(self):
+        tree = self.tree
+        if self.rng.random() < self.swap_prob:
+            v = self.internal[int(self.rng.integers(len(self.internal)))]
+            tree.swap_children(v)
+            return lambda: tree.swap_children(v)
+
+        # Regraft targets are every node outside the pruned subtree other than its parent
+        while True:
+            s = int(self.rng.integers(tree.n))
+            if s != tree.root:
+                break
+        p = tree.parent[s]
+        while True:
+            t = int(self.rng.integers(tree.n))
+            if t != p and not tree.is_ancestor(s, t):
+                break
+        undo = tree.prune_regraft(s, t, bool(self.rng.random() < 0.5))
+        return lambda: tree.prune_regraft(*undo)
+
+    def step(self):
+        self.proposed += 1
+        undo = self._propose()
+        proposed = self.tree.statistics()[self.statistic]
+        log_alpha = -self.beta * (proposed - self._current)
+        if log_alpha >= 0 or self.rng.random() < math.exp(log_alpha):
+            self._current = proposed
+            self.accepted += 1
+            return True
+        undo()
+        return False
+
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else float('nan')
+
+
+def run_chain(n_leaves, n_steps, out_path, seed=0, thin=100, burn_in=0, beta=0.0, statistic='ave_depth', swap_prob=0.1, flush_every=1000):
+    """Runs one seeded chain from a random tree and streams the statistics of every thin-th state after burn_in to a
+    CSV file.  Returns the acceptance rate."""
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seeds = seed.spawn(2)
+    tree = MutableTree.random(n_leaves, seed=seeds[0])
+    sampler = Sampler(tree, seed=seeds[1], beta=beta, statistic=statistic, swap_prob=swap_prob)
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['step'] + STATISTICS)
+        rows = list()
+        for i in range(1, n_steps + 1):
+            sampler.step()
+            if i > burn_in and i % thin == 0:
+                stats = tree.statistics()
+                rows.append([i] + [stats[s] for s in STATISTICS])
+            if len(rows) >= flush_every:
+                writer.writerows(rows)
+                f.flush()
+                rows = list()
+        writer.writerows(rows)
+    return sampler.acceptance_rate()
+
+
+def _run_chain(args):
+    return run_chain(*args[:3], **args[3])
+
+
+def run_chains(n_chains, n_leaves, n_steps, out_dir, seed=0, workers=None, **kwargs):
+    """Runs independent chains in parallel, one CSV per chain (chain_0.csv, ...) in out_dir.  Chain seeds are spawned
+    from seed, so the whole run is reproducible.  Returns each chain's acceptance rate."""
+    os.makedirs(out_dir, exist_ok=True)
+    seeds = np.random.SeedSequence(seed).spawn(n_chains)
+    jobs = [(n_leaves, n_steps, os.path.join(out_dir, f'chain_{i}.csv'), dict(kwargs, seed=s)) for i, s in enumerate(seeds)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_run_chain, jobs))
@@ -1,103 +1,321 @@
-import geopandas as gpd
 import pandas as pd
 import numpy as np
-import queue
-from scipy.stats import circmean, circstd
+import warnings
+from .geometry import CoordinateStore
+from .topology import Topology, tree_metrics, trunk, junction_angles
+from .instrument import stage
 
 class Segment:
+    """Per-feature view of the batched edge metrics in binary_rivers.geometry."""
 
     def __init__(self, geom):
         self.geom = geom
-        self.length = geom.length
-
-        tmp_coords = []
-        if geom.geom_type == 'MultiLineString':
-            for line in geom.geoms:
-                tmp_coords.extend(line.coords)
-        else:
-            tmp_coords = geom.coords
-        self.coords = tmp_coords
-        self.first = self.coords[0]
-        self.last = self.coords[-1]
-
-        dy = (self.last[1] - self.first[1])
-        dx = (self.last[0] - self.first[0])
-        tmp_slope = dy / dx if dx != 0 else 999999
-    
-        tmp_intercept = self.first[1] - (tmp_slope * self.first[0])
-        self.d = ((self.last[0] - self.first[0]) ** 2 + (self.last[1] - self.first[1]) ** 2) ** 0.5
-
-        if dx == 0:
-            if dy > 0:
-                self.orientation = 90
-            else:
-                self.orientation = -90
-        else:
-            self.orientation = (np.arctan2(np.array([dy]), np.array([dx])) / np.pi) * 180
-
-        tmp_dist = 0
-        for coord in self.coords:
-            tmp_dist = max(tmp_dist, abs(tmp_slope * coord[0] - coord[1] + tmp_intercept) / (tmp_slope ** 2 + 1) ** 0.5)
-        self.a = tmp_dist
+        self.store = CoordinateStore.from_geometries([geom])
+        self.first = tuple(self.store.coords[0].tolist())
+        self.last = tuple(self.store.coords[-1].tolist())
+
+        metrics = self.store.edge_metrics()
+        self.length = metrics['length'][0]
+        self.d = metrics['d'][0]
+        self.a = metrics['a'][0]
+        self.orientation = metrics['orientation'][0]
+        self._curvature = metrics['curvature'][0]
+        self._meander = metrics['meander'][0]
+        self._arc_l = metrics['arc_l'][0]
 
         self.arc_l = None
 
+    @property
+    def coords(self):
+        """Every vertex, all parts concatenated, as a list of tuples."""
+        return list(map(tuple, self.store.coords.tolist()))
 
     def curvature(self):
-        return self.a / self.d
+        return self._curvature
     
 
     def meander(self):
-        if self.a == 0:
-            return 0
-        h = self.d / 2
-        r = ((h ** 2) + (self.a ** 2)) / (2 * self.a)
-        if abs(h - r) < 0.0001:
-            alpha = np.pi / 2  # just kinda estimating by looking at the asymptote of arcsin on wolframalpha
-        else:
-            alpha = np.arcsin(h / r)
-        
-        self.arc_l = r * alpha
-        return (self.length - self.arc_l) / self.arc_l
+        if self.a != 0:
+            self.arc_l = self._arc_l
+        return self._meander
     
 
+METRIC_FAMILIES = ('edges', 'orientation', 'exterior', 'order', 'trunk', 'junctions', 'topology', 'density', 'bifurcation')
+
+
+def _group_stats(labels, n_groups, values):
+    """Mean and sample std of each column of values for every group label (labels < 0 are skipped), ignoring NaN."""
+    means = np.full((n_groups, values.shape[1]), np.nan)
+    stds = np.full((n_groups, values.shape[1]), np.nan)
+    for j in range(values.shape[1]):
+        v = values[:, j]
+        ok = (labels >= 0) & ~np.isnan(v)
+        g = labels[ok]
+        x = v[ok]
+        count = np.bincount(g, minlength=n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.bincount(g, x, minlength=n_groups) / count
+            ss = np.bincount(g, (x - mean[g]) ** 2, minlength=n_groups)
+            std = np.sqrt(ss / (count - 1))
+        means[:, j] = np.where(count > 0, mean, np.nan)
+        stds[:, j] = np.where(count > 1, std, np.nan)
+    return means, stds
+
+
+def reach_edge_metrics(coords, ids, edge_cache=None):
+    """Edge metrics of every reach in a CoordinateStore, taking whatever it can from edge_cache and computing the rest
+    in bulk."""
+    if edge_cache is None:
+        return coords.edge_metrics()
+
+    # Only reaches missing from the cache (or whose geometry changed) are measured
+    hashes = coords.hashes()
+    hit, metrics = edge_cache.get(ids, hashes)
+    miss = np.flatnonzero(~hit)
+    if len(miss):
+        computed = coords.take(miss).edge_metrics()
+        edge_cache.put(ids[miss], hashes[miss], computed)
+        for c in metrics:
+            metrics[c][miss] = computed[c]
+    return metrics
+
+
+NETWORK_COLUMNS = ['length', 'curvature', 'meander', 'orientation', 'leaves', 'tja', 'ORD_STRA', 'trunk', 'depth', 'balance_factor', 'ave_depth']
+
+
+def network_metrics(columns, root_loc, da, families=None):
+    """Network-level metrics of one tree from its per-row columns (edges plus the virtual root row at root_loc):
+    length, curvature, meander, orientation, leaves, tja, ORD_STRA, trunk, depth, balance_factor and ave_depth."""
+    if families is None:
+        families = METRIC_FAMILIES
+    unknown = set(families) - set(METRIC_FAMILIES)
+    if unknown:
+        raise ValueError(f'Unknown metric families: {sorted(unknown)}')
+    out_dict = dict()
+
+    # Pull every column once
+    shape_names = ['length', 'curvature', 'meander']
+    shape = np.column_stack([np.asarray(columns[c], dtype=np.float64) for c in shape_names])
+    leaves = np.asarray(columns['leaves'], dtype=np.float64)
+    tja = np.asarray(columns['tja'], dtype=np.float64)
+    order = np.asarray(columns['ORD_STRA'])
+    exterior_mask = (leaves > 1)
+    interior_mask = (leaves == 1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        if 'edges' in families:
+            for j, c in enumerate(shape_names):
+                out_dict[f'ave_{c}'] = np.nanmean(shape[:, j])
+                out_dict[f'med_{c}'] = np.nanmedian(shape[:, j])
+                out_dict[f'std_{c}'] = np.nanstd(shape[:, j], ddof=1)
+
+        if 'orientation' in families:
+            from scipy.stats import circmean, circstd
+            orientations = np.asarray(columns['orientation'], dtype=np.float64)
+            orientations = orientations[~np.isnan(orientations)]
+            out_dict['ave_orientation'] = circmean(orientations, low=-180, high=180)
+            out_dict['std_orientation'] = circstd(orientations, low=-180, high=180)
+
+        if 'exterior' in families:
+            labels = np.where(exterior_mask, 0, np.where(interior_mask, 1, -1))
+            means, stds = _group_stats(labels, 2, shape)
+            for stat, values, groups in [('mean', means, [(0, 'ext'), (1, 'int')]), ('std', stds, [(0, 'ext'), (1, 'int')])]:
+                for g, name in groups:
+                    for j, c in enumerate(shape_names):
+                        out_dict[f'{stat}_{c}_{name}'] = values[g, j]
+
+        if 'order' in families:
+            present, first = np.unique(order, return_index=True)
+            present = present[np.argsort(first)]
+            present = [i for i in present if not np.isnan(i)]
+            labels = np.full(len(order), -1)
+            for g, i in enumerate(present):
+                labels[order == i] = g
+            means, _ = _group_stats(labels, len(present), shape)
+            for g, i in enumerate(present):
+                for j, c in enumerate(shape_names):
+                    out_dict[f'mean_{c}_ord_{i}'] = means[g, j]
+
+        if 'trunk' in families:
+            labels = np.where(np.asarray(columns['trunk']) == 1, 0, -1)
+            means, _ = _group_stats(labels, 1, shape)
+            for j, c in enumerate(shape_names):
+                out_dict[f'mean_{c}_trunk'] = means[0, j]
+
+        if 'junctions' in families:
+            has_tja = ~np.isnan(tja)
+            tjas = tja[has_tja]
+            out_dict['ave_tja'] = np.nanmean(tjas)
+            out_dict['med_tja'] = np.nanmedian(tjas)
+            out_dict['std_tja'] = np.nanstd(tjas, ddof=1)
+            bins = [0, 80, 100, 170, 180]
+            hist = np.histogram(tjas, bins=bins, density=True)[0]
+            out_dict['pct_t_acute'] = hist[0]
+            out_dict['pct_t_right'] = hist[1]
+            out_dict['pct_t_obtuse'] = hist[2]
+            out_dict['pct_t_straight'] = hist[3]
+
+            ext_angles = tja[has_tja & exterior_mask]
+            bins = np.arange(0, 180, 30)
+            ext_hist = np.histogram(ext_angles, bins=bins, density=True)[0]
+            ext_hist_sums = ext_hist[1:] + ext_hist[:-1]
+            int_angles = tja[has_tja & interior_mask]
+            int_hist = np.histogram(int_angles, bins=bins, density=True)[0]
+            int_hist_sums = int_hist[1:] + int_hist[:-1]
+            if max(ext_angles) > 0.6:
+                out_dict['parallel'] = 1
+            elif max(ext_hist_sums) > 0.7:
+                out_dict['parallel'] = 1
+            elif max(ext_hist_sums) > 0.5:
+                if int_hist_sums[np.argmax(ext_hist_sums)] > 0.8:
+                    out_dict['parallel'] = 1
+                else:
+                    out_dict['parallel'] = 0
+
+        if 'topology' in families:
+            depth = np.asarray(columns['depth'], dtype=np.float64)
+            balance = np.asarray(columns['balance_factor'], dtype=np.float64)
+            out_dict['med_depth'] = np.nanmedian(depth)
+            out_dict['std_depth'] = np.nanstd(depth, ddof=1)
+            out_dict['ave_balance'] = np.nanmean(balance)
+            out_dict['med_balance'] = np.nanmedian(balance)
+            out_dict['std_balance'] = np.nanstd(balance, ddof=1)
+
+            out_dict['leaves'] = leaves[root_loc]
+            out_dict['ave_depth'] = np.asarray(columns['ave_depth'], dtype=np.float64)[root_loc]
+            out_dict['height'] = np.nanmax(depth)
+            out_dict['compactness'] = out_dict['height'] / out_dict['leaves']
+            out_dict['mag_ord_ratio'] = leaves[root_loc] / np.nanmax(order)
+
+        if 'density' in families:
+            out_dict['density'] = np.nansum(shape[:, 0]) / da
+            out_dict['texture'] = len(order) / da
+
+        if 'bifurcation' in families:
+            bifurcation = bifurcation_ratios(order)
+            for i in bifurcation:
+                out_dict[i] = bifurcation[i]
+
+    return out_dict
+
+
+def bifurcation_ratios(order):
+    order = np.asarray(order, dtype=np.float64)
+    present_orders, counts = np.unique(order[~np.isnan(order)], return_counts=True)
+    counts = dict(zip(present_orders.tolist(), counts))
+    out_dict = dict()
+    for i in range(len(present_orders) - 1):
+        i += 2
+        out_dict[f'bifurcation_{i}'] = counts.get(i - 1, np.int64(0)) / counts.get(i, np.int64(0))
+    out_dict['bifurcation_mean'] = counts.get(1, np.int64(0)) ** (1 / (max(present_orders) - 1))
+    return out_dict
+
+
+def _find_root(ids, next_down):
+    root = np.unique(next_down[~np.isin(next_down, ids)])
+    if len(root) > 1:
+        raise ValueError('Multiple roots found')
+    return root[0]
+
+
 class Network:
+    """Metrics of one river tree.
+
+    Reach coordinates are held in a CoordinateStore (coords), built once from the geometry column or passed in, e.g.
+    from selection.select_reaches(packed=True), in which case gdf can be a plain DataFrame with one row per reach in
+    the same order.  With coord_dtype=np.float32 the buffer takes half the memory at the cost of precision.
+    Network.from_arrays computes the same metrics from plain arrays, without a DataFrame.
+    """
 
-    def __init__(self, gdf, from_field='HYRIV_ID', to_field='NEXT_DOWN', order_field='UPLAND_SKM', root=None):
+    def __init__(self, gdf, from_field='HYRIV_ID', to_field='NEXT_DOWN', order_field='UPLAND_SKM', root=None, families=None, edge_cache=None,
+                 coords=None, coord_dtype=np.float64):
         self.gdf = gdf
         self.gdf = self.gdf.set_index(from_field)
         self.da = gdf[order_field].max()
         self.from_field = from_field
         self.to_field = to_field
+        self.edge_cache = edge_cache
+        self.coords = CoordinateStore.from_geometries(gdf['geometry'].values, coord_dtype) if coords is None else coords
 
         if root is None:
             self.root = self.find_root()
         else:
             self.root = root
 
-        self.edge_dict = dict()
-        u = self.gdf.index.values
-        v = self.gdf[to_field].values
-        priority = {tmp_u: p for tmp_u, p in zip(u, self.gdf[order_field].values)}
-
-        edge_dict = dict()
-        for i in range(len(u)):
-            if v[i] in edge_dict:
-                if priority[u[i]] > priority[edge_dict[v[i]][0]]:
-                    edge_dict[v[i]].insert(0, u[i])
+        with stage('network', rows=len(self.gdf)):
+            with stage('topology', rows=len(self.gdf)):
+                self.topology = Topology(self.gdf.index.values, self.gdf[to_field].values, priority=self.gdf[order_field].values, roots=[self.root])
+            self.node_metrics = dict()
+
+            self.gdf.loc[:, ['length', 'curvature', 'meander', 'orientation', 'depth', 'leaves', 'balance_factor', 'cum_depth', 'ave_depth', 'tja']] = np.nan
+            self.gdf['trunk'] = 0
+            with stage('edge_metrics', rows=len(self.gdf)):
+                self.calc_edge_metrics()
+
+            with stage('traversal', rows=len(self.gdf)):
+                self.post_order_traversal()
+            with stage('trunk'):
+                self.get_trunk()
+            with stage('attach', rows=len(self.gdf)):
+                self.attach_node_metrics()
+            with stage('network_metrics'):
+                self.metrics = self.calc_network_metrics(families)
+
+    @classmethod
+    def from_arrays(cls, ids, next_down, upland, order, coords=None, length=None, orientation=None, curvature=None, meander=None,
+                    root=None, families=None, edge_cache=None):
+        """Builds the Network from per-reach arrays: ids, next_down, upland (drainage area, which orders tributaries
+        like order_field does) and order (Strahler), plus either a CoordinateStore or precomputed length and
+        orientation (curvature and meander are NaN unless given).  metrics is the same dictionary the GeoDataFrame
+        constructor produces; per-row values are kept in columns instead of gdf, with the root row last."""
+        self = cls.__new__(cls)
+        ids = np.asarray(ids)
+        next_down = np.asarray(next_down)
+        upland = np.asarray(upland, dtype=np.float64)
+        self.gdf = None
+        self.from_field = None
+        self.to_field = None
+        self.edge_cache = edge_cache
+        self.coords = coords
+        self.da = upland.max()
+        self.root = _find_root(ids, next_down) if root is None else root
+
+        with stage('network', rows=len(ids)):
+            with stage('topology', rows=len(ids)):
+                self.topology = Topology(ids, next_down, priority=upland, roots=[self.root])
+            topo = self.topology
+            with stage('edge_metrics', rows=len(ids)):
+                if coords is not None:
+                    edge = reach_edge_metrics(coords, ids, edge_cache)
                 else:
-                    edge_dict[v[i]].append(u[i])
-            else:
-                edge_dict[v[i]] = [u[i]]
-        self.edge_dict = edge_dict
-
-        self.gdf.loc[:, ['length', 'curvature', 'meander', 'orientation', 'depth', 'leaves', 'balance_factor', 'cum_depth', 'ave_depth', 'tja']] = np.nan
-        self.gdf['trunk'] = 0
-        self.calc_edge_metrics()
-
-        self.post_order_traversal()
-        self.get_trunk()
-        self.metrics = self.calc_network_metrics()
+                    if length is None or orientation is None:
+                        raise ValueError('Give coords, or length and orientation')
+                    edge = {'length': length, 'orientation': orientation, 'curvature': curvature, 'meander': meander}
+                edge = {c: np.full(len(ids), np.nan) if edge[c] is None else np.asarray(edge[c], dtype=np.float64) for c in ['length', 'curvature', 'meander', 'orientation']}
+
+            with stage('traversal', rows=len(ids)):
+                node_orientation = np.full(len(topo.ids), np.nan)
+                node_orientation[:topo.n_edges] = edge['orientation']
+                self.node_metrics = tree_metrics(topo, node_orientation)
+            with stage('trunk'):
+                self.get_trunk()
+
+            # Rows as Network.gdf has them: every reach, then the reached virtual nodes (the root)
+            with stage('attach', rows=len(ids)):
+                rows = np.concatenate([np.arange(topo.n_edges), topo.n_edges + np.flatnonzero(topo.reached[topo.n_edges:])])
+                n_virtual = len(rows) - topo.n_edges
+                order = np.asarray(order)
+                if n_virtual:
+                    order = np.append(order.astype(np.float64), np.full(n_virtual, np.nan))  # as reindexing gdf does
+                self.columns = {c: np.append(v, np.full(n_virtual, np.nan)) for c, v in edge.items()}
+                self.columns['ORD_STRA'] = order
+                self.columns.update({c: v[rows] for c, v in self.node_metrics.items()})
+                self.columns['id'] = topo.ids[rows]
+            with stage('network_metrics'):
+                self.metrics = self.calc_network_metrics(families)
+        return self
 
     def find_root(self):
         root = self.gdf[self.gdf[self.to_field].isin(self.gdf.index) == False][self.to_field].unique()
@@ -106,208 +324,142 @@ class Network:
         return root[0]
 
     def calc_edge_metrics(self):
-        print('Calculating Edge Metrics...')
-        for i in self.gdf.index:
-            tmp_e = Segment(self.gdf.loc[i, 'geometry'])
-            self.gdf.loc[i, 'length'] = tmp_e.length
-            self.gdf.loc[i, 'curvature'] = tmp_e.curvature()
-            self.gdf.loc[i, 'meander'] = tmp_e.meander()
-            self.gdf.loc[i, 'orientation'] = tmp_e.orientation
-
-    def calc_network_metrics(self):
-        print('Calculating Network Metrics...')
-        out_dict = dict()
-
-        out_dict['ave_length'] = self.gdf['length'].mean()
-        out_dict['med_length'] = self.gdf['length'].median()
-        out_dict['std_length'] = self.gdf['length'].std()
-        out_dict['ave_curvature'] = self.gdf['curvature'].mean()
-        out_dict['med_curvature'] = self.gdf['curvature'].median()
-        out_dict['std_curvature'] = self.gdf['curvature'].std()
-        out_dict['ave_meander'] = self.gdf['meander'].mean()
-        out_dict['med_meander'] = self.gdf['meander'].median()
-        out_dict['std_meander'] = self.gdf['meander'].std()
-
-        orientations = self.gdf['orientation'].dropna()
-        out_dict['ave_orientation'] = circmean(orientations, low=-180, high=180)
-        out_dict['std_orientation'] = circstd(orientations, low=-180, high=180)
-
-        exterior_mask = (self.gdf['leaves'] > 1)
-        out_dict['mean_length_ext'] = self.gdf[exterior_mask]['length'].mean()
-        out_dict['mean_curvature_ext'] = self.gdf[exterior_mask]['curvature'].mean()
-        out_dict['mean_meander_ext'] = self.gdf[exterior_mask]['meander'].mean()
-        interior_mask = (self.gdf['leaves'] == 1)
-        out_dict['mean_length_int'] = self.gdf[interior_mask]['length'].mean()
-        out_dict['mean_curvature_int'] = self.gdf[interior_mask]['curvature'].mean()
-        out_dict['mean_meander_int'] = self.gdf[interior_mask]['meander'].mean()
-
-        out_dict['std_length_ext'] = self.gdf[exterior_mask]['length'].std()
-        out_dict['std_curvature_ext'] = self.gdf[exterior_mask]['curvature'].std()
-        out_dict['std_meander_ext'] = self.gdf[exterior_mask]['meander'].std()
-
-        out_dict['std_length_int'] = self.gdf[interior_mask]['length'].std()
-        out_dict['std_curvature_int'] = self.gdf[interior_mask]['curvature'].std()
-        out_dict['std_meander_int'] = self.gdf[interior_mask]['meander'].std()
-
-        for i in self.gdf['ORD_STRA'].unique():
-            if np.isnan(i):
-                continue
-            out_dict[f'mean_length_ord_{i}'] = self.gdf[self.gdf['ORD_STRA'] == i]['length'].mean()
-            out_dict[f'mean_curvature_ord_{i}'] = self.gdf[self.gdf['ORD_STRA'] == i]['curvature'].mean()
-            out_dict[f'mean_meander_ord_{i}'] = self.gdf[self.gdf['ORD_STRA'] == i]['meander'].mean()
-
-        trunk_mask = (self.gdf['trunk'] == 1)
-        out_dict['mean_length_trunk'] = self.gdf[trunk_mask]['length'].mean()
-        out_dict['mean_curvature_trunk'] = self.gdf[trunk_mask]['curvature'].mean()
-        out_dict['mean_meander_trunk'] = self.gdf[trunk_mask]['meander'].mean()
-
-        tjas = self.gdf['tja'].dropna()
-        out_dict['ave_tja'] = tjas.mean()
-        out_dict['med_tja'] = tjas.median()
-        out_dict['std_tja'] = tjas.std()
-        bins = [0, 80, 100, 170, 180]
-        hist = np.histogram(tjas, bins=bins, density=True)[0]
-        out_dict['pct_t_acute'] = hist[0]
-        out_dict['pct_t_right'] = hist[1]
-        out_dict['pct_t_obtuse'] = hist[2]
-        out_dict['pct_t_straight'] = hist[3]
-
-        ext_angles = tjas[exterior_mask]
-        bins = np.arange(0, 180, 30)
-        ext_hist = np.histogram(ext_angles, bins=bins, density=True)[0]
-        ext_hist_sums = ext_hist[1:] + ext_hist[:-1]
-        int_angles = tjas[interior_mask]
-        int_hist = np.histogram(int_angles, bins=bins, density=True)[0]
-        int_hist_sums = int_hist[1:] + int_hist[:-1]
-        if max(ext_angles) > 0.6:
-            out_dict['parallel'] = 1
-        elif max(ext_hist_sums) > 0.7:
-            out_dict['parallel'] = 1
-        elif max(ext_hist_sums) > 0.5:
-            if int_hist_sums[np.argmax(ext_hist_sums)] > 0.8:
-                out_dict['parallel'] = 1
-            else:
-                out_dict['parallel'] = 0
-
-        out_dict['med_depth'] = self.gdf['depth'].median()
-        out_dict['std_depth'] = self.gdf['depth'].std()
-        out_dict['ave_balance'] = self.gdf['balance_factor'].mean()
-        out_dict['med_balance'] = self.gdf['balance_factor'].median()
-        out_dict['std_balance'] = self.gdf['balance_factor'].std()
-
-        out_dict['leaves'] = self.gdf.loc[self.root, 'leaves']
-        out_dict['ave_depth'] = self.gdf.loc[self.root, 'ave_depth']
-        out_dict['height'] = self.gdf['depth'].max()
-        out_dict['compactness'] = out_dict['height'] / out_dict['leaves']
-        out_dict['mag_ord_ratio'] = self.gdf.loc[self.root, 'leaves'] / self.gdf['ORD_STRA'].max()
-
-        out_dict['density'] = self.gdf['length'].sum() / self.da
-        out_dict['texture'] = len(self.gdf) / self.da
+        metrics = reach_edge_metrics(self.coords, self.gdf.index.values, self.edge_cache)
+        for c in ['length', 'curvature', 'meander', 'orientation']:
+            self.gdf[c] = metrics[c]
 
-        bifurcation = self.bifurcation_ratios()
-        for i in bifurcation:
-            out_dict[i] = bifurcation[i]
-
-        return out_dict
+    def calc_network_metrics(self, families=None):
+        if self.gdf is None:
+            root_loc = int(np.flatnonzero(self.columns['id'] == self.root)[0])
+            return network_metrics(self.columns, root_loc, self.da, families)
+        columns = {c: self.gdf[c].to_numpy() for c in NETWORK_COLUMNS}
+        return network_metrics(columns, self.gdf.index.get_loc(self.root), self.da, families)
 
     def bifurcation_ratios(self):
-        present_orders = sorted(self.gdf['ORD_STRA'].dropna().unique())
-        out_dict = dict()
-        for i in range(len(present_orders) - 1):
-            i += 2
-            out_dict[f'bifurcation_{i}'] = np.sum(self.gdf['ORD_STRA'] == i - 1) / np.sum(self.gdf['ORD_STRA'] == i)
-        out_dict['bifurcation_mean'] = np.sum(self.gdf['ORD_STRA'] == 1) ** (1 / (max(present_orders) - 1))
-        return out_dict
-
-    def calc_junction_angles(self):
-        init_list = self.gdf[[self.to_field]]
-        init_list = init_list.merge(init_list, left_index=True, right_on=self.to_field, how='left')
-        init_list = init_list[init_list[self.to_field + '_y'].isna()][self.to_field + '_x'].unique()
-
-        q = queue.Queue()
-        [q.put(i) for i in init_list]
-        evaluated = dict()
-        all_edges = self.gdf[self.from_field].to_list()
-        while not q.empty():
-            cur_node = q.get()
-            if not cur_node in all_edges:
-                continue
-            
-            tribs = self.gdf[self.gdf[self.to_field] == cur_node][self.from_field].index
-            if len(tribs) != 2:
-                continue
-            tja = abs(self.gdf.loc[tribs[0], 'orientation'] - self.gdf.loc[tribs[1], 'orientation'])
-            if tja > 180:
-                tja = 360 - tja
-            evaluated[cur_node] = tja
-
-            next_down = self.edges[self.edges[self.from_field] == cur_node][self.to_field].item()
-            if not next_down in evaluated:
-                q.put(next_down)
-        return evaluated
-    
-    def _process_node(self, node):
-        if node not in self.edge_dict:
-            self.gdf.loc[node, 'depth'] = 0
-            self.gdf.loc[node, 'leaves'] = 1
-            self.gdf.loc[node, 'balance_factor'] = 0
-            self.gdf.loc[node, 'cum_depth'] = 0
-            self.gdf.loc[node, 'ave_depth'] = 0
-            self.gdf.loc[node, 'tja'] = np.nan
-        else:
-            children = self.edge_dict[node]
-            sub_df = self.gdf.loc[children]
-            depths = sub_df['depth'].values
-            self.gdf.loc[node, 'depth'] = depths.max() + 1
-            leaves = sub_df['leaves'].sum()
-            self.gdf.loc[node, 'leaves'] = leaves
-            cum_depth = sub_df['cum_depth'].sum() + leaves
-            self.gdf.loc[node, 'cum_depth'] = cum_depth
-            self.gdf.loc[node, 'ave_depth'] = cum_depth / leaves
-            self.gdf.loc[node, 'balance_factor'] = depths[0] - depths[1]
-            orientations = sub_df['orientation'].values
-            tja = abs(orientations[0] - orientations[1])
-            if tja > 180:
-                tja = 360 - tja
-            self.gdf.loc[node, 'tja'] = tja
+        return bifurcation_ratios(self.gdf['ORD_STRA'].to_numpy() if self.gdf is not None else self.columns['ORD_STRA'])
+
+    def calc_junction_angles(self, n_vertices=None, distance_km=None, distance=None):
+        """Angles at every confluence from the reach tangents next to it: the last (or first) n_vertices, or the last
+        (or first) distance_km along the reach (lon/lat data such as HydroRIVERS), or distance in coordinate units
+        (projected data), falling back to chord orientations.  Returns a DataFrame indexed by the receiving node with
+        the two tributaries, tja, the receiving reach direction and each tributary's deflection."""
+        topo = self.topology
+        tangents = self.coords.end_tangents(n_vertices, distance, distance_km)
+        angles = junction_angles(topo, tangents['head'], tangents['tail'])
+        nodes = angles.pop('node')
+        out = pd.DataFrame(angles, index=pd.Index(topo.ids[nodes], name=self.gdf.index.name if self.gdf is not None else None))
+        out.insert(0, 'trib_0', topo.ids[topo.first_child(nodes, 0)])
+        out.insert(1, 'trib_1', topo.ids[topo.first_child(nodes, 1)])
+        return out
+
+    def geometries(self):
+        """Shapely geometry of every reach, built from the coordinate store."""
+        return self.coords.geometries()
 
     def get_trunk(self):
-        print('Finding Trunk...')
-        q = [self.root]
-        while q:
-            cur_node = q[-1]
-            if cur_node not in self.edge_dict:
-                q.pop()
-            else:
-                self.gdf.loc[cur_node, 'trunk'] = 1
-                children = self.edge_dict[cur_node]
-                if self.gdf.loc[children[0], 'depth'] > self.gdf.loc[children[1], 'depth']:
-                    q.pop()
-                    q.append(children[0])
-                else:
-                    q.pop()
-                    q.append(children[1])
-                
-        return
+        self.node_metrics['trunk'] = trunk(self.topology, self.node_metrics['depth'])
 
     def post_order_traversal(self):
-        print('Traversing Network...')
-        
-        q = [self.root]
-        visited = []
-        while q:
-            cur_node = q[-1]
-            if cur_node not in self.edge_dict or all([child in visited for child in self.edge_dict[cur_node]]):
-                q.pop()
-                self._process_node(cur_node)
-                visited.append(cur_node)
-            else:
-                for child in self.edge_dict[cur_node]:
-                    if child not in visited:
-                        q.append(child)
-        return visited
-
-
-
-
+        orientation = np.full(len(self.topology.ids), np.nan)
+        orientation[:self.topology.n_edges] = self.gdf['orientation'].values
+        self.node_metrics.update(tree_metrics(self.topology, orientation))
+        return self.topology.ids[self.topology.post_order]
+
+    def attach_node_metrics(self):
+        """Writes the node metric arrays onto gdf in one step, adding rows for reached virtual nodes such as the root."""
+        topo = self.topology
+        virtual = topo.ids[topo.n_edges:][topo.reached[topo.n_edges:]]
+        if len(virtual):
+            index = self.gdf.index.append(pd.Index(virtual)).rename(self.gdf.index.name)
+            self.gdf = self.gdf.reindex(index)
+        positions = topo.index_of(self.gdf.index.values)
+        for c, values in self.node_metrics.items():
+            self.gdf[c] = values[positions]
+
+
+class Forest:
+    """Every disjoint tree of a GeoDataFrame at once, e.g. all the basins label_basins produces.
+
+    Each tree is rooted at a virtual outlet node, the same way Network roots a single tree, and all trees share one
+    topology, one batch of edge metrics and one traversal.  gdf carries the per-edge columns for the whole forest
+    plus a tree column holding each row's root id, and metrics is a DataFrame of network metrics indexed by root id.
+    Trees whose metrics cannot be computed are left out of metrics and listed in failures with the error.  Coordinates
+    are held in a CoordinateStore exactly as in Network.
+    """
+
+    def __init__(self, gdf, from_field='HYRIV_ID', to_field='NEXT_DOWN', order_field='UPLAND_SKM', families=None, edge_cache=None,
+                 coords=None, coord_dtype=np.float64):
+        self.gdf = gdf.set_index(from_field)
+        self.coords = CoordinateStore.from_geometries(gdf['geometry'].values, coord_dtype) if coords is None else coords
+        self.from_field = from_field
+        self.to_field = to_field
+        self.order_field = order_field
+        self.failures = dict()
+
+        with stage('forest', rows=len(self.gdf)):
+            with stage('topology', rows=len(self.gdf)):
+                self.topology = Topology(self.gdf.index.values, self.gdf[to_field].values, priority=self.gdf[order_field].values)
+                self.roots = self.topology.ids[self.topology.roots]
+            with stage('edge_metrics', rows=len(self.gdf)):
+                metrics = reach_edge_metrics(self.coords, self.gdf.index.values, edge_cache)
+                for c in ['length', 'curvature', 'meander', 'orientation']:
+                    self.gdf[c] = metrics[c]
+            with stage('traversal', rows=len(self.gdf)):
+                orientation = np.full(len(self.topology.ids), np.nan)
+                orientation[:self.topology.n_edges] = self.gdf['orientation'].values
+                self.node_metrics = tree_metrics(self.topology, orientation)
+                self.node_metrics['trunk'] = trunk(self.topology, self.node_metrics['depth'])
+                self.node_metrics['tree'] = self.tree_labels()
+            with stage('attach', rows=len(self.gdf)):
+                self.attach_node_metrics()
+            with stage('network_metrics', rows=len(self.roots)):
+                self.metrics = self.calc_network_metrics(families)
+
+    def tree_labels(self):
+        """Root id of the tree every node belongs to, pushed down level by level.  Unreached nodes get -1, which a root
+        id may also be, so tell them apart with topology.reached rather than the label."""
+        topo = self.topology
+        label = np.full(len(topo.ids), -1, dtype=np.int64)
+        label[topo.roots] = np.arange(len(topo.roots))
+        for lvl in topo.levels[1:]:
+            label[lvl] = label[topo.parent[lvl]]
+        out = np.full(len(topo.ids), -1, dtype=np.int64)
+        out[topo.reached] = topo.ids[topo.roots][label[topo.reached]]
+        return out
+
+    def attach_node_metrics(self):
+        """Writes the node metric arrays onto gdf, appending one row per root like Network does for its root."""
+        topo = self.topology
+        virtual = topo.ids[topo.n_edges:][topo.reached[topo.n_edges:]]
+        if len(virtual):
+            index = self.gdf.index.append(pd.Index(virtual)).rename(self.gdf.index.name)
+            self.gdf = self.gdf.reindex(index)
+        positions = topo.index_of(self.gdf.index.values)
+        for c, values in self.node_metrics.items():
+            self.gdf[c] = values[positions]
+
+    def calc_network_metrics(self, families=None):
+        """Runs network_metrics on every tree's slice of the shared columns.  Rows are grouped by tree in their gdf
+        order, which puts each root row last, exactly where Network has it."""
+        tree = self.gdf['tree'].to_numpy()
+        rows = np.flatnonzero(self.topology.reached[self.topology.index_of(self.gdf.index.values)])
+        rows = rows[np.argsort(tree[rows], kind='stable')]
+        columns = {c: self.gdf[c].to_numpy()[rows] for c in NETWORK_COLUMNS}
+        order_value = self.gdf[self.order_field].to_numpy(dtype=np.float64)[rows]
+        labels, starts = np.unique(tree[rows], return_index=True)
+        ends = np.append(starts[1:], len(rows))
+
+        out = list()
+        index = list()
+        for root, start, end in zip(labels.tolist(), starts.tolist(), ends.tolist()):
+            tree_columns = {c: v[start:end] for c, v in columns.items()}
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=RuntimeWarning)
+                    da = np.nanmax(order_value[start:end])
+                out.append(network_metrics(tree_columns, end - start - 1, da, families))
+                index.append(root)
+            except Exception as e:
+                self.failures[root] = f'{type(e).__name__}: {e}'
+        return pd.DataFrame(out, index=pd.Index(index, name='root'))
 
@@ -1,48 +1,190 @@
-import networkx as nx
 import network_cards as nc
 import os
 import sqlite3
-import pandas as pd
-
-# Load network
-in_path = os.path.join(os.getcwd(), 'data', 'graph.db')
-con = sqlite3.connect(in_path)
-cur = con.cursor()
-G = nx.DiGraph()
-
-# Load data
-edge_df = pd.read_sql_query("SELECT HYRIV_ID, NEXT_DOWN, LENGTH_KM, UPLAND_SKM, ORD_STRA FROM edges", con)
-node_df = pd.read_sql_query("SELECT HYRIV_ID, longitude, latitude, basin FROM nodes", con)
-con.close()
-
-# Make graph
-edges = edge_df[['HYRIV_ID', 'NEXT_DOWN']].values.tolist()
-G.add_edges_from(edges)
-edge_attrs = edge_df.set_index(['HYRIV_ID', 'NEXT_DOWN']).to_dict(orient='index')
-nx.set_edge_attributes(G, edge_attrs)
-node_attrs = node_df.set_index('HYRIV_ID').to_dict(orient='index')
-nx.set_node_attributes(G, node_attrs)
-
-# Make network card
-card = nc.NetworkCard(G)
-
-card.update_overall("Name", "North American Fifth-Order Streams")
-card.update_overall("Kind", "Directed graph")
-card.update_overall("Nodes are", "River confluences")
-card.update_overall("Links are", "River segments between confluences")
-card.update_overall("Links weights are", "One of the following: length (km), drainage area (sq.km.), strahler order")
-card.update_overall("Considerations", None)
-card_meta = {
-    "Node metadata": "hyriv_id, latitude, longitude, subbasin ID",
-    "Link metadata": "length (km), drainage area (sq.km.), strahler order",
-    "Date of creation": 2024,
-    "Data generating process": "Data was extracted from the HyrdoRIVERS data layer, a global dataset of rivers derived from 15 arc-second digital elevation data.  Lehner, B., Grill G. (2013): Global river hydrography and network routing: baseline data and new approaches to study the world’s large river systems. Hydrological Processes, 27(15): 2171–2186. Data is available at www.hydrosheds.org.",
-    "Ethics": None,
-    "Funding": None,
-    "Citation": None,
-    "Access": 'https://www.hydroshare.org/resource/6cf2c36bccb94055bd5264b847df3af1/'
-}
-card.update_metainfo(card_meta)
-print(card)
-card.to_latex(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'network_card.tex'))
-card.to_frame().to_csv(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'network_card.csv'))
\ No newline at end of file
+import numpy as np
+
+EDGE_ATTRS = ['LENGTH_KM', 'UPLAND_SKM', 'ORD_STRA']
+NODE_ATTRS = ['longitude', 'latitude', 'basin']
+
+
+def read_topology(db_path, chunk_size=500000):
+    """Streams HYRIV_ID and NEXT_DOWN from graph.db into two int64 arrays."""
+    con = sqlite3.connect(db_path)
+    cur = con.cursor()
+    n = cur.execute('SELECT COUNT(*) FROM edges').fetchall()[0][0]
+    ids = np.empty(n, dtype=np.int64)
+    next_down = np.empty(n, dtype=np.int64)
+    cur.execute('SELECT HYRIV_ID, NEXT_DOWN FROM edges')
+    start = 0
+    rows = cur.fetchmany(chunk_size)
+    while rows:
+        block = np.array(rows, dtype=np.int64)
+        ids[start:start + len(rows)] = block[:, 0]
+        next_down[start:start + len(rows)] = block[:, 1]
+        start += len(rows)
+        rows = cur.fetchmany(chunk_size)
+    con.close()
+    return ids, next_down
+
+
+def attribute_summaries(db_path):
+    """Count, mean, min and max of every edge and node attribute, aggregated inside SQLite."""
+    con = sqlite3.connect(db_path)
+    out = dict()
+    for table, attrs in [('edges', EDGE_ATTRS), ('nodes', NODE_ATTRS)]:
+        columns = {i[1] for i in con.execute(f'PRAGMA table_info({table})').fetchall()}
+        for a in attrs:
+            if a in columns:
+                count, mean, low, high = con.execute(f'SELECT COUNT({a}), AVG({a}), MIN({a}), MAX({a}) FROM {table}').fetchall()[0]
+                out[a] = {'count': count, 'mean': mean, 'min': low, 'max': high}
+    con.close()
+    return out
+
+
+def graph_stats(ids, next_down):
+    """The structure NetworkCard reports for the directed graph with one link HYRIV_ID -> NEXT_DOWN per reach, from
+    arrays.  Nodes are every reach plus every downstream id that is not a reach.  networkx is only used for the
+    cases a river network should never hit: clustering of a graph that is not a forest, and the diameter of a
+    strongly connected graph."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    ids = np.asarray(ids, dtype=np.int64)
+    next_down = np.asarray(next_down, dtype=np.int64)
+    nodes, inverse = np.unique(np.concatenate([ids, next_down]), return_inverse=True)
+    n = len(nodes)
+    m = len(ids)
+    src = inverse[:m]
+    dst = inverse[m:]
+    in_degree = np.bincount(dst, minlength=n)
+    out_degree = np.bincount(src, minlength=n)
+
+    # Links that also exist in the opposite direction
+    pairs = np.unique(np.column_stack([np.minimum(src, dst), np.maximum(src, dst)]), axis=0)
+    graph = coo_matrix((np.ones(m), (src, dst)), shape=(n, n)).tocsr()
+    n_weak = connected_components(graph, directed=True, connection='weak')[0]
+    n_strong = connected_components(graph, directed=True, connection='strong')[0]
+    self_loops = int((src == dst).sum())
+    forest = self_loops == 0 and len(pairs) == m and m == n - n_weak
+
+    stats = {
+        'nodes': n,
+        'links': m,
+        'self_loops': self_loops,
+        'bidirectional_links': m - len(pairs),
+        'in_degree': in_degree,
+        'degree': in_degree + out_degree,
+        'weak_components': n_weak,
+        'strong_components': n_strong,
+        'clustering': 0.0 if forest or n == 0 else None,
+        'diameter': None,
+    }
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = out_degree[src].astype(np.float64)
+        y = in_degree[dst].astype(np.float64)
+        stats['assortativity'] = float(((x - x.mean()) * (y - y.mean())).mean() / (x.std() * y.std())) if m else float('nan')
+
+    if stats['clustering'] is None or n_strong == 1:
+        import networkx as nx
+        G = to_networkx(ids, next_down)
+        if stats['clustering'] is None:
+            stats['clustering'] = nx.average_clustering(G)
+        if n_strong == 1:
+            stats['diameter'] = nx.diameter(G)
+    return stats
+
+
+def to_networkx(ids, next_down, edge_attrs=None, node_attrs=None):
+    """The full nx.DiGraph, for when it is actually needed.  Attribute arguments are {name: array} over reaches."""
+    import networkx as nx
+
+    G = nx.DiGraph()
+    G.add_edges_from(zip(np.asarray(ids).tolist(), np.asarray(next_down).tolist()))
+    for name, values in (edge_attrs or {}).items():
+        nx.set_edge_attributes(G, dict(zip(zip(np.asarray(ids).tolist(), np.asarray(next_down).tolist()), np.asarray(values).tolist())), name)
+    for name, values in (node_attrs or {}).items():
+        nx.set_node_attributes(G, dict(zip(np.asarray(ids).tolist(), np.asarray(values).tolist())), name)
+    return G
+
+
+def _summarize_distribution(values, label):
+    """NetworkCard.summarize_distribution without converting the values to a Python list first."""
+    if len(values) <= 5:
+        return {label: str(sorted(np.asarray(values).tolist(), reverse=True))}
+    s = f"{np.mean(values):g} [{int(np.min(values))}, {int(np.max(values))}]"
+    return {label: (s, r"Distributions summarized with average [min, max].")}
+
+
+def build_card(stats, attributes=None, name=''):
+    """Fills a NetworkCard with the same fields, in the same order, that NetworkCard(G) computes for the directed
+    graph, without the graph.  With attributes (from attribute_summaries), an average [min, max] line per attribute
+    is added to the structure panel."""
+    card = nc.NetworkCard(None, initialize=False)
+    card.update_overall({"Name": name})
+    card.update_overall({"Kind": "Directed, unweighted"})
+    card.update_overall("Nodes are")
+    card.update_overall("Links are")
+    card.update_overall("Considerations")
+
+    links = stats['links']
+    if stats['self_loops'] > 0:
+        lbl = 'self-loop' if stats['self_loops'] == 1 else 'self-loops'
+        links = f"{links} ({stats['self_loops']} {lbl})"
+    card.update_structure({"Number of nodes": stats['nodes']})
+    card.update_structure({"Number of links": links})
+    card.update_structure({"--- Bidirectional links": f"{100 * stats['bidirectional_links'] / stats['links']:.3g}%"})
+    degree = _summarize_distribution(stats['in_degree'], 'Degree (in/out)')
+    degree.update(_summarize_distribution(stats['degree'], 'Degree'))
+    if isinstance(degree['Degree'], tuple):
+        entry, note = degree['Degree']
+        degree['Degree'] = (entry, "Undirected.", note)
+    card.update_structure(degree)
+    card.update_structure({"Clustering": stats['clustering']})
+    if stats['strong_components'] == 1:
+        card.update_structure({"Connected": "Strongly connected", 'Diameter': stats['diameter']})
+    elif stats['weak_components'] == 1:
+        card.update_structure({"Connected": "Weakly connected"})
+    else:
+        card.update_structure({"Connected": "Disconnected"})
+    card.update_structure({"Assortativity (degree)": stats['assortativity']})
+    for a, s in (attributes or {}).items():
+        card.update_structure({a: f"{s['mean']:g} [{s['min']:g}, {s['max']:g}]"})
+
+    for field in ["Node metadata", "Link metadata", "Date of creation", "Data generating process", "Ethics", "Funding", "Citation", "Access"]:
+        card.update_metainfo(field)
+    return card
+
+
+def card_from_db(db_path, attributes=False, chunk_size=500000):
+    """Network card for graph.db computed from streamed topology arrays."""
+    stats = graph_stats(*read_topology(db_path, chunk_size))
+    return build_card(stats, attribute_summaries(db_path) if attributes else None)
+
+
+if __name__ == '__main__':
+    # Load network
+    in_path = os.path.join(os.getcwd(), 'data', 'graph.db')
+
+    # Make network card
+    card = card_from_db(in_path)
+
+    card.update_overall("Name", "North American Fifth-Order Streams")
+    card.update_overall("Kind", "Directed graph")
+    card.update_overall("Nodes are", "River confluences")
+    card.update_overall("Links are", "River segments between confluences")
+    card.update_overall("Links weights are", "One of the following: length (km), drainage area (sq.km.), strahler order")
+    card.update_overall("Considerations", None)
+    card_meta = {
+        "Node metadata": "hyriv_id, latitude, longitude, subbasin ID",
+        "Link metadata": "length (km), drainage area (sq.km.), strahler order",
+        "Date of creation": 2024,
+        "Data generating process": "Data was extracted from the HyrdoRIVERS data layer, a global dataset of rivers derived from 15 arc-second digital elevation data.  Lehner, B., Grill G. (2013): Global river hydrography and network routing: baseline data and new approaches to study the world’s large river systems. Hydrological Processes, 27(15): 2171–2186. Data is available at www.hydrosheds.org.",
+        "Ethics": None,
+        "Funding": None,
+        "Citation": None,
+        "Access": 'https://www.hydroshare.org/resource/6cf2c36bccb94055bd5264b847df3af1/'
+    }
+    card.update_metainfo(card_meta)
+    print(card)
+    card.to_latex(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'network_card.tex'))
+    card.to_frame().to_csv(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'network_card.csv'))
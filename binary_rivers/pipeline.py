@@ -0,0 +1,192 @@
+import hashlib
+import sqlite3
+import json
+import time
+import os
+from .extract_graph import (EDGE_COLS, EDGE_DTYPES, NODE_COLS, NODE_DTYPES, create_table, list_layers, plan_shards,
+                            extract_shard, label_basins_fast, prune_graph, enforce_binary_fast)
+from .columnar import write_columnar
+from .refresh import record_source
+from .instrument import stage
+from .graphdb import connect, close, finalize, session
+
+
+STAGES = ['extract', 'label_basins', 'prune_graph', 'enforce_binary', 'columnar']
+DESTRUCTIVE = {'prune_graph', 'enforce_binary'}  # can only be redone on a freshly extracted graph.db
+
+
+def file_fingerprint(path):
+    """Size and latest mtime of a file, or of every file under a directory (a .gdb is a directory)."""
+    if os.path.isdir(path):
+        size = 0
+        mtime = 0.0
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                st = os.stat(os.path.join(root, f))
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+    else:
+        st = os.stat(path)
+        size, mtime = st.st_size, st.st_mtime
+    return {'path': os.path.abspath(path), 'size': size, 'mtime': mtime}
+
+
+def _digest(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def stage_fingerprints(sources, order_thresh, checkpoint_size, columnar_path=None):
+    """One fingerprint per stage.  Each includes the previous stage's, so a changed input invalidates everything
+    after it."""
+    inputs = {
+        'extract': {'sources': [(file_fingerprint(p), l) for p, l in sources], 'checkpoint_size': checkpoint_size},
+        'label_basins': {'order_thresh': order_thresh},
+        'prune_graph': {},
+        'enforce_binary': {},
+        'columnar': {'path': os.path.abspath(columnar_path) if columnar_path else None},
+    }
+    out = dict()
+    previous = None
+    for s in STAGES:
+        previous = _digest([previous, s, inputs[s]])
+        out[s] = previous
+    return out
+
+
+def init_state(con):
+    con.execute('CREATE TABLE IF NOT EXISTS pipeline_stages (stage TEXT PRIMARY KEY, fingerprint TEXT, completed REAL)')
+    con.execute('''CREATE TABLE IF NOT EXISTS pipeline_batches (
+        source TEXT, layer TEXT, fid_start INTEGER, fid_stop INTEGER, fingerprint TEXT, rows INTEGER, completed REAL,
+        PRIMARY KEY (source, layer, fid_start))''')
+    con.commit()
+
+
+def read_state(db_path):
+    """Completed stages and extraction batches recorded in graph.db, or empty state when there is none yet."""
+    if not os.path.exists(db_path):
+        return {}, {}
+    con = sqlite3.connect(db_path)
+    tables = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()}
+    if 'pipeline_stages' not in tables:
+        con.close()
+        return {}, {}
+    stages = dict(con.execute('SELECT stage, fingerprint FROM pipeline_stages').fetchall())
+    batches = {(r[0], r[1], r[2]): r[3] for r in con.execute('SELECT source, layer, fid_start, fingerprint FROM pipeline_batches').fetchall()}
+    con.close()
+    return stages, batches
+
+
+def plan_pipeline(stages, batches, fingerprints, columnar_path=None):
+    """Decides what each stage needs: 'skip' when it finished with the same inputs, 'resume' when extraction has
+    matching batches to build on, otherwise 'run'.  Returns [(stage, action, reason)]."""
+    names = [s for s in STAGES if s != 'columnar' or columnar_path]
+    stale = [s for s in names if stages.get(s) != fingerprints[s]]
+    if columnar_path and 'columnar' not in stale and not os.path.exists(os.path.join(columnar_path, 'meta.json')):
+        stale.append('columnar')
+    if not stale:
+        return [(s, 'skip', 'inputs unchanged') for s in names]
+    first = names.index(stale[0])
+
+    # Pruning and binarization rewrite graph.db in place, so anything before them has to start from extraction
+    restart = first > 0 and any(s in stages for s in names[first:] if s in DESTRUCTIVE)
+    if restart:
+        first = 0
+    if first == 0 and 'extract' in stages:
+        batches = {}  # a finished extraction with other inputs is not something to resume
+
+    plan = list()
+    for i, s in enumerate(names):
+        if i < first:
+            plan.append((s, 'skip', 'inputs unchanged'))
+        elif i == first == 0 and batches and all(f == fingerprints[s] for f in batches.values()):
+            plan.append((s, 'resume', f'{len(batches)} batches already committed'))
+        elif i == first and restart:
+            plan.append((s, 'run', f'{stale[0]} inputs changed and graph.db was already pruned'))
+        elif i == first:
+            plan.append((s, 'run', 'not run yet' if s not in stages else 'inputs changed'))
+        else:
+            plan.append((s, 'run', 'depends on ' + names[first]))
+    return plan
+
+
+def _mark_complete(con, name, fingerprint):
+    con.execute('INSERT OR REPLACE INTO pipeline_stages VALUES (?, ?, ?)', (name, fingerprint, time.time()))
+    con.commit()
+
+
+def _extract(db_path, sources, fingerprint, resume, checkpoint_size, batch_size, use_arrow):
+    """Extracts FID shards one transaction at a time; each shard is committed together with its checkpoint row."""
+    if not resume and os.path.exists(db_path):
+        close(db_path)
+        os.remove(db_path)
+    con = connect(db_path)
+    init_state(con)
+    if not resume:
+        create_table(con, 'edges', EDGE_COLS, EDGE_DTYPES)
+        create_table(con, 'nodes', NODE_COLS, NODE_DTYPES)
+        con.commit()
+    done = {r[0:3] for r in con.execute('SELECT source, layer, fid_start FROM pipeline_batches').fetchall()}
+
+    with stage('extract', con=con) as s:
+        shards = plan_shards(sources, checkpoint_size)
+        s.set('shards', len(shards))
+        s.set('resumed', len(done))
+        for shard in shards:
+            in_path, layer_name, fid_col, start, stop = shard
+            if (os.path.abspath(in_path), layer_name, start) in done:
+                continue
+            try:
+                rows = extract_shard(con, shard, batch_size, use_arrow)
+            except BaseException:
+                con.rollback()  # the connection is shared, so a half-written shard must not ride along with the next commit
+                raise
+            con.execute('INSERT INTO pipeline_batches VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (os.path.abspath(in_path), layer_name, start, stop, fingerprint, rows, time.time()))
+            con.commit()
+            s.add_rows(rows)
+        con.create_indexes()
+    record_source(db_path)  # what refresh_graph diffs the next release against
+    _mark_complete(con, 'extract', fingerprint)
+
+
+def run_pipeline(in_path, out_path, order_thresh=5, layer_names=None, columnar_path=None, dry_run=False,
+                 checkpoint_size=500000, batch_size=100000, use_arrow=True):
+    """Runs extraction, basin labeling, pruning, binarization and (optionally) the columnar export, skipping every
+    stage whose inputs have not changed since it last finished and resuming extraction from its last committed
+    batch.  Every stage shares one connection to out_path, which is analyzed, vacuumed and closed at the end, or just
+    closed if a stage fails.  With dry_run nothing is touched.  Returns the plan as [(stage, action, reason)]."""
+    in_paths = [in_path] if isinstance(in_path, (str, os.PathLike)) else list(in_path)
+    sources = [(p, l) for p in in_paths for l in (layer_names or list_layers(p))]
+    fingerprints = stage_fingerprints(sources, order_thresh, checkpoint_size, columnar_path)
+    stages, batches = read_state(out_path)
+    plan = plan_pipeline(stages, batches, fingerprints, columnar_path)
+    if dry_run:
+        return plan
+
+    with session(out_path):
+        for name, action, reason in plan:
+            if action == 'skip':
+                continue
+            if name == 'extract':
+                _extract(out_path, sources, fingerprints[name], action == 'resume', checkpoint_size, batch_size, use_arrow)
+                continue
+
+            # Forget this stage and everything after it until it finishes again
+            con = connect(out_path)
+            con.executemany('DELETE FROM pipeline_stages WHERE stage = ?', [(s,) for s in STAGES[STAGES.index(name):]])
+            con.commit()
+            if name == 'label_basins':
+                label_basins_fast(out_path, order_thresh)
+            elif name == 'prune_graph':
+                prune_graph(out_path)
+            elif name == 'enforce_binary':
+                enforce_binary_fast(out_path)
+            elif name == 'columnar':
+                write_columnar(out_path, columnar_path)
+            _mark_complete(con, name, fingerprints[name])
+
+        # Planner statistics and a compact file once anything has been rewritten
+        if any(action != 'skip' for _, action, _ in plan):
+            with stage('finalize'):
+                finalize(out_path)
+    return plan
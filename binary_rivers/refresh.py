@@ -0,0 +1,210 @@
+import os
+import numpy as np
+from .extract_graph import (EDGE_COLS, NODE_COLS, _open_layer, _batch_reader, list_layers, BasinLabeler, find_confluences,
+                            synthetic_reaches, add_synthetic_flag, insert_synthetic, has_upstream_index, build_upstream_index, upstream_totals)
+from .geometry import _mix
+from .graphdb import connect, mark_dirty, session
+from .instrument import stage, watch
+
+
+SOURCE_COLS = EDGE_COLS + NODE_COLS[1:]
+SOURCE_DTYPES = ['INTEGER PRIMARY KEY', 'INTEGER', 'FLOAT', 'FLOAT', 'INTEGER', 'FLOAT', 'FLOAT', 'INTEGER']
+
+
+def row_hashes(rows):
+    """int64 hash of the attributes of every source row (HYRIV_ID, NEXT_DOWN, ..., longitude, latitude), id excluded.
+    NULLs hash like NaN."""
+    data = np.array(rows, dtype=np.float64).reshape(len(rows), len(SOURCE_COLS))
+    bits = np.ascontiguousarray(data[:, 1:]).view(np.uint64)
+    h = np.zeros(len(rows), dtype=np.uint64)
+    for j in range(bits.shape[1]):
+        h = _mix(h ^ bits[:, j]) + np.uint64(j + 1)
+    return h.view(np.int64)
+
+
+def record_source(db_path):
+    """Snapshots the freshly extracted edges and nodes into source_reaches, one hashed row per HydroRIVERS reach, so
+    a later release can be diffed against what graph.db was built from.  Run it before basins are labeled and
+    pruned."""
+    con = connect(db_path)
+    watch(con)
+    cur = con.cursor()
+    with stage('record_source', con=con) as s:
+        rows = cur.execute('SELECT {}, n.longitude, n.latitude FROM edges e JOIN nodes n ON e.hyriv_id = n.hyriv_id'.format(
+            ', '.join(f'e.{c}' for c in EDGE_COLS))).fetchall()
+        cur.execute('DROP TABLE IF EXISTS source_reaches')
+        cur.execute('CREATE TABLE source_reaches ({})'.format(', '.join(f'{c} {d}' for c, d in zip(SOURCE_COLS + ['row_hash'], SOURCE_DTYPES))))
+        cur.executemany('INSERT INTO source_reaches VALUES ({})'.format(', '.join('?' * len(SOURCE_DTYPES))),
+                        (r + (h,) for r, h in zip(rows, row_hashes(rows).tolist())))
+        con.commit()
+        s.add_rows(len(rows))
+
+
+def read_source(in_path, layer_names=None, batch_size=100000, use_arrow=True):
+    """Source rows (EDGE_COLS, then longitude and latitude of the first vertex) of every HydroRIVERS layer in one or
+    more geodatabases, read the way extraction reads them."""
+    in_paths = [in_path] if isinstance(in_path, (str, os.PathLike)) else list(in_path)
+    rows = list()
+    for p in in_paths:
+        for layer_name in (layer_names or list_layers(p)):
+            geodatabase, layer = _open_layer(p, layer_name)
+            for edge_values, node_values in _batch_reader(layer, batch_size, use_arrow):
+                rows.extend(e + n[1:] for e, n in zip(edge_values, node_values))
+    return rows
+
+
+def _labels(con, order_thresh):
+    """hyriv_id (sorted) and basin label of every reach in source_reaches."""
+    rows = con.execute('SELECT hyriv_id, next_down, ord_stra FROM source_reaches ORDER BY hyriv_id').fetchall()
+    ids, next_down, order = zip(*rows) if rows else ([], [], [])
+    labeler = BasinLabeler(ids, next_down, [np.nan if o is None else o for o in order])
+    return labeler.ids, labeler.label(order_thresh)
+
+
+def _lookup(ids, values, query):
+    """values at the positions of query in the sorted ids, -1 where a query id is missing."""
+    query = np.asarray(query, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(ids, query), max(len(ids) - 1, 0))
+    found = ids[pos] == query if len(ids) else np.zeros(len(query), dtype=bool)
+    return np.where(found, values[pos] if len(ids) else -1, -1)
+
+
+def affected_basins(old, new, changed):
+    """Basins whose reaches have to be rebuilt: those any changed reach belonged to before or belongs to now, those
+    named after a changed reach, and both basins of every reach whose label flipped.  Closed over nested basins, whose
+    roots lie inside another basin.  old and new are (sorted ids, labels)."""
+    (old_ids, old_basin), (new_ids, new_basin) = old, new
+    common = np.intersect1d(old_ids, new_ids)
+    before = _lookup(old_ids, old_basin, common)
+    after = _lookup(new_ids, new_basin, common)
+    flipped = before != after
+    roots = np.union1d(old_basin, new_basin)
+    basins = np.concatenate([_lookup(old_ids, old_basin, changed), _lookup(new_ids, new_basin, changed),
+                             before[flipped], after[flipped], np.intersect1d(changed, roots)])
+    basins = set(basins[basins != -1].tolist())
+
+    # A nested basin and the basin its root lies in are rebuilt together
+    roots = roots[roots != -1]
+    outer = np.stack([_lookup(old_ids, old_basin, roots), _lookup(new_ids, new_basin, roots)])
+    while True:
+        marked = np.fromiter(basins, dtype=np.int64, count=len(basins))
+        inside = np.isin(roots, marked)
+        grow = np.concatenate([roots[inside | np.isin(outer, marked).any(axis=0)], outer[:, inside].ravel()])
+        grow = set(grow[grow != -1].tolist())
+        if grow <= basins:
+            break
+        basins |= grow
+    return basins
+
+
+def refresh_rows(db_path, rows, order_thresh, partial=False, deleted=()):
+    """ Brings graph.db up to date with a new set of source rows (see read_source) without rebuilding it.
+
+    rows are diffed against source_reaches by HYRIV_ID and row hash.  Basins are re-labeled for the whole network in
+    memory, but only the basins a change can reach are deleted from edges and nodes, rebuilt from the new source rows
+    and binarized again; everything else is left as it is.  graph.db is expected to be pruned, as the pipeline leaves
+    it.  The rebuilt basins are recorded in dirty_basins as 'new', 'changed' or 'removed' for the metric jobs.  With
+    partial, rows only cover a patched region: reaches missing from them are kept unless listed in deleted.  Synthetic
+    reaches of rebuilt basins get fresh ids, so they differ from the ids a full rebuild would assign.  Returns the
+    counts of inserted, updated and deleted reaches and the rebuilt basins. """
+    con = connect(db_path)
+    watch(con)
+    cur = con.cursor()
+    if 'source_reaches' not in con.tables():
+        raise ValueError(f'{db_path} has no source_reaches snapshot; rebuild it with the pipeline first')
+
+    with stage('refresh_graph', con=con) as s:
+        # Diff
+        new_ids = np.array([r[0] for r in rows], dtype=np.int64)
+        new_hash = row_hashes(rows)
+        old = np.array(cur.execute('SELECT hyriv_id, row_hash FROM source_reaches ORDER BY hyriv_id').fetchall(), dtype=np.int64).reshape(-1, 2)
+        old_hash = _lookup(old[:, 0], old[:, 1], new_ids)
+        known = np.isin(new_ids, old[:, 0])
+        inserted = np.flatnonzero(~known)
+        updated = np.flatnonzero(known & (old_hash != new_hash))
+        gone = np.intersect1d(old[:, 0], np.asarray(deleted, dtype=np.int64)) if partial else np.setdiff1d(old[:, 0], new_ids)
+        changed = np.unique(np.concatenate([new_ids[inserted], new_ids[updated], gone]))
+        for k, v in [('inserted', len(inserted)), ('updated', len(updated)), ('deleted', len(gone))]:
+            s.set(k, v)
+        summary = {'inserted': len(inserted), 'updated': len(updated), 'deleted': len(gone), 'basins': []}
+        if not len(changed):
+            return summary
+
+        # Apply the diff to the snapshot, labeling before and after
+        old_labels = _labels(con, order_thresh)
+        write = np.concatenate([inserted, updated])
+        cur.executemany('INSERT OR REPLACE INTO source_reaches VALUES ({})'.format(', '.join('?' * len(SOURCE_DTYPES))),
+                        (tuple(rows[i]) + (h,) for i, h in zip(write.tolist(), new_hash[write].tolist())))
+        cur.executemany('DELETE FROM source_reaches WHERE hyriv_id = ?', [(i,) for i in gone.tolist()])
+        new_labels = _labels(con, order_thresh)
+        basins = affected_basins(old_labels, new_labels, changed)
+
+        # A new reach may reuse the id of a synthetic reach, whose basin then renumbers its synthetic reaches
+        cur.execute('CREATE TEMP TABLE refresh_ids (hyriv_id INTEGER PRIMARY KEY)')
+        cur.executemany('INSERT INTO refresh_ids VALUES (?)', [(i,) for i in new_ids[inserted].tolist()])
+        basins |= {r[0] for r in cur.execute('SELECT n.basin FROM nodes n JOIN refresh_ids r ON n.hyriv_id = r.hyriv_id').fetchall()}
+        basins.discard(-1)
+        cur.execute('DROP TABLE refresh_ids')
+
+        # Drop the affected basins, synthetic reaches included
+        cur.execute('CREATE TEMP TABLE refresh_basins (basin INTEGER PRIMARY KEY)')
+        cur.executemany('INSERT INTO refresh_basins VALUES (?)', [(b,) for b in basins])
+        cur.execute('DELETE FROM edges WHERE hyriv_id IN (SELECT n.hyriv_id FROM nodes n JOIN refresh_basins b ON n.basin = b.basin)')
+        cur.execute('DELETE FROM nodes WHERE basin IN (SELECT basin FROM refresh_basins)')
+        cur.execute('DROP TABLE refresh_basins')
+
+        # Rebuild them from the new snapshot
+        ids, label = new_labels
+        members = np.isin(label, np.fromiter(basins, dtype=np.int64, count=len(basins)))
+        cur.execute('CREATE TEMP TABLE refresh_members (hyriv_id INTEGER PRIMARY KEY, basin INTEGER)')
+        cur.executemany('INSERT INTO refresh_members VALUES (?, ?)', zip(ids[members].tolist(), label[members].tolist()))
+        source = cur.execute('SELECT {}, m.basin FROM source_reaches r JOIN refresh_members m ON r.hyriv_id = m.hyriv_id ORDER BY r.hyriv_id'.format(
+            ', '.join(f'r.{c}' for c in SOURCE_COLS))).fetchall()
+        cur.execute('DROP TABLE refresh_members')
+        edges = [list(r[:len(EDGE_COLS)]) for r in source]
+        nodes = [(r[0], *r[len(EDGE_COLS):]) for r in source]
+
+        topo, bad = find_confluences(edges)
+        max_id = max(cur.execute('SELECT max(hyriv_id) FROM edges').fetchall()[0][0] or 0,
+                     cur.execute('SELECT max(hyriv_id) FROM nodes').fetchall()[0][0] or 0,
+                     cur.execute('SELECT max(hyriv_id) FROM source_reaches').fetchall()[0][0] or 0)
+        new_edges, new_nodes, moved, created = synthetic_reaches(edges, topo, bad, {n[0]: n for n in nodes}, max_id, basin_col=3)
+        position = {e[0]: i for i, e in enumerate(edges)}
+        for next_down, hyriv_id in moved:
+            edges[position[hyriv_id]][1] = next_down
+        edge_cols = ', '.join(EDGE_COLS)
+        node_cols = ', '.join(NODE_COLS + ['basin'])
+        cur.executemany(f'INSERT INTO edges ({edge_cols}) VALUES ({", ".join("?" * len(EDGE_COLS))})', [tuple(e) for e in edges])
+        add_synthetic_flag(con)
+        insert_synthetic(cur, new_edges)
+        cur.executemany(f'INSERT INTO nodes ({node_cols}) VALUES ({", ".join("?" * (len(NODE_COLS) + 1))})', nodes + new_nodes)
+        s.add_rows(len(edges) + len(new_edges))
+
+        # Tell the metric jobs
+        before = set(old_labels[1].tolist())
+        after = set(label.tolist())
+        mark_dirty(con, {b: 'removed' if b not in after else 'new' if b not in before else 'changed' for b in basins})
+        if 'pipeline_stages' in con.tables():
+            cur.execute("DELETE FROM pipeline_stages WHERE stage = 'columnar'")
+        con.commit()
+        s.set('basins', len(basins))
+
+    # Derived columns cover the whole network, so they are recomputed rather than patched
+    if has_upstream_index(db_path):
+        build_upstream_index(db_path)
+    if 'up_reaches' in con.columns('edges'):
+        upstream_totals(db_path)
+    summary['basins'] = sorted(basins)
+    return summary
+
+
+def refresh_graph(in_path, db_path, order_thresh=5, layer_names=None, partial=False, deleted=(), batch_size=100000, use_arrow=True):
+    """ Incremental counterpart of the pipeline for a new or corrected HydroRIVERS release: reads the layers and
+    applies them to graph.db with refresh_rows.  For a regional patch, pass only that region's layers with partial=True
+    and the ids the patch removes as deleted.  graph.db must have been built by the pipeline, which records the
+    source_reaches snapshot. """
+    with stage('read_source') as s:
+        rows = read_source(in_path, layer_names, batch_size, use_arrow)
+        s.add_rows(len(rows))
+    with session(db_path):
+        return refresh_rows(db_path, rows, order_thresh, partial, deleted)
@@ -0,0 +1,147 @@
+import numpy as np
+import sqlite3
+
+
+NETWORK_FIELDS = ['HYRIV_ID', 'NEXT_DOWN', 'UPLAND_SKM', 'ORD_STRA']
+BASIN_FIELDS = ['basin', '_basin']
+
+
+def _layer_info(con, layer=None):
+    """Feature table, geometry column and R-tree table of a GeoPackage layer (the first one by default)."""
+    rows = con.execute("SELECT c.table_name, g.column_name FROM gpkg_contents c JOIN gpkg_geometry_columns g ON c.table_name = g.table_name WHERE c.data_type = 'features'").fetchall()
+    if layer is not None:
+        rows = [r for r in rows if r[0] == layer]
+    if not rows:
+        raise ValueError(f'No feature layer {layer} found')
+    table, geom_col = rows[0]
+    rtree = f'rtree_{table}_{geom_col}'
+    if not con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchall():
+        rtree = None
+    fid_col = [r[1] for r in con.execute(f'PRAGMA table_info("{table}")').fetchall() if r[5]][0]
+    return table, geom_col, fid_col, rtree
+
+
+def _basin_field(con, table):
+    columns = [r[1] for r in con.execute(f'PRAGMA table_info("{table}")').fetchall()]
+    return next((c for c in BASIN_FIELDS if c in columns), None)
+
+
+def index_geopackage(path, layer=None, from_field='HYRIV_ID', to_field='NEXT_DOWN'):
+    """Adds the attribute indexes selection relies on: reach id, downstream id and (when present) basin."""
+    con = sqlite3.connect(path)
+    try:
+        table, _, _, _ = _layer_info(con, layer)
+        fields = [from_field, to_field]
+        basin_field = _basin_field(con, table)
+        if basin_field is not None:
+            fields.append(basin_field)
+        for f in fields:
+            con.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{f}" ON "{table}" ("{f}")')
+        con.commit()
+    finally:
+        con.close()
+
+
+def _bbox_fids(con, table, rtree, fid_col, geom_col, bbox):
+    minx, miny, maxx, maxy = bbox
+    if rtree is None:
+        raise ValueError(f'{table} has no R-tree index on {geom_col}')
+    return [r[0] for r in con.execute(f'SELECT id FROM "{rtree}" WHERE maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ?', (minx, maxx, miny, maxy)).fetchall()]
+
+
+def _upstream_fids(con, table, fid_col, outlet, from_field, to_field):
+    return [r[0] for r in con.execute(f'''
+        WITH RECURSIVE upstream(id) AS (
+            SELECT ?
+            UNION ALL
+            SELECT t."{from_field}" FROM "{table}" t JOIN upstream u ON t."{to_field}" = u.id
+        )
+        SELECT t."{fid_col}" FROM "{table}" t JOIN upstream u ON t."{from_field}" = u.id
+    ''', (int(outlet),)).fetchall()]
+
+
+def nearest_reach(path, point, layer=None, from_field='HYRIV_ID', search=0.01):
+    """HYRIV_ID of the reach closest to point (x, y).  R-tree boxes double in size until one hits; since a box hit
+    need not be the nearest reach, the square reaching as far as the closest hit is then searched once more."""
+    import geopandas as gpd
+    import shapely
+
+    x, y = point
+    target = shapely.Point(x, y)
+
+    def closest(fids):
+        gdf = gpd.read_file(path, layer=table, fids=sorted(fids), columns=[from_field])
+        distance = shapely.distance(gdf.geometry.values, target)
+        best = np.argmin(distance)
+        return gdf[from_field].values[best], distance[best]
+
+    con = sqlite3.connect(path)
+    try:
+        table, geom_col, fid_col, rtree = _layer_info(con, layer)
+        fids = []
+        extent = con.execute('SELECT max_x - min_x, max_y - min_y FROM gpkg_contents WHERE table_name = ?', (table,)).fetchall()[0]
+        limit = max([e for e in extent if e is not None], default=360)
+        while not fids and search <= 2 * limit:
+            fids = _bbox_fids(con, table, rtree, fid_col, geom_col, (x - search, y - search, x + search, y + search))
+            search *= 2
+        if not fids:
+            raise ValueError(f'No reach found near {point}')
+        # Any reach closer than the best hit has its box inside this square
+        _, radius = closest(fids)
+        fids = _bbox_fids(con, table, rtree, fid_col, geom_col, (x - radius, y - radius, x + radius, y + radius))
+    finally:
+        con.close()
+    return closest(fids)[0]
+
+
+def read_packed(con, table, geom_col, fid_col, fids, columns, dtype=np.float64):
+    """Attribute columns as a DataFrame plus a CoordinateStore parsed straight from the GeoPackage geometry blobs of
+    the given feature ids, in fid order.  No geometry objects are created."""
+    import pandas as pd
+    from .geometry import CoordinateStore
+
+    con.execute('CREATE TEMP TABLE selected (fid INTEGER PRIMARY KEY)')
+    con.executemany('INSERT INTO selected VALUES (?)', [(int(f),) for f in fids])
+    fields = ', '.join(f't."{c}"' for c in [*columns, geom_col])
+    rows = con.execute(f'SELECT {fields} FROM "{table}" t JOIN selected s ON t."{fid_col}" = s.fid ORDER BY s.fid').fetchall()
+    con.execute('DROP TABLE selected')
+    df = pd.DataFrame([r[:-1] for r in rows], columns=list(columns))
+    return df, CoordinateStore.from_wkb([r[-1] for r in rows], dtype)
+
+
+def select_reaches(path, basin=None, outlet=None, point=None, bbox=None, layer=None, columns=NETWORK_FIELDS,
+                   from_field='HYRIV_ID', to_field='NEXT_DOWN', packed=False, coord_dtype=np.float64):
+    """Reads only the reaches of one basin id, everything draining through an outlet HYRIV_ID (the outlet included),
+    everything draining through the reach nearest a point, or every reach whose bounding box meets a bbox
+    (minx, miny, maxx, maxy).  Matching feature ids come from the R-tree or, once index_geopackage has been run on
+    the file, from the basin/downstream attribute indexes, so the cost depends on the size of the selection and not
+    of the GeoPackage; only columns and the geometry are read.  Rows keep their order in the file, so Network sees
+    them exactly as it would in the full dataset.  With packed, returns a DataFrame and a CoordinateStore read from
+    the geometry blobs instead of a GeoDataFrame, ready for Network(df, coords=store)."""
+    import geopandas as gpd
+
+    if sum(s is not None for s in (basin, outlet, point, bbox)) != 1:
+        raise ValueError('Give exactly one of basin, outlet, point or bbox')
+    if point is not None:
+        outlet = nearest_reach(path, point, layer, from_field)
+
+    con = sqlite3.connect(path)
+    try:
+        table, geom_col, fid_col, rtree = _layer_info(con, layer)
+        if basin is not None:
+            basin_field = _basin_field(con, table)
+            if basin_field is None:
+                raise ValueError(f'{table} has no basin column')
+            fids = [r[0] for r in con.execute(f'SELECT "{fid_col}" FROM "{table}" WHERE "{basin_field}" = ?', (int(basin),)).fetchall()]
+        elif outlet is not None:
+            fids = _upstream_fids(con, table, fid_col, outlet, from_field, to_field)
+        else:
+            fids = _bbox_fids(con, table, rtree, fid_col, geom_col, bbox)
+
+        if not fids:
+            raise ValueError('No reaches match the selection')
+        if packed:
+            return read_packed(con, table, geom_col, fid_col, sorted(fids), columns, coord_dtype)
+    finally:
+        con.close()
+    return gpd.read_file(path, layer=table, fids=sorted(fids), columns=list(columns))
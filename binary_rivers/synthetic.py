@@ -0,0 +1,214 @@
+import numpy as np
+import sqlite3
+import os
+from .topology import Topology, accumulate, strahler
+
+
+def random_tree(n_leaves, seed=0):
+    """Random binary tree grown by splitting a uniformly chosen leaf until there are n_leaves leaves."""
+    rng = np.random.default_rng(seed)
+    n = 2 * n_leaves - 1
+    next_down = np.zeros(n, dtype=np.int64)
+    leaves = np.zeros(n_leaves, dtype=np.int64)
+    picks = rng.random(n_leaves)
+    n_nodes = 1
+    for k in range(1, n_leaves):
+        i = int(picks[k] * k)
+        split = leaves[i]
+        next_down[n_nodes] = split + 1
+        next_down[n_nodes + 1] = split + 1
+        leaves[i] = n_nodes
+        leaves[k] = n_nodes + 1
+        n_nodes += 2
+    return np.arange(1, n + 1, dtype=np.int64), next_down
+
+
+def balanced_tree(n_leaves):
+    """Complete binary tree in heap layout: reach i drains into reach i // 2 and reach 1 is the outlet."""
+    ids = np.arange(1, 2 * n_leaves, dtype=np.int64)
+    return ids, ids // 2
+
+
+def tokunaga_tree(order, a=1.0, c=2.0, seed=0):
+    """Deterministic Tokunaga self-similar tree: a stream of order k carries round(a * c ** (j - 1)) side tributaries
+    of order k - j for every j, placed in a seeded random order along its length."""
+    rng = np.random.default_rng(seed)
+    next_down = [0]
+
+    def branch(k, outlet):
+        # The outlet reach is the most downstream segment of this stream; side tributaries join going upstream
+        sides = [k - j for j in range(1, k) for _ in range(int(round(a * c ** (j - 1))))]
+        rng.shuffle(sides)
+        cur = outlet
+        for side in sides:
+            next_down.append(cur + 1)
+            upper = len(next_down) - 1
+            next_down.append(cur + 1)
+            branch(side, len(next_down) - 1)
+            cur = upper
+        if k > 1:
+            for _ in range(2):
+                next_down.append(cur + 1)
+                branch(k - 1, len(next_down) - 1)
+
+    branch(order, 0)
+    next_down = np.array(next_down, dtype=np.int64)
+    return np.arange(1, len(next_down) + 1, dtype=np.int64), next_down
+
+
+def random_tokunaga_tree(order, a=1.0, c=2.0, gamma=1.0, seed=0):
+    """Random self-similar tree from the hierarchical branching process of Kovchegov et al. (2022).
+
+    A branch of order k carries side tributaries of order k - j in proportion to the Tokunaga coefficients
+    T_j = a * c ** (j - 1) until it terminates; an order k > 1 branch then splits into two of order k - 1.  The number
+    of side tributaries is geometric with mean sum(T_j), their orders and positions are random, and every reach on an
+    order k branch gets an exponential length with mean c ** (k - 1) / (gamma * (1 + sum(T_j))).  Branches of one
+    order are all grown at once, so trees with millions of leaves take seconds.  Returns ids, next_down and length.
+    """
+    rng = np.random.default_rng(seed)
+    next_down = [np.zeros(0, dtype=np.int64)]
+    length = [np.zeros(0)]
+    n_reaches = 0
+    pending = {order: [np.zeros(1, dtype=np.int64)]}  # ids the branches of each order drain into
+    for k in range(order, 0, -1):
+        down = np.concatenate(pending.pop(k, [np.zeros(0, dtype=np.int64)]))
+        if not len(down):
+            continue
+        tokunaga = a * c ** np.arange(k - 1)  # T_1 .. T_{k-1}
+        total = tokunaga.sum()
+
+        # Side tributaries per branch, then one reach per side tributary plus the terminal reach
+        n_sides = rng.geometric(1 / (1 + total), len(down)) - 1
+        counts = n_sides + 1
+        starts = n_reaches + 1 + np.concatenate([[0], np.cumsum(counts)[:-1]])
+        ids = np.arange(n_reaches + 1, n_reaches + 1 + counts.sum(), dtype=np.int64)
+        branch = np.repeat(np.arange(len(down)), counts)
+        first = ids == starts[branch]
+        next_down.append(np.where(first, down[branch], ids - 1))
+        length.append(rng.exponential(c ** (k - 1) / (gamma * (1 + total)), len(ids)))
+        n_reaches += len(ids)
+
+        # Side tributary j of a branch joins at the top of its j-th reach; the terminal reach is the last one
+        is_last = np.append(first[1:], True)
+        joins = ids[~is_last]
+        if len(joins):
+            side_orders = k - 1 - rng.choice(k - 1, size=len(joins), p=tokunaga / total)
+            for i in np.unique(side_orders):
+                pending.setdefault(i, []).append(joins[side_orders == i])
+        if k > 1:
+            pending.setdefault(k - 1, []).append(np.repeat(ids[is_last], 2))
+    return np.arange(1, n_reaches + 1, dtype=np.int64), np.concatenate(next_down), np.concatenate(length)
+
+
+def critical_tokunaga_tree(order, c=2.0, gamma=1.0, seed=0):
+    """The critical Tokunaga model: T_j = (c - 1) * c ** (j - 1).  c = 2 is the critical binary Galton-Watson tree."""
+    return random_tokunaga_tree(order, a=c - 1, c=c, gamma=gamma, seed=seed)
+
+
+def make_tree(kind, n_reaches, seed=0, a=1.0, c=2.0):
+    """Builds a tree of the given kind ('random', 'balanced', 'tokunaga' or 'critical') with about n_reaches
+    reaches."""
+    if kind == 'random':
+        return random_tree(max(1, (n_reaches + 1) // 2), seed)
+    if kind == 'balanced':
+        return balanced_tree(max(1, (n_reaches + 1) // 2))
+    if kind == 'tokunaga':
+        order = 1
+        while True:
+            ids, next_down = tokunaga_tree(order, a, c, seed)
+            if len(ids) >= n_reaches:
+                return ids, next_down
+            order += 1
+    if kind == 'critical':
+        order = 1
+        while True:
+            ids, next_down, _ = critical_tokunaga_tree(order, c, seed=seed)
+            if len(ids) >= n_reaches:
+                return ids, next_down
+            order += 1
+    raise ValueError(f'Unknown tree kind: {kind}')
+
+
+def add_multi_confluences(ids, next_down, fraction=0.05, seed=0):
+    """Removes a fraction of interior reaches and drains their tributaries into the reach below, producing the
+    three-way confluences that enforcce_binary has to repair."""
+    rng = np.random.default_rng(seed)
+    topo = Topology(ids, next_down)
+    counts = topo.n_children()[:topo.n_edges]
+    parent = topo.parent[:topo.n_edges]
+    candidates = np.flatnonzero((counts == 2) & (parent < topo.n_edges))
+    chosen = rng.choice(candidates, size=int(len(candidates) * fraction), replace=False) if len(candidates) else candidates
+
+    # Keep at most one removal per receiving reach, and never remove a reach that receives another removal
+    chosen = chosen[np.unique(parent[chosen], return_index=True)[1]]
+    chosen = chosen[~np.isin(chosen, parent[chosen])]
+    next_down = next_down.copy()
+    moved = np.isin(parent, chosen)
+    next_down[moved] = next_down[parent[moved]]
+    keep = np.ones(len(ids), dtype=bool)
+    keep[chosen] = False
+    return ids[keep], next_down[keep]
+
+
+def layout(ids, next_down, seed=0, vertices=5, spread=np.pi / 3, scale=0.02):
+    """Lays the tree out in the plane and returns one (vertices, 2) polyline per reach, drawn upstream to downstream."""
+    rng = np.random.default_rng(seed)
+    topo = Topology(ids, next_down)
+    n = len(topo.ids)
+    heading = np.full(n, np.pi / 2)
+    top = np.zeros((n, 2))
+    bottom = np.zeros((n, 2))
+    length = rng.exponential(scale, n) + scale / 10
+
+    for lvl in topo.levels[1:]:
+        par = topo.parent[lvl]
+        heading[lvl] = heading[par] + rng.uniform(-spread, spread, len(lvl))
+        bottom[lvl] = top[par]
+        top[lvl] = bottom[lvl] + length[lvl, None] * np.column_stack([np.cos(heading[lvl]), np.sin(heading[lvl])])
+
+    # Interior vertices wiggle perpendicular to the chord
+    t = np.linspace(0, 1, vertices)
+    wiggle = rng.normal(0, 0.15, (n, vertices)) * np.sin(np.pi * t)
+    normal = np.column_stack([-np.sin(heading), np.cos(heading)])
+    chord = bottom - top
+    lines = top[:, None, :] + t[None, :, None] * chord[:, None, :] + (wiggle * length[:, None])[:, :, None] * normal[:, None, :]
+    return lines[:topo.n_edges]
+
+
+def to_geodataframe(ids, next_down, seed=0, vertices=5):
+    """Synthetic reaches with the columns Network expects: HYRIV_ID, NEXT_DOWN, LENGTH_KM, UPLAND_SKM, ORD_STRA."""
+    import geopandas as gpd
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    lines = layout(ids, next_down, seed, vertices)
+    geometry = shapely.linestrings(lines.reshape(-1, 2), indices=np.repeat(np.arange(len(ids)), vertices))
+
+    topo = Topology(ids, next_down)
+    catchment = rng.uniform(1, 20, topo.n_edges)
+    upland = accumulate(topo, catchment)[:topo.n_edges]
+    order = strahler(topo)[:topo.n_edges]
+    return gpd.GeoDataFrame({
+        'HYRIV_ID': ids,
+        'NEXT_DOWN': next_down,
+        'LENGTH_KM': np.round(shapely.length(geometry) * 111, 2),
+        'UPLAND_SKM': np.round(upland, 1),
+        'ORD_STRA': order,
+    }, geometry=geometry, crs='EPSG:4326')
+
+
+def to_graph_db(gdf, db_path):
+    """Writes synthetic reaches with the same edges/nodes schema extract_graph produces."""
+    import shapely
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    first = shapely.get_coordinates(shapely.get_point(gdf.geometry.values, 0))
+    con = sqlite3.connect(db_path)
+    cur = con.cursor()
+    cur.execute('CREATE TABLE edges (HYRIV_ID INTEGER PRIMARY KEY, NEXT_DOWN INTEGER, LENGTH_KM FLOAT, UPLAND_SKM FLOAT, ORD_STRA INTEGER)')
+    cur.execute('CREATE TABLE nodes (HYRIV_ID INTEGER PRIMARY KEY, longitude FLOAT, latitude FLOAT)')
+    cur.executemany('INSERT INTO edges VALUES (?, ?, ?, ?, ?)', zip(*[gdf[c].tolist() for c in ['HYRIV_ID', 'NEXT_DOWN', 'LENGTH_KM', 'UPLAND_SKM', 'ORD_STRA']]))
+    cur.executemany('INSERT INTO nodes VALUES (?, ?, ?)', zip(gdf['HYRIV_ID'].tolist(), first[:, 0].tolist(), first[:, 1].tolist()))
+    con.commit()
+    con.close()
@@ -0,0 +1,373 @@
+import numpy as np
+
+
+class Topology:
+    """Integer-indexed river tree with a parent array, CSR child lists and a precomputed post-order.
+
+    Nodes are every reach in ids plus every next_down target that is not itself a reach (the virtual outlet nodes
+    that Network has always treated as roots).  Children of a node are ordered the same way Network.edge_dict used
+    to order them: a child with a strictly higher priority than the current first child moves to the front,
+    anything else is appended.
+    """
+
+    def __init__(self, ids, next_down, priority=None, roots=None):
+        ids = np.asarray(ids)
+        next_down = np.asarray(next_down)
+        self.n_edges = len(ids)
+
+        # Index nodes
+        targets = next_down if roots is None else np.concatenate([next_down, np.asarray(roots, dtype=next_down.dtype)])
+        extra = np.setdiff1d(targets, ids)
+        self.ids = np.concatenate([ids, extra])
+        n = len(self.ids)
+        self._sorter = np.argsort(self.ids, kind='stable')
+        self.parent = np.full(n, -1, dtype=np.int64)
+        self.parent[:self.n_edges] = self.index_of(next_down)
+
+        # CSR children
+        par = self.parent[:self.n_edges]
+        order = np.argsort(par, kind='stable')
+        if priority is not None and len(order):
+            order = _priority_order(order, par[order], np.asarray(priority)[order])
+        self.children = order
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(par, minlength=n), out=self.child_offsets[1:])
+
+        # Traversal schedule
+        if roots is None:
+            self.roots = np.flatnonzero(self.parent == -1)
+        else:
+            self.roots = self.index_of(roots)
+        self._build_levels()
+
+    def index_of(self, node_ids):
+        """Maps node ids to integer node indices."""
+        node_ids = np.asarray(node_ids)
+        pos = np.searchsorted(self.ids, node_ids, sorter=self._sorter)
+        pos = np.minimum(pos, len(self.ids) - 1)
+        idx = self._sorter[pos]
+        if np.any(self.ids[idx] != node_ids):
+            raise KeyError('Unknown node id')
+        return idx
+
+    def n_children(self, nodes=None):
+        if nodes is None:
+            return np.diff(self.child_offsets)
+        return self.child_offsets[np.asarray(nodes) + 1] - self.child_offsets[nodes]
+
+    def gather_children(self, nodes):
+        """Returns the children of nodes, grouped by parent, plus the start of each non-empty group."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.child_offsets[nodes]
+        counts = self.child_offsets[nodes + 1] - starts
+        group_starts = np.zeros(len(nodes), dtype=np.int64)
+        np.cumsum(counts[:-1], out=group_starts[1:])
+        total = counts.sum()
+        idx = np.arange(total, dtype=np.int64) + np.repeat(starts - group_starts, counts)
+        return self.children[idx], group_starts[counts > 0]
+
+    def first_child(self, nodes, k=0):
+        """Returns the k-th priority child of nodes, -1 where there is none."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        has = self.n_children(nodes) > k
+        out = np.full(len(nodes), -1, dtype=np.int64)
+        out[has] = self.children[self.child_offsets[nodes[has]] + k]
+        return out
+
+    def intervals(self):
+        """DFS entry/exit numbers: node b is upstream of node a exactly when tin[a] < tin[b] <= tout[a]."""
+        return self.pre, self.pre + self.size - 1
+
+    def is_upstream(self, a, b):
+        """True where node a is strictly upstream of node b."""
+        tin, tout = self.intervals()
+        return (tin[b] < tin[a]) & (tin[a] <= tout[b])
+
+    def _build_levels(self):
+        """Breadth-first levels from the roots, then a post-order permutation derived from subtree sizes."""
+        n = len(self.ids)
+        self.levels = []
+        self.level = np.full(n, -1, dtype=np.int64)
+        frontier = self.roots
+        seen = 0
+        while len(frontier):
+            seen += len(frontier)
+            if seen > n:
+                raise ValueError('Cycle found in network')
+            self.level[frontier] = len(self.levels)
+            self.levels.append(frontier)
+            frontier = self.gather_children(frontier)[0]
+        self.reached = self.level >= 0
+
+        # Subtree sizes, bottom-up
+        size = np.ones(n, dtype=np.int64)
+        for lvl in reversed(self.levels[1:]):
+            np.add.at(size, self.parent[lvl], size[lvl])
+        self.size = size
+
+        # Pre-order numbers, top-down; children are visited in priority order
+        pre = np.full(n, -1, dtype=np.int64)
+        pre[self.roots] = np.cumsum(size[self.roots]) - size[self.roots]
+        for lvl in self.levels[:-1]:
+            ch, group_starts = self.gather_children(lvl)
+            if not len(ch):
+                continue
+            sizes = size[ch]
+            excl = np.cumsum(sizes) - sizes
+            group_id = np.zeros(len(ch), dtype=np.int64)
+            group_id[group_starts[1:]] = 1
+            group_id = np.cumsum(group_id)
+            excl -= excl[group_starts][group_id]
+            pre[ch] = pre[self.parent[ch]] + 1 + excl
+        self.pre = pre
+
+        post = np.full(n, -1, dtype=np.int64)
+        post[self.reached] = (pre - self.level + size - 1)[self.reached]
+        self.post = post
+        self.post_order = np.empty(self.reached.sum(), dtype=np.int64)
+        self.post_order[post[self.reached]] = np.flatnonzero(self.reached)
+
+
+def _priority_order(order, par, priority):
+    """Reorders children within each parent exactly as the old edge_dict insert/append rule did.  NaN priorities
+    compare false, as they did there: a NaN child never moves to the front, and one that arrives first stays there."""
+    priority = np.asarray(priority, dtype=np.float64)
+    missing = np.isnan(priority)
+    _, rank = np.unique(np.where(missing, -np.inf, priority), return_inverse=True)
+    key = par.astype(np.int64) * (len(priority) + 1) + rank
+    running = np.maximum.accumulate(key)
+    prev = np.concatenate([[-1], running[:-1]])
+
+    # Position of every child within its parent's group, in row order
+    new_group = np.concatenate([[True], par[1:] != par[:-1]])
+    group_start = np.flatnonzero(new_group)
+    group_id = np.cumsum(new_group) - 1
+    pos = np.arange(len(par)) - group_start[group_id]
+    record = (key > prev) & (new_group | ~missing[group_start][group_id])
+
+    # Records end up at the front in reverse order of arrival, everything else follows in arrival order
+    sort_key = np.where(record, -pos, pos + len(par))
+    return order[np.lexsort((sort_key, par))]
+
+
+def tree_metrics(topo, orientation):
+    """Depth, leaves, cum_depth, ave_depth, balance_factor and tja for every reached node in one bottom-up sweep."""
+    n = len(topo.ids)
+    depth = np.full(n, np.nan)
+    leaves = np.full(n, np.nan)
+    cum_depth = np.full(n, np.nan)
+    for lvl in reversed(topo.levels):
+        counts = topo.n_children(lvl)
+        leaf = lvl[counts == 0]
+        depth[leaf] = 0
+        leaves[leaf] = 1
+        cum_depth[leaf] = 0
+        internal = lvl[counts > 0]
+        if not len(internal):
+            continue
+        ch, group_starts = topo.gather_children(internal)
+        depth[internal] = np.maximum.reduceat(depth[ch], group_starts) + 1
+        leaves[internal] = np.add.reduceat(leaves[ch], group_starts)
+        cum_depth[internal] = np.add.reduceat(cum_depth[ch], group_starts) + leaves[internal]
+
+    with np.errstate(invalid='ignore'):
+        ave_depth = cum_depth / leaves
+
+    # Balance and junction angle come from the first two children in priority order
+    nodes = np.flatnonzero(topo.reached)
+    c0 = topo.first_child(nodes, 0)
+    c1 = topo.first_child(nodes, 1)
+    binary = c1 >= 0
+    balance_factor = np.full(n, np.nan)
+    balance_factor[nodes[topo.n_children(nodes) == 0]] = 0
+    balance_factor[nodes[binary]] = depth[c0[binary]] - depth[c1[binary]]
+    tja = np.full(n, np.nan)
+    tmp = np.abs(orientation[c0[binary]] - orientation[c1[binary]])
+    tja[nodes[binary]] = np.where(tmp > 180, 360 - tmp, tmp)
+
+    return {
+        'depth': depth,
+        'leaves': leaves,
+        'balance_factor': balance_factor,
+        'cum_depth': cum_depth,
+        'ave_depth': ave_depth,
+        'tja': tja,
+    }
+
+
+def junction_angles(topo, head, tail):
+    """Angles at every confluence from the end tangents of the reaches (arrays over edges, see end_tangents).
+
+    tja is the angle between the first two tributaries in priority order as they arrive (the same pair tree_metrics
+    uses), receiving is the direction the receiving reach leaves the confluence (NaN below an outlet), and
+    deflection_0/1 are how far each tributary turns to follow it (0 for a straight continuation).  Returns arrays
+    over confluence node indices, plus those indices as 'node'.
+    """
+    nodes = np.flatnonzero(topo.n_children() >= 2)
+    c0 = topo.first_child(nodes, 0)
+    c1 = topo.first_child(nodes, 1)
+    tail = np.asarray(tail, dtype=np.float64)
+    receiving = np.full(len(nodes), np.nan)
+    real = nodes < topo.n_edges
+    receiving[real] = np.asarray(head, dtype=np.float64)[nodes[real]]
+
+    def fold(a, b):
+        d = np.abs(a - b) % 360
+        return np.where(d > 180, 360 - d, d)
+
+    return {
+        'node': nodes,
+        'tja': fold(tail[c0], tail[c1]),
+        'receiving': receiving,
+        'deflection_0': fold(tail[c0], receiving),
+        'deflection_1': fold(tail[c1], receiving),
+    }
+
+
+def trunk(topo, depth):
+    """Flags the path from each root that always steps into the deeper of the first two children."""
+    c0 = topo.first_child(np.arange(len(topo.ids)), 0)
+    c1 = topo.first_child(np.arange(len(topo.ids)), 1)
+    favored = np.where((c1 < 0) | (depth[np.maximum(c0, 0)] > depth[np.maximum(c1, 0)]), c0, c1)
+    out = np.zeros(len(topo.ids), dtype=np.int64)
+    for node in topo.roots:
+        while favored[node] >= 0:
+            out[node] = 1
+            node = favored[node]
+    return out
+
+
+ACCUMULATORS = {'sum': (np.add, 0.0), 'max': (np.maximum, -np.inf), 'min': (np.minimum, np.inf)}
+
+
+def accumulate(topo, values, how='sum'):
+    """Combines values over every node and everything upstream of it ('sum', 'max' or 'min') in one bottom-up sweep.
+    values may be 2-D (one column per attribute); nodes past len(values) start from the identity of how."""
+    ufunc, identity = ACCUMULATORS[how]
+    out = np.array(values, dtype=np.float64, copy=True)
+    if len(out) < len(topo.ids):
+        out = np.concatenate([out, np.full((len(topo.ids) - len(out),) + out.shape[1:], identity)])
+    for lvl in reversed(topo.levels[:-1]):
+        internal = lvl[topo.n_children(lvl) > 0]
+        if not len(internal):
+            continue
+        ch, group_starts = topo.gather_children(internal)
+        out[internal] = ufunc(out[internal], ufunc.reduceat(out[ch], group_starts, axis=0))
+    return out
+
+
+def accumulate_columns(topo, columns, how='sum'):
+    """accumulate for several attributes at once.  columns is {name: values}, how is one method or {name: method};
+    columns sharing a method are swept together as one 2-D array.  Returns {name: values over every node}."""
+    methods = {c: how if isinstance(how, str) else how[c] for c in columns}
+    out = dict()
+    for m in sorted(set(methods.values())):
+        names = [c for c in columns if methods[c] == m]
+        stacked = accumulate(topo, np.column_stack([np.asarray(columns[c], dtype=np.float64) for c in names]), m)
+        out.update({c: stacked[:, i] for i, c in enumerate(names)})
+    return {c: out[c] for c in columns}
+
+
+def local_values(topo, totals, synthetic=None):
+    """Inverts accumulate('sum'): what each reach adds on top of its tributaries' totals.  Synthetic reaches add
+    nothing, and a real reach's tributaries are looked up through any synthetic reaches between them, so totals of
+    real reaches that predate the synthetic ones are reproduced exactly by accumulate(topo, local_values(...))."""
+    totals = np.asarray(totals, dtype=np.float64)
+    n = len(topo.ids)
+    synthetic = np.zeros(n, dtype=bool) if synthetic is None else np.concatenate([synthetic, np.zeros(n - len(synthetic), dtype=bool)])
+    seen = np.zeros(n)  # totals of the nearest real reaches at or above each node
+    upstream = np.zeros(n)
+    seen[:len(totals)] = totals
+    for lvl in reversed(topo.levels[:-1]):
+        internal = lvl[topo.n_children(lvl) > 0]
+        if not len(internal):
+            continue
+        ch, group_starts = topo.gather_children(internal)
+        upstream[internal] = np.add.reduceat(seen[ch], group_starts)
+        seen[internal] = np.where(synthetic[internal], upstream[internal], seen[internal])
+    local = np.where(synthetic, 0.0, seen - upstream)
+    return local[:len(totals)]
+
+
+def _strahler_sweep(topo):
+    """Strahler order of every reached node, plus the highest tributary order at every node (0 at leaves)."""
+    order = np.zeros(len(topo.ids), dtype=np.int64)
+    top = np.zeros(len(topo.ids), dtype=np.int64)
+    for lvl in reversed(topo.levels):
+        counts = topo.n_children(lvl)
+        order[lvl[counts == 0]] = 1
+        internal = lvl[counts > 0]
+        if not len(internal):
+            continue
+        ch, group_starts = topo.gather_children(internal)
+        top[internal] = np.maximum.reduceat(order[ch], group_starts)
+        group_id = np.repeat(np.arange(len(internal)), topo.n_children(internal))
+        n_top = np.add.reduceat((order[ch] == top[internal][group_id]).astype(np.int64), group_starts)
+        order[internal] = np.where(n_top > 1, top[internal] + 1, top[internal])
+    return order, top
+
+
+def strahler(topo):
+    """Horton-Strahler order of every reached node: leaves are 1, and the order goes up by one where the two highest
+    tributary orders are equal."""
+    return _strahler_sweep(topo)[0]
+
+
+def horton_tokunaga(topo, length=None):
+    """Horton-Strahler orders and branch statistics of every tree in topo from one bottom-up sweep.
+
+    A branch is a maximal run of reaches of the same order; its head is the reach that drains into a reach of
+    another order (or into an outlet).  A branch of order i is a side branch of an order k branch when it joins at a
+    confluence whose highest tributary order is above i.  Returns a dict with
+
+      order        Strahler order per node
+      counts       N_k, the number of branches of order k = 1 .. K (index k - 1)
+      side_counts  N_ik, side branches of order i joining branches of order k (indexed [i - 1, k - 1])
+      tokunaga     T_ik = N_ik / N_k
+      tokunaga_j   T_j, side branches per branch j orders lower, pooled over k
+      bifurcation  R_B(k) = N_k / N_k+1
+      length       mean branch length per order and length_ratio L_k+1 / L_k (when length is given)
+    """
+    order, top = _strahler_sweep(topo)
+    n = topo.n_edges
+    edges = np.flatnonzero(topo.reached[:n])
+    o = order[edges]
+    par = topo.parent[edges]
+    real = par < n
+    head = ~real | (order[np.where(real, par, 0)] != o)
+    side = head & real & (o < top[np.where(real, par, 0)])
+    k_max = int(o.max()) if len(o) else 0
+
+    counts = np.bincount(o[head] - 1, minlength=k_max).astype(np.float64)
+    side_counts = np.zeros((k_max, k_max))
+    np.add.at(side_counts, (o[side] - 1, order[par[side]] - 1), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tokunaga = side_counts / counts[None, :]
+        bifurcation = counts[:-1] / counts[1:]
+        tokunaga_j = np.array([np.trace(side_counts, offset=j) / counts[j:].sum() for j in range(1, k_max)])
+
+    out = {
+        'order': order,
+        'counts': counts,
+        'side_counts': side_counts,
+        'tokunaga': tokunaga,
+        'tokunaga_j': tokunaga_j,
+        'bifurcation': bifurcation,
+    }
+    if length is not None:
+        total = np.bincount(o - 1, weights=np.asarray(length, dtype=np.float64)[edges], minlength=k_max)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out['length'] = total / counts
+            out['length_ratio'] = out['length'][1:] / out['length'][:-1]
+    return out
+
+
+def fit_tokunaga(tokunaga_j, weights=None):
+    """Least-squares fit of T_j = a * c ** (j - 1) on log T_j; returns (a, c)."""
+    j = np.arange(1, len(tokunaga_j) + 1)
+    ok = np.isfinite(tokunaga_j) & (np.asarray(tokunaga_j) > 0)
+    if ok.sum() < 2:
+        return np.nan, np.nan
+    w = None if weights is None else np.asarray(weights)[ok]
+    slope, intercept = np.polyfit(j[ok] - 1, np.log(np.asarray(tokunaga_j)[ok]), 1, w=w)
+    return np.exp(intercept), np.exp(slope)
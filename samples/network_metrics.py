@@ -3,12 +3,12 @@ import sys
 import os
 base_dir = str(Path(__file__).parents[1])
 sys.path.append(base_dir)
-import geopandas as gpd
 from binary_rivers.metrics import Network
+from binary_rivers.selection import select_reaches
 
 # Load geospatial data for network
 in_path = os.path.join(base_dir, 'data', 'connecticut.gpkg')
-gdf = gpd.read_file(in_path)
+gdf = select_reaches(in_path, basin=70519135)  # only the reaches and fields this basin's Network needs
 
 # Create network object
 network = Network(gdf)
@@ -3,14 +3,24 @@ import sys
 import os
 base_dir = str(Path(__file__).parents[1])
 sys.path.append(base_dir)
-from binary_rivers.extract_graph import *
+from binary_rivers.pipeline import run_pipeline
+from binary_rivers.instrument import Instrumentation, PrintLogger, set_instrumentation
 
 # Define paths to and from data
 in_path = os.path.join(base_dir, 'data', 'HydroRIVERS_v10_na.gdb')  # Downloaded from https://www.hydrosheds.org/products/hydrorivers
 out_path =  os.path.join(base_dir, 'data', 'graph.db')
+columnar_path = os.path.join(base_dir, 'data', 'graph')
+profile_path = os.path.join(base_dir, 'data', 'preprocess_stages.json')
 
-# Process data
-extract_graph(in_path, out_path)
-label_basins(out_path, 5)
-prune_graph(out_path)
-enforcce_binary(out_path)
+# Report each stage as it finishes
+instrumentation = Instrumentation(callbacks=[PrintLogger()])
+set_instrumentation(instrumentation)
+
+# Process data; finished stages are skipped and an interrupted extraction picks up from its last batch.  Pass
+# --dry-run to see what would be recomputed.
+dry_run = '--dry-run' in sys.argv
+plan = run_pipeline(in_path, out_path, order_thresh=5, columnar_path=columnar_path, dry_run=dry_run)
+for name, action, reason in plan:
+    print(f'{name}: {action} ({reason})')
+if not dry_run:
+    instrumentation.to_json(profile_path)
\ No newline at end of file